@@ -4,6 +4,7 @@ import time
 import logging
 import threading
 import pickle
+import itertools
 from functools import partial
 
 sys.path.append("../tooling/")
@@ -29,7 +30,9 @@ class LatencyWatcher():
             level = logging.INFO
         )
 
-        # Storage for latencies
+        # Storage for latencies, data_version changes whenever a sample comes in
+        self.data_version = 0
+        self.version_counter = itertools.count(1)
         self.latency_info = {}
         for account in self.accounts:
             self.latency_info[account] = {}
@@ -85,6 +88,7 @@ class LatencyWatcher():
                         account2 = tuple(notification.status.account.acct.split("@"))
                         logging.info("New read for " + str(account) + " from " + str(account2) + " -> " + str(latency))
                         self.latency_info[account][account2] = (latency, now)
+                        self.data_version = next(self.version_counter)
             except Exception as e:
                 logging.warn("Failed to log latency for " + str(account) + ", reason was " + str(e))
 
@@ -110,5 +114,8 @@ class LatencyWatcher():
             self.writers[account] = threading.Thread(target=write_worker, args=(account,))
             self.writers[account].start()
 
+    def get_data_version(self):
+        return self.data_version
+
     def get_latencies(self):
         return self.latency_info
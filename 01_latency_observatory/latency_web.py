@@ -1,8 +1,12 @@
-from flask import Flask
+from flask import Flask, request
+import sys
 import datetime
 
 from latencies import LatencyWatcher
 
+sys.path.append("../tooling/")
+from page_cache import PageCache
+
 # Settings
 accounts = [
     ("halcy", "mastodon.social"),
@@ -52,9 +56,15 @@ FOOT = """
 <a href="https://github.com/halcy/MastodonpyExamples/tree/master/01_latency_observatory">source code</a>
 </body></html>
 """
+page_cache = PageCache()
+
 app = Flask(__name__)
 @app.route('/')
 def base_page():
+    # Only rendered again when a new sample came in
+    return page_cache.respond(request, "base", watcher.get_data_version(), render_base_page)
+
+def render_base_page():
     # Get info from watcher
     latency_info = watcher.get_latencies()
 
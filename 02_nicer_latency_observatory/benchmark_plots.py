@@ -0,0 +1,134 @@
+# Page load benchmark for the latency plots
+# Fills a 10x10 matrix of account pairs with a week of samples and measures what one page
+# view costs on the server: before, every <img> rendered its plot inside the request (with
+# pyplot, global rcParams and figures that are never closed); after, the background renderer
+# keeps PNGs up to date and the request only picks up cached bytes. New samples arrive
+# between page views, so the synchronous path has to re-render every cell every time.
+#
+# Usage: python benchmark_plots.py [instances] [page views] [output.json]
+# Needs MASTODON_SECRET and MASTODON_GLOBAL_SECRET set, like the observatory itself.
+
+import sys
+import json
+import time
+import random
+import resource
+
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import matplotlib as mpl
+import matplotlib.dates as mdates
+import io
+import datetime
+
+import latencies
+import latency_plots
+
+# Settings
+DEFAULT_INSTANCES = 10
+DEFAULT_PAGE_VIEWS = 3
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def make_rings(accounts):
+    now = time.time()
+    latency_info = {}
+    for account in accounts:
+        latency_info[account] = {}
+        for account2 in accounts:
+            ring = latencies.LatencyRing(latencies.LATENCY_CACHE_MAX, latencies.LATENCY_CACHE_MEAN_OVER_LAST)
+            for i in range(latencies.LATENCY_CACHE_MAX):
+                ring.append(random.uniform(0.2, 3.0), now - (latencies.LATENCY_CACHE_MAX - i) * latencies.TIME_BETWEEN_PINGS)
+            latency_info[account][account2] = ring
+    return latency_info
+
+def add_samples(latency_info):
+    for row in latency_info.values():
+        for ring in row.values():
+            ring.append(random.uniform(0.2, 3.0), time.time())
+
+def render_in_request(account, account2, ring):
+    """
+    The old synchronous /plot path
+    """
+    COLOR = 'white'
+    mpl.rcParams['text.color'] = COLOR
+    mpl.rcParams['axes.labelcolor'] = COLOR
+    mpl.rcParams['xtick.color'] = COLOR
+    mpl.rcParams['ytick.color'] = COLOR
+    mpl.rcParams['axes.edgecolor'] = COLOR
+    _, latencies_copy, timestamps = ring.snapshot()
+    data_x = list(map(lambda x: datetime.datetime.fromtimestamp(x).astimezone(datetime.timezone.utc), timestamps))
+    data_y = latencies_copy * 1000
+    fig = plt.figure(figsize=(3.5, 3.5))
+    ax = fig.add_subplot(111)
+    ax.plot(data_x, data_y, marker="o", color=COLOR)
+    ax.set_title("{} ->\n{}\nMean[50]: {}ms".format(account[1], account2[1], str(round(ring.mean() * 1000, 2))))
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%b%d\n%H:%M'))
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', transparent=True, bbox_inches=0)
+    return buf.getvalue()
+
+def page_view(accounts, get_plot):
+    """
+    Server side time for one page: every off-diagonal cell fetches its plot
+    """
+    time_start = time.perf_counter()
+    for account in accounts:
+        for account2 in accounts:
+            if account != account2:
+                get_plot(account, account2)
+    return time.perf_counter() - time_start
+
+if __name__ == "__main__":
+    instances = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_INSTANCES
+    page_views = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_PAGE_VIEWS
+    accounts = [("latencyobs", "instance" + str(i) + ".example") for i in range(instances)]
+    latency_info = make_rings(accounts)
+    results = {"instances": instances, "page_views": page_views}
+
+    # Before: render in the request
+    rss_start = max_rss_mb()
+    timings = []
+    for _ in range(page_views):
+        add_samples(latency_info)
+        timings.append(page_view(accounts, lambda account, account2: render_in_request(account, account2, latency_info[account][account2])))
+    results["before"] = {
+        "page_seconds": timings,
+        "open_figures": len(plt.get_fignums()),
+        "max_rss_growth_mb": max_rss_mb() - rss_start,
+    }
+    plt.close("all")
+
+    # After: background renderer, requests read the cache
+    renderer = latency_plots.PlotRenderer(accounts, latency_info)
+    renderer.start()
+    time_start = time.perf_counter()
+    renderer.render_all()
+    results["after_initial_render_seconds"] = time.perf_counter() - time_start
+    rss_start = max_rss_mb()
+    timings = []
+    for _ in range(page_views):
+        add_samples(latency_info)
+        timings.append(page_view(accounts, renderer.get))
+    results["after"] = {
+        "page_seconds": timings,
+        "open_figures": len(plt.get_fignums()),
+        "max_rss_growth_mb": max_rss_mb() - rss_start,
+    }
+    renderer.stop()
+
+    for mode in ["before", "after"]:
+        print("{:<6} page load mean {:.4f}s max {:.4f}s | open figures {} | rss growth {:.1f}MB".format(
+            mode,
+            np.mean(results[mode]["page_seconds"]), max(results[mode]["page_seconds"]),
+            results[mode]["open_figures"], results[mode]["max_rss_growth_mb"]
+        ))
+    print("after: initial background render of all pairs took {:.2f}s".format(results["after_initial_render_seconds"]))
+    if len(sys.argv) > 3:
+        with open(sys.argv[3], 'w') as f:
+            json.dump(results, f, indent = 4)
@@ -0,0 +1,214 @@
+# Offline replay benchmark for LatencyWatcher
+# Runs a LatencyWatcher against fake_mastodon with simulated time: probes are posted on the
+# usual schedule, mentions come back with simulated latency, skew and loss, and weeks of data
+# go through log_latency in seconds. Measures ingest rate (log_latency events per second of
+# wall time), get_latencies / get_percentiles / get_latencies_graph call latency and resident
+# memory per simulated day, and API calls per instance and day. Probes and delete sweeps are
+# scheduled by the ProbeScheduler's bookkeeping, driven here in simulated time instead of by
+# its asyncio loop, which sleeps in real time. Halfway through, one instance has an incident
+# (extra delivery delay), to see how many more samples adaptive probing gets for it, and
+# whether change detection alerts on it (and on nothing else).
+#
+# Usage: python benchmark_replay.py [instances] [weeks] [loss] [skew] [output.json]
+# Needs MASTODON_SECRET and MASTODON_GLOBAL_SECRET set, like the observatory itself.
+
+import os
+import sys
+import json
+import heapq
+import time
+import shutil
+import logging
+import resource
+import tempfile
+
+import latencies
+import latency_plots
+import latency_probes
+import latency_alerts
+import fake_mastodon
+from benchmark_plots import page_view
+
+# Settings
+DEFAULT_INSTANCES = 10
+DEFAULT_WEEKS = 2
+DEFAULT_LOSS = 0.01
+DEFAULT_SKEW = 2.0
+QUERY_SAMPLES = 20
+SIMULATED_DAY = 24 * 60 * 60
+API_CALL_TARGET = 0.5
+INCIDENT_DELAY = 10.0
+INCIDENT_SECONDS = 2 * 60 * 60
+
+def rss_mb():
+    """
+    Current resident set size, or the peak if /proc isn't there
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024.0 / 1024.0
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def call_stats(function, samples = QUERY_SAMPLES):
+    """
+    Mean and max call latency of function() in milliseconds
+    """
+    latencies_ms = []
+    for _ in range(samples):
+        call_start = time.perf_counter()
+        function()
+        latencies_ms.append((time.perf_counter() - call_start) * 1000.0)
+    return {"mean_ms": sum(latencies_ms) / len(latencies_ms), "max_ms": max(latencies_ms)}
+
+def replay(instances, weeks, loss, skew, store_dir):
+    accounts = [("latencyobs", "instance" + str(i) + ".example") for i in range(instances)]
+    clock = fake_mastodon.SimClock(time.time())
+    network = fake_mastodon.FakeNetwork(clock, skew = skew, loss = loss)
+    alerts = latency_alerts.AlertDispatcher(os.path.join(store_dir, "alerts.jsonl"), None)
+    watcher = latencies.LatencyWatcher(accounts, api_factory = network.api_factory, clock = clock, store_dir = store_dir, alerts = alerts)
+    logging.getLogger().setLevel(logging.ERROR)
+    watcher.start_readers()
+    alerts.start()
+
+    results = {"instances": instances, "weeks": weeks, "loss": loss, "skew": skew, "days": []}
+    scheduler = watcher.probe_scheduler
+    ingest = {"seconds": 0.0, "events": 0}
+    def deliver_until(timestamp):
+        delivered_before = network.stats["delivered"]
+        deliver_start = time.perf_counter()
+        network.deliver_until(timestamp)
+        ingest["seconds"] += time.perf_counter() - deliver_start
+        ingest["events"] += network.stats["delivered"] - delivered_before
+
+    # Timeline: probe wakeups per account, delete sweeps, the incident and daily measurements
+    start = clock()
+    end = start + weeks * 7 * SIMULATED_DAY
+    incident_start = start + (end - start) / 2
+    incident_account = accounts[0][0] + "@" + accounts[0][1]
+    incident = {}
+    wakeups = [(scheduler.next_wakeup(account, start), i, account) for i, account in enumerate(accounts)]
+    heapq.heapify(wakeups)
+    next_sweep = start + latency_probes.DELETE_SWEEP_INTERVAL
+    next_day = start + SIMULATED_DAY
+    time_start = time.perf_counter()
+    while clock() < end:
+        wakeup, i, account = heapq.heappop(wakeups)
+
+        while next_sweep <= wakeup:
+            deliver_until(next_sweep)
+            for sweep_account in accounts:
+                entries = scheduler.take_due_deletes(sweep_account, next_sweep)
+                scheduler.deletes_done(sweep_account, entries, scheduler.delete_batch(sweep_account, entries))
+            next_sweep += latency_probes.DELETE_SWEEP_INTERVAL
+
+        # Incident on the first instance, count what we get from it before and during
+        for name, at in [("before", incident_start - INCIDENT_SECONDS), ("start", incident_start), ("end", incident_start + INCIDENT_SECONDS)]:
+            if not name in incident and wakeup >= at:
+                deliver_until(at)
+                incident[name] = network.delivered_from[incident_account]
+                if name == "start":
+                    network.set_instance_delay(accounts[0][1], network.get_instance_delay(accounts[0][1]) + INCIDENT_DELAY)
+                if name == "end":
+                    network.set_instance_delay(accounts[0][1], network.get_instance_delay(accounts[0][1]) - INCIDENT_DELAY)
+
+        deliver_until(wakeup)
+        targets = scheduler.next_targets(account, wakeup)
+        if len(targets) > 0:
+            status = watcher.post_probe(account, targets)
+            scheduler.counters[(account, "post", "success")] += 1
+            scheduler.queue_delete(account, status, wakeup)
+        heapq.heappush(wakeups, (scheduler.next_wakeup(account, wakeup), i, account))
+
+        # Once per simulated day, measure the read side
+        if clock() >= next_day:
+            next_day += SIMULATED_DAY
+            results["days"].append({
+                "day": len(results["days"]) + 1,
+                "events": ingest["events"],
+                "get_latencies": call_stats(watcher.get_latencies),
+                "get_percentiles": call_stats(watcher.get_percentiles),
+                "rss_mb": rss_mb(),
+            })
+
+    results["wall_seconds"] = time.perf_counter() - time_start
+    results["events"] = ingest["events"]
+    results["ingest_events_per_sec"] = ingest["events"] / ingest["seconds"] if ingest["seconds"] > 0 else None
+    results["network"] = dict(network.stats)
+
+    # API calls against the original fixed schedule, one post mentioning everyone plus its
+    # delete per TIME_BETWEEN_PINGS
+    days = (end - start) / SIMULATED_DAY
+    results["api_calls_per_instance_day"] = (network.stats["posts"] + network.stats["deletes"]) / instances / days
+    results["original_api_calls_per_instance_day"] = 2 * SIMULATED_DAY / latencies.TIME_BETWEEN_PINGS
+    results["api_call_target_met"] = results["api_calls_per_instance_day"] <= API_CALL_TARGET * results["original_api_calls_per_instance_day"]
+    results["incident_samples"] = {"before": incident["start"] - incident["before"], "during": incident["end"] - incident["start"]}
+
+    # Alerts: incident pairs going degraded during the incident, and anything else
+    alerts.stop()
+    with open(alerts.log_file) as f:
+        raised = [json.loads(line) for line in f]
+    incident_alerts = [alert for alert in raised if alert["sender"] == incident_account and incident_start <= alert["timestamp"] <= incident_start + INCIDENT_SECONDS + SIMULATED_DAY / 24]
+    detected = [alert["timestamp"] - incident_start for alert in incident_alerts if alert["state"] == "degraded"]
+    results["alerts"] = {
+        "incident_pairs_degraded": len(detected),
+        "incident_pairs_recovered": len([alert for alert in incident_alerts if alert["state"] == "recovered"]),
+        "detection_delay_seconds": sum(detected) / len(detected) if len(detected) > 0 else None,
+        "other_alerts": len(raised) - len(incident_alerts),
+    }
+
+    # Plots: what one background render of a full pair costs, rendering every pair and the
+    # matrix sprite once, and what a page view costs once they are rendered
+    ring = watcher.latency_info[accounts[0]][accounts[1]]
+    _, pair_latencies, pair_timestamps = ring.snapshot()
+    results["render_plot"] = call_stats(
+        lambda: latency_plots.render_plot(accounts[0][1], accounts[1][1], pair_latencies, pair_timestamps, ring.mean()), 3
+    )
+    watcher.plot_renderer.start_pool()
+    time_start = time.perf_counter()
+    watcher.plot_renderer.render_all()
+    results["render_all_seconds"] = time.perf_counter() - time_start
+    results["get_latencies_graph_page_seconds"] = page_view(accounts, watcher.get_latencies_graph)
+    results["get_latencies_matrix"] = call_stats(watcher.get_latencies_matrix)
+    watcher.plot_renderer.stop()
+    return results
+
+if __name__ == "__main__":
+    instances = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_INSTANCES
+    weeks = float(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_WEEKS
+    loss = float(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_LOSS
+    skew = float(sys.argv[4]) if len(sys.argv) > 4 else DEFAULT_SKEW
+    store_dir = tempfile.mkdtemp(prefix = "benchmark_replay_")
+    try:
+        results = replay(instances, weeks, loss, skew, store_dir)
+    finally:
+        shutil.rmtree(store_dir)
+
+    print("{} events in {:.1f}s wall time, {:.0f} log_latency events/sec".format(
+        results["events"], results["wall_seconds"], results["ingest_events_per_sec"]
+    ))
+    for day in results["days"]:
+        if day["day"] % 7 == 0 or day["day"] == len(results["days"]):
+            print("day {:>3}: {} events | get_latencies {:.3f}ms | get_percentiles {:.3f}ms | rss {:.1f}MB".format(
+                day["day"], day["events"], day["get_latencies"]["mean_ms"], day["get_percentiles"]["mean_ms"], day["rss_mb"]
+            ))
+    print("api calls per instance and day: {:.0f} adaptive, {:.0f} original fixed schedule".format(
+        results["api_calls_per_instance_day"], results["original_api_calls_per_instance_day"]
+    ))
+    if not results["api_call_target_met"]:
+        print("FAIL: adaptive probing saves less than {:.0f}% of the original API calls".format(API_CALL_TARGET * 100))
+    print("samples from the incident instance: {} in the {}h before, {} during".format(
+        results["incident_samples"]["before"], INCIDENT_SECONDS // 3600, results["incident_samples"]["during"]
+    ))
+    print("alerts: {} of {} incident pairs degraded after {}s on average, {} recovered, {} other alerts".format(
+        results["alerts"]["incident_pairs_degraded"], instances - 1, results["alerts"]["detection_delay_seconds"],
+        results["alerts"]["incident_pairs_recovered"], results["alerts"]["other_alerts"]
+    ))
+    print("plots: render_plot {:.1f}ms | render_all {:.1f}s | page of get_latencies_graph {:.4f}s | get_latencies_matrix {:.3f}ms".format(
+        results["render_plot"]["mean_ms"], results["render_all_seconds"], results["get_latencies_graph_page_seconds"], results["get_latencies_matrix"]["mean_ms"]
+    ))
+    if len(sys.argv) > 5:
+        with open(sys.argv[5], 'w') as f:
+            json.dump(results, f, indent = 4)
+    if not results["api_call_target_met"]:
+        sys.exit(1)
@@ -0,0 +1,126 @@
+# Offline stand-in for the parts of Mastodon.py the latency observatory uses
+# A FakeNetwork connects FakeMastodon API objects for any number of accounts. Posting a status
+# schedules a mention notification for every mentioned account, after a simulated delivery
+# latency (per pair base latency, per instance extra delay for skew, random jitter), and drops
+# a configurable fraction of them. Time is simulated: nothing sleeps, deliver_until() advances
+# the SimClock to each delivery and hands the notification to the receiver's stream listener
+# on the calling thread. Pass FakeNetwork.api_factory and the clock to LatencyWatcher.
+
+import re
+import heapq
+import random
+import itertools
+import collections
+from types import SimpleNamespace
+
+# Settings
+DEFAULT_BASE_LATENCY = (0.2, 3.0)
+DEFAULT_JITTER = 0.3
+MENTION_PATTERN = re.compile(r"@([^@\s]+)@([^@\s]+)")
+
+class SimClock():
+    """
+    Simulated time, callable like time.time
+    """
+    def __init__(self, start):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance_to(self, timestamp):
+        self.now = max(self.now, timestamp)
+
+class FakeNetwork():
+    """
+    Delivery of mentions between all fake accounts
+    """
+    def __init__(self, clock, skew = 0.0, loss = 0.0, jitter = DEFAULT_JITTER, seed = 0):
+        self.clock = clock
+        self.loss = loss
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.skew = skew
+        self.instance_delay = {}
+        self.base_latency = {}
+        self.listeners = {}
+        self.pending = []
+        self.sequence = itertools.count()
+        self.status_ids = itertools.count(1)
+        self.stats = {"posts": 0, "deletes": 0, "delivered": 0, "dropped": 0}
+        self.delivered_from = collections.Counter()
+
+    def api_factory(self, account):
+        return FakeMastodon(self, account)
+
+    def get_base_latency(self, sender, receiver):
+        if not (sender, receiver) in self.base_latency:
+            self.base_latency[(sender, receiver)] = self.random.uniform(*DEFAULT_BASE_LATENCY)
+        return self.base_latency[(sender, receiver)]
+
+    def get_instance_delay(self, instance):
+        # Some instances are just slower at federating, by up to skew seconds
+        if not instance in self.instance_delay:
+            self.instance_delay[instance] = self.random.uniform(0, self.skew)
+        return self.instance_delay[instance]
+
+    def set_instance_delay(self, instance, delay):
+        self.instance_delay[instance] = delay
+
+    def post(self, sender, text):
+        self.stats["posts"] += 1
+        status = {"id": next(self.status_ids), "content": text, "account": {"acct": sender[0] + "@" + sender[1]}}
+        for receiver in MENTION_PATTERN.findall(text):
+            if self.random.random() < self.loss:
+                self.stats["dropped"] += 1
+                continue
+            latency = self.get_base_latency(sender, receiver) + self.get_instance_delay(sender[1])
+            latency *= self.random.lognormvariate(0, self.jitter)
+            heapq.heappush(self.pending, (self.clock() + latency, next(self.sequence), receiver, status))
+        return status
+
+    def delete(self, status):
+        self.stats["deletes"] += 1
+
+    def deliver_until(self, timestamp):
+        """
+        Deliver every notification due up to timestamp, in order, advancing the clock
+        """
+        while len(self.pending) > 0 and self.pending[0][0] <= timestamp:
+            deliver_at, _, receiver, status = heapq.heappop(self.pending)
+            self.clock.advance_to(deliver_at)
+            listener = self.listeners.get(receiver)
+            if listener is None:
+                self.stats["dropped"] += 1
+                continue
+            self.stats["delivered"] += 1
+            self.delivered_from[status["account"]["acct"]] += 1
+            listener.on_notification(SimpleNamespace(
+                type = "mention",
+                status = SimpleNamespace(
+                    content = status["content"],
+                    account = SimpleNamespace(acct = status["account"]["acct"])
+                )
+            ))
+        self.clock.advance_to(timestamp)
+
+class FakeMastodon():
+    """
+    The Mastodon API calls LatencyWatcher makes, for one account
+    """
+    def __init__(self, network, account):
+        self.network = network
+        self.account = account
+
+    def me(self):
+        return SimpleNamespace(acct = self.account[0])
+
+    def status_post(self, status, visibility = None):
+        return self.network.post(self.account, status)
+
+    def status_delete(self, status):
+        self.network.delete(status)
+
+    def stream_user(self, listener, run_async = False, reconnect_async = False):
+        self.network.listeners[self.account] = listener
+        return SimpleNamespace(close = lambda: self.network.listeners.pop(self.account, None))
@@ -2,34 +2,200 @@ import sys
 import os
 import time
 import logging
-import threading
 import numpy as np
-import matplotlib.pyplot as plt
+import itertools
+import threading
 from functools import partial
-import datetime
-import matplotlib as mpl
-import matplotlib.dates as mdates
-import io
-import copy
-import traceback
 
 sys.path.append("../tooling/")
 import secret_registry
 
+import latency_alerts
+import latency_histogram
+import latency_metrics
+import latency_plots
+import latency_probes
+import latency_query
+import latency_store
+
 from mastodon import Mastodon, streaming
 
 # Hardcoded settings
+ACCOUNTS = [
+    ("halcy", "mastodon.social"),
+    ("halcy", "glitch.social"),
+    ("latencyobs", "icosahedron.website"),
+    #("latencyobs", "botsin.space"),
+    ("halcy", "hachyderm.io"),
+]
 TIME_BETWEEN_PINGS = 60 * 5
 TIME_BEFORE_DELETE = 10
 SECRET = os.environ["MASTODON_SECRET"]
 LATENCY_TEST_FRAME = "____________LATENCYPING____________"
 LATENCY_CACHE_MAX = 7 * 24 * (60 * 60) // TIME_BETWEEN_PINGS
 LATENCY_CACHE_MEAN_OVER_LAST = 3 * (60 * 60) // TIME_BETWEEN_PINGS
+LATENCY_MEAN_RESUM_EVERY = 10000
+LATENCY_STORE_RAW_MAX = 90 * 24 * (60 * 60) // TIME_BETWEEN_PINGS
+AGGREGATE_POLL_INTERVAL = 1
+AGGREGATE_CURSOR_FILE = "aggregate_cursor"
+
+# Adaptive probing: a sample that is off by more than PROBE_CHANGE_THRESHOLD (relative to the
+# pair's rolling mean) divides its probe interval by PROBE_SPEEDUP, every unremarkable sample
+# stretches it by PROBE_BACKOFF, within PROBE_INTERVAL_MIN and PROBE_INTERVAL_MAX. A single
+# outlier costs a few faster probes, a real shift quickly gets the pair to the minimum. Pairs
+# that have gone quiet are probed again soon, then less and less often the longer they stay
+# silent (silence / PROBE_MISSING_BACKOFF), so a dead instance ends up at PROBE_INTERVAL_MAX.
+# No account posts more than once per PROBE_INTERVAL_MIN, and while none of its pairs is
+# probed faster than PROBE_INTERVAL_MAX only once per PROBE_INTERVAL_MAX, see latency_probes.
+PROBE_INTERVAL_MIN = 2 * 60
+PROBE_INTERVAL_MAX = 5 * TIME_BETWEEN_PINGS
+PROBE_SPEEDUP = 4
+PROBE_BACKOFF = 1.5
+PROBE_CHANGE_THRESHOLD = 1.0
+PROBE_CHANGE_FLOOR = 0.1
+PROBE_MISSING_FACTOR = 2
+PROBE_MISSING_BACKOFF = 4
+
+class LatencyRing():
+    """
+    Fixed size circular storage of (latency, timestamp) samples for one account pair.
+    Every sample is written twice, capacity apart, so the newest samples always form one
+    contiguous slice that readers get as a view, without copying. The sum over the last
+    mean_over latencies is kept up to date on every insert.
+
+    There is a single writer per pair (the stream thread of the receiving account), which
+    never waits for readers: it bumps version to odd before writing and back to even after,
+    seqlock style. Readers that need a consistent copy retry if the version moved under them.
+    """
+    def __init__(self, capacity, mean_over):
+        self.capacity = capacity
+        self.mean_over = min(mean_over, capacity)
+        self.latencies = np.zeros(2 * capacity)
+        self.timestamps = np.zeros(2 * capacity)
+        self.head = 0
+        self.count = 0
+        self.mean_sum = 0.0
+        self.inserts_since_resum = 0
+        self.version = 0
+
+    def append(self, latency, timestamp):
+        self.version += 1
+
+        # Drop the sample leaving the mean window
+        if self.count >= self.mean_over:
+            self.mean_sum -= self.latencies[self.head + self.capacity - self.mean_over]
+
+        self.latencies[self.head] = latency
+        self.latencies[self.head + self.capacity] = latency
+        self.timestamps[self.head] = timestamp
+        self.timestamps[self.head + self.capacity] = timestamp
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self.mean_sum += latency
+
+        # Every now and then, sum up from scratch so float error can't accumulate
+        self.inserts_since_resum += 1
+        if self.inserts_since_resum >= LATENCY_MEAN_RESUM_EVERY:
+            self.inserts_since_resum = 0
+            self.mean_sum = float(np.sum(self.view()[0][-self.mean_over:]))
+
+        self.version += 1
+
+    def load(self, latencies, timestamps):
+        """
+        Replace the contents with samples (oldest first), e.g. from the persistent store
+        """
+        self.version += 1
+        latencies = np.asarray(latencies)[-self.capacity:]
+        timestamps = np.asarray(timestamps)[-self.capacity:]
+        self.count = len(latencies)
+        self.head = self.count % self.capacity
+        for offset in [0, self.capacity]:
+            self.latencies[offset:offset + self.count] = latencies
+            self.timestamps[offset:offset + self.count] = timestamps
+        self.mean_sum = float(np.sum(latencies[-self.mean_over:]))
+        self.inserts_since_resum = 0
+        self.version += 1
+
+    def view(self):
+        """
+        Get (latencies, timestamps), oldest first, as views into the buffer
+        """
+        end = self.head + self.capacity
+        return self.latencies[end - self.count:end], self.timestamps[end - self.count:end]
+
+    def read_consistent(self, read):
+        """
+        Call read() until it ran without a write in between, return (version, result)
+        """
+        while True:
+            version = self.version
+            if version % 2 == 0:
+                result = read()
+                if self.version == version:
+                    return version, result
+            time.sleep(0)
+
+    def snapshot(self):
+        """
+        Get (version, latencies, timestamps) with private copies of this pair's samples
+        """
+        version, (latencies, timestamps) = self.read_consistent(
+            lambda: tuple(np.array(samples) for samples in self.view())
+        )
+        return version, latencies, timestamps
+
+    def summary(self):
+        """
+        Get (version, rolling mean, last timestamp), or None for mean and timestamp if there are no samples yet
+        """
+        version, result = self.read_consistent(
+            lambda: (self.mean(), self.last_timestamp()) if self.count > 0 else (None, None)
+        )
+        return (version,) + result
+
+    def mean(self):
+        return self.mean_sum / min(self.count, self.mean_over)
+
+    def last_timestamp(self):
+        return self.timestamps[self.head + self.capacity - 1]
+
+    def __len__(self):
+        return self.count
+
+class CountingStreamListener(streaming.CallbackStreamListener):
+    """
+    Callback listener that also counts connection aborts, after which Mastodon.py reconnects
+    """
+    def __init__(self, on_abort_handler, **kwargs):
+        super(CountingStreamListener, self).__init__(**kwargs)
+        self.on_abort_handler = on_abort_handler
+
+    def on_abort(self, err):
+        self.on_abort_handler(err)
+
+def login(account):
+    cred_file = secret_registry.get_name_for("day01latencyobs", SECRET, account[1], "user", account[0])
+    return Mastodon(access_token = cred_file)
 
 class LatencyWatcher():
-    def __init__(self, accounts):
-        # Store parameters
+    def __init__(self, accounts, api_factory = login, clock = time.time, store_dir = latency_store.STORE_DIR,
+                 aggregate = None, probe_accounts = None, listen_accounts = None, alerts = None):
+        # Store parameters. api_factory and clock can be replaced for offline runs, see fake_mastodon.
+        # accounts is the whole matrix. By default this watcher probes from and listens for all of
+        # them; with an aggregate (see latency_aggregate) it can be one node of several, which only
+        # probes from probe_accounts and listens for listen_accounts, writes what it measures to the
+        # aggregate and takes all samples from there. alerts (a latency_alerts.AlertDispatcher)
+        # gets degraded / recovered changes of pairs, if set.
         self.accounts = accounts
+        self.api_factory = api_factory
+        self.clock = clock
+        self.started = clock()
+        self.aggregate = aggregate
+        self.probe_accounts = accounts if probe_accounts is None else probe_accounts
+        self.listen_accounts = accounts if listen_accounts is None else listen_accounts
+        self.aggregate_cursor = None
+        self.alerts = alerts
 
         # Logging setup
         logging.basicConfig(
@@ -38,84 +204,160 @@ class LatencyWatcher():
             level = logging.INFO
         )
 
-        # Storage for latencies
+        # Storage for latencies: recent samples in memory, full history on disk.
+        # data_version changes whenever a sample comes in.
+        self.data_version = 0
+        self.version_counter = itertools.count(1)
+        self.store = latency_store.LatencyStore(store_dir, raw_capacity = LATENCY_STORE_RAW_MAX)
+        # No account probes itself, so there is nothing kept for (account, account).
         self.latency_info = {}
-        self.latency_info_cached = {}
-        self.latency_plot_cached = {}
-        self.latency_dirty = {}
-        self.latency_dirty_any = True
         for account in self.accounts:
             self.latency_info[account] = {}
-            self.latency_info_cached[account] = {}
-            self.latency_dirty[account] = {}
-            self.latency_plot_cached[account] = {}
             for account2 in self.accounts:
-                self.latency_info[account][account2] = []
-                self.latency_info_cached[account][account2] = (10000, 0)
-                self.latency_dirty[account][account2] = True
-                self.latency_plot_cached[account][account2] = None
+                if account == account2:
+                    continue
+                self.latency_info[account][account2] = LatencyRing(LATENCY_CACHE_MAX, LATENCY_CACHE_MEAN_OVER_LAST)
+                series = self.store.get_series(account, account2, create = False)
+                if series is not None:
+                    self.latency_info[account][account2].load(*series.get_raw(LATENCY_CACHE_MAX))
 
-        # Log in
-        self.apis = {}
-        self.mention_strings = {}
+        # Percentile histograms, hourly slices per pair, seeded from the store's hourly rollups
+        self.latency_histograms = {}
         for account in self.accounts:
-            cred_file = secret_registry.get_name_for("day01latencyobs", SECRET, account[1], "user", account[0])
-            self.apis[account] = Mastodon(access_token = cred_file)
+            self.latency_histograms[account] = {}
+            for account2 in self.accounts:
+                if account == account2:
+                    continue
+                histograms = latency_histogram.SlicedHistogram()
+                history_start = self.clock() - histograms.slices * histograms.slice_seconds
+                series = self.store.get_series(account, account2, create = False)
+                if series is not None:
+                    for slot in series.get_rollup("1h", history_start):
+                        histograms.load_slice(slot["start"], slot["histogram"], slot["max"])
+                self.latency_histograms[account][account2] = histograms
 
-            mention_str = ""
+        # Change detection per pair, baseline from the samples loaded above
+        self.detectors = {}
+        for account in self.accounts:
+            self.detectors[account] = {}
             for account2 in self.accounts:
-                if account2 != account:
-                    mention_str = mention_str + "@" + account2[0] + "@" + account2[1] + " "
-            self.mention_strings[account] = mention_str
+                if account == account2:
+                    continue
+                self.detectors[account][account2] = latency_alerts.ChangeDetector()
+                self.detectors[account][account2].seed(self.latency_info[account][account2].view()[0])
 
-            logging.info("Logged into " + str(account) + " = " + self.apis[account].me().acct)
+        # Current probe interval per pair
+        self.probe_intervals = {}
+        for account in self.accounts:
+            self.probe_intervals[account] = {}
+            for account2 in self.accounts:
+                if account == account2:
+                    continue
+                self.probe_intervals[account][account2] = TIME_BETWEEN_PINGS
 
-    def start(self):
-        # Write workers
-        def write_worker(account):
-            api = self.apis[account]
-            mention_str = self.mention_strings[account]
-            while True:
-                prev_status = None
-                try:
-                    logging.info("Attempting post for " + str(account))
-                    prev_status = api.status_post(
-                        status = mention_str + LATENCY_TEST_FRAME + str(time.time()) + LATENCY_TEST_FRAME,
-                        visibility = "direct"
-                    )
-                except Exception as e:
-                    logging.warn("Status post failed for " + str(account) + ", reason was " + str(e))
-                time.sleep(TIME_BEFORE_DELETE)
-                try:
-                    api.status_delete(prev_status)
-                except Exception as e:
-                    logging.warn("Status delete failed for " + str(account) + ", reason was " + str(e))
-                time.sleep(TIME_BETWEEN_PINGS)
-
-        # Latency logger using streaming API
-        def log_latency(account, notification):
-            try:
-                now = time.time()
-                if notification.type == "mention":
-                    text = notification.status.content
-                    if LATENCY_TEST_FRAME in text:
-                        latency_time = float(text.split(LATENCY_TEST_FRAME)[1])
-                        latency = now - latency_time
-                        account2 = tuple(notification.status.account.acct.split("@"))
-                        logging.info("New read for " + str(account) + " from " + str(account2) + " -> " + str(latency))
-                        self.latency_info[account][account2].append((latency, now))
-                        self.latency_info[account][account2] = self.latency_info[account][account2][-LATENCY_CACHE_MAX:]
-                        self.latency_dirty[account][account2] = True
-                        self.latency_dirty_any = True
-            except Exception as e:
-                logging.warn("Failed to log latency for " + str(account) + ", reason was " + str(e))
-
-        # Start readers
-        self.readers = {}
+        # Counters for /metrics
+        self.lifetime_histograms = {}
+        self.stream_aborts = {}
         for account in self.accounts:
+            self.stream_aborts[account] = 0
+            self.lifetime_histograms[account] = {}
+            for account2 in self.accounts:
+                if account == account2:
+                    continue
+                self.lifetime_histograms[account][account2] = latency_histogram.LatencyHistogram()
+
+        # Plots are rendered in the background whenever a pair's data changes
+        self.plot_renderer = latency_plots.PlotRenderer(self.accounts, self.latency_info)
+
+        # Log in, only to the accounts we probe from or listen for
+        self.apis = {}
+        for account in self.accounts:
+            if account in self.probe_accounts or account in self.listen_accounts:
+                self.apis[account] = self.api_factory(account)
+                logging.info("Logged into " + str(account) + " = " + self.apis[account].me().acct)
+
+        # Probes for all our accounts run on one scheduler thread
+        self.probe_scheduler = latency_probes.ProbeScheduler(
+            self.probe_accounts,
+            self.post_probe,
+            self.delete_probe,
+            self.pair_interval,
+            TIME_BEFORE_DELETE,
+            PROBE_INTERVAL_MIN,
+            clock = self.clock,
+            targets = self.accounts,
+            stable_post_interval = PROBE_INTERVAL_MAX
+        )
+
+    def post_probe(self, account, targets):
+        mention_str = ""
+        for account2 in targets:
+            mention_str = mention_str + "@" + account2[0] + "@" + account2[1] + " "
+        return self.apis[account].status_post(
+            status = mention_str + LATENCY_TEST_FRAME + str(self.clock()) + LATENCY_TEST_FRAME,
+            visibility = "direct"
+        )
+
+    def delete_probe(self, account, status):
+        self.apis[account].status_delete(status)
+
+    def pair_interval(self, account, account2):
+        """
+        Time between probes from account to account2: the adaptive interval of the pair, or
+        if it has no recent samples, one that grows with how long it has been silent
+        """
+        interval = self.probe_intervals[account2][account]
+        _, _, last_timestamp = self.latency_info[account2][account].summary()
+        now = self.clock()
+        if last_timestamp is None or now - last_timestamp > PROBE_MISSING_FACTOR * interval + TIME_BEFORE_DELETE:
+            silent_since = self.started if last_timestamp is None else max(last_timestamp, self.started)
+            return min(PROBE_INTERVAL_MAX, max(PROBE_INTERVAL_MIN, (now - silent_since) / PROBE_MISSING_BACKOFF))
+        return interval
+
+    def adapt_interval(self, account, account2, latency):
+        """
+        Shrink or stretch the probe interval of a pair for a new sample, before it is added
+        """
+        ring = self.latency_info[account][account2]
+        interval = self.probe_intervals[account][account2]
+        if len(ring) == 0:
+            interval = PROBE_INTERVAL_MIN
+        else:
+            mean = ring.mean()
+            if abs(latency - mean) / max(mean, PROBE_CHANGE_FLOOR) > PROBE_CHANGE_THRESHOLD:
+                interval = max(PROBE_INTERVAL_MIN, interval / PROBE_SPEEDUP)
+            else:
+                interval = min(PROBE_INTERVAL_MAX, interval * PROBE_BACKOFF)
+        self.probe_intervals[account][account2] = interval
+
+    def start(self, render_plots = True):
+        # Start plot rendering and periodic store flushes
+        if render_plots:
+            self.plot_renderer.start()
+        self.store.start_flushing()
+        if self.alerts is not None:
+            self.alerts.start()
+
+        # Start readers, and follow what the other nodes measured
+        self.start_readers()
+        if self.aggregate is not None:
+            self.aggregate.start_writing()
+            self.start_following()
+
+        # Wait a moment
+        time.sleep(1)
+
+        # Start probing
+        if len(self.probe_accounts) > 0:
+            self.probe_scheduler.start()
+
+    def start_readers(self):
+        self.readers = {}
+        for account in self.listen_accounts:
             logging.info("Starting reader for " + str(account))
-            listener = streaming.CallbackStreamListener(
-                notification_handler = partial(log_latency, account)
+            listener = CountingStreamListener(
+                partial(self.stream_aborted, account),
+                notification_handler = partial(self.log_latency, account)
             )
             self.readers[account] = self.apis[account].stream_user(
                 listener,
@@ -123,71 +365,150 @@ class LatencyWatcher():
                 reconnect_async = True
             )
 
-        # Wait a moment
-        time.sleep(1)
+    # Latency logger using streaming API
+    def log_latency(self, account, notification):
+        try:
+            now = self.clock()
+            if notification.type == "mention":
+                text = notification.status.content
+                if LATENCY_TEST_FRAME in text:
+                    latency_time = float(text.split(LATENCY_TEST_FRAME)[1])
+                    latency = now - latency_time
+                    account2 = tuple(notification.status.account.acct.split("@"))
+                    logging.info("New read for " + str(account) + " from " + str(account2) + " -> " + str(latency))
+                    if self.aggregate is None:
+                        self.record_sample(account, account2, latency, now)
+                    else:
+                        self.aggregate.add_sample(account, account2, now, latency)
+        except Exception as e:
+            logging.warn("Failed to log latency for " + str(account) + ", reason was " + str(e))
 
-        # Start writers
-        self.writers = {}
-        for account in self.accounts:
-            self.writers[account] = threading.Thread(target=write_worker, args=(account,))
-            self.writers[account].start()
+    def record_sample(self, account, account2, latency, timestamp):
+        """
+        Add a sample to everything that is kept per pair. Only ever called from one thread per pair:
+        the stream thread of the receiving account, or the aggregate follower.
+        """
+        self.adapt_interval(account, account2, latency)
+        self.latency_info[account][account2].append(latency, timestamp)
+        self.latency_histograms[account][account2].add(timestamp, latency)
+        self.lifetime_histograms[account][account2].add(latency)
+        self.data_version = next(self.version_counter)
+        self.store.append(account, account2, timestamp, latency)
+        change = self.detectors[account][account2].update(latency, timestamp)
+        if change is not None:
+            self.pair_changed(account, account2, change, latency, timestamp)
+
+    def pair_changed(self, account, account2, change, latency, timestamp):
+        detector = self.detectors[account][account2]
+        logging.warning("Latency to " + str(account) + " from " + str(account2) + " " + change + ", " + str(latency) + " vs. baseline " + str(detector.baseline()))
+        if self.alerts is not None:
+            self.alerts.send({
+                "state": change,
+                "receiver": account[0] + "@" + account[1],
+                "sender": account2[0] + "@" + account2[1],
+                "timestamp": timestamp,
+                "latency": latency,
+                "baseline": detector.baseline(),
+                "degraded_since": detector.degraded_since,
+            })
+
+    def follow_aggregate(self):
+        """
+        Record new samples from the aggregate, return how many there were. The id of the last
+        one goes to a file next to the store, so a restart picks up where this left off.
+        """
+        cursor_file = os.path.join(self.store.store_dir, AGGREGATE_CURSOR_FILE)
+        if self.aggregate_cursor is None:
+            self.aggregate_cursor = 0
+            if os.path.exists(cursor_file):
+                with open(cursor_file) as f:
+                    self.aggregate_cursor = int(f.read().strip() or 0)
+
+        samples = self.aggregate.samples_since(self.aggregate_cursor)
+        for row_id, account, account2, timestamp, latency in samples:
+            if account in self.latency_info and account2 in self.latency_info[account]:
+                self.record_sample(account, account2, latency, timestamp)
+            self.aggregate_cursor = row_id
+
+        if len(samples) > 0:
+            with open(cursor_file + ".tmp", "w") as f:
+                f.write(str(self.aggregate_cursor))
+            os.replace(cursor_file + ".tmp", cursor_file)
+        return len(samples)
+
+    def start_following(self):
+        def follow_worker():
+            while True:
+                try:
+                    if self.follow_aggregate() > 0:
+                        continue
+                except Exception as e:
+                    logging.warning("Following the aggregate failed, reason was " + str(e))
+                time.sleep(AGGREGATE_POLL_INTERVAL)
+        self.follow_thread = threading.Thread(target = follow_worker, daemon = True)
+        self.follow_thread.start()
+
+    def stream_aborted(self, account, err):
+        self.stream_aborts[account] += 1
+        logging.warning("Stream for " + str(account) + " aborted, reason was " + str(err))
+
+    def get_metrics(self):
+        # OpenMetrics text, see latency_metrics
+        return latency_metrics.render_metrics(self)
+
+    def get_data_version(self):
+        return self.data_version
 
     def get_latencies(self):
-        # Update cache if dirty
-        if self.latency_dirty_any:
-            self.latency_dirty_any = False
-            for account in self.accounts:
-                for account2 in self.accounts:
-                    if len(self.latency_info[account][account2]) > 0:
-                        self.latency_info_cached[account][account2] = (
-                                np.mean(list(map(lambda x: x[0], self.latency_info[account][account2][-LATENCY_CACHE_MEAN_OVER_LAST:]))),
-                                self.latency_info[account][account2][-1][1]
-                        )
-                    else:
-                        self.latency_info_cached[account][account2] = (10000, 0)
-        
-        # Return cached
-        return self.latency_info_cached
+        # Rolling means are kept up to date on insert, so this is cheap
+        latencies = {}
+        for account in self.accounts:
+            latencies[account] = {}
+            for account2 in self.latency_info[account]:
+                _, mean, last_timestamp = self.latency_info[account][account2].summary()
+                if mean is not None:
+                    latencies[account][account2] = (mean, last_timestamp)
+                else:
+                    latencies[account][account2] = (10000, 0)
+        return latencies
+
+    def get_percentiles(self, window = LATENCY_CACHE_MEAN_OVER_LAST * TIME_BETWEEN_PINGS):
+        """
+        p50 / p90 / p99 / max and sample count per pair over the last window seconds
+        (at hourly granularity), from merged histograms
+        """
+        now = self.clock()
+        percentiles = {}
+        for account in self.accounts:
+            percentiles[account] = {}
+            for account2 in self.latency_histograms[account]:
+                histogram = self.latency_histograms[account][account2].window(now - window, now + 1)
+                percentiles[account][account2] = histogram.summary()
+        return percentiles
+
+    def get_history(self, account, account2, tier = "1h", start = None, end = None):
+        """
+        Long range history for a pair from the store's rollup tiers ("1h" or "1d")
+        """
+        series = self.store.get_series(account, account2, create = False)
+        if series is None:
+            return []
+        return latency_store.summarize_rollup(series.get_rollup(tier, start, end))
+
+    def query_history(self, account, account2, start, end, points = latency_query.QUERY_DEFAULT_POINTS):
+        """
+        Up to points rows of a pair's history in [start, end), downsampled, see latency_query.
+        Returns (resolution, columns, rows).
+        """
+        series = self.store.get_series(account, account2, create = False)
+        if series is None:
+            return "raw", ["timestamp", "latency"], []
+        return latency_query.query_series(series, start, end, self.clock(), points)
 
     def get_latencies_graph(self, account, account2):
-        if self.latency_dirty[account][account2] or self.latency_plot_cached[account][account2] is None:
-            try:
-                # Refresh cache if needed
-                COLOR = 'white'
-                mpl.rcParams['text.color'] = COLOR
-                mpl.rcParams['axes.labelcolor'] = COLOR
-                mpl.rcParams['xtick.color'] = COLOR
-                mpl.rcParams['ytick.color'] = COLOR
-                mpl.rcParams['axes.edgecolor'] = COLOR
-
-                latency_val = self.get_latencies()[account][account2][0]
-                self.latency_dirty[account][account2] = False
-                latency_copy = copy.deepcopy(self.latency_info)
-                
-                data_x = list(map(lambda x: datetime.datetime.fromtimestamp(x[1]).astimezone(datetime.timezone.utc), latency_copy[account][account2]))
-                data_y = list(map(lambda x: x[0] * 1000, latency_copy[account][account2]))
-
-                # Basic matplotlib plot
-                fig = plt.figure(figsize=(3.5, 3.5))
-                ax = fig.add_subplot(111)
-                ax.plot(data_x, data_y, marker="o", color=COLOR)
-                ax.set_title("{} ->\n{}\nMean[50]: {}ms".format(account[1], account2[1], str(round(latency_val * 1000, 2)) + "ms" ))
-                ax.set_xlabel("Time")
-                ax.set_ylabel("Latency [ms]")
-                ax.xaxis.set_major_formatter(mdates.DateFormatter('%b%d\n%H:%M'))
-                ax.set_xticks(list(map(
-                    lambda x: datetime.datetime.fromtimestamp(x).astimezone(datetime.timezone.utc),
-                    np.linspace(data_x[0].timestamp(), data_x[-1].timestamp(), 5)
-                )))
-                ax.set_xlim(data_x[0], data_x[-1])
-                fig.tight_layout()
-
-                # Save the figure to a PNG file in memory
-                buf = io.BytesIO()
-                fig.savefig(buf, format='png', transparent=True, bbox_inches=0)
-
-                # Get the PNG image data from the BytesIO object
-                self.latency_plot_cached[account][account2] = buf.getvalue()
-            except Exception as e:
-                traceback.print_exc()
-        return self.latency_plot_cached[account][account2]
+        # Latest finished render, never blocks on matplotlib
+        return self.plot_renderer.get(account, account2)
+
+    def get_latencies_matrix(self):
+        # (etag, png) of all pairs as one sprite of thumbnails, see latency_plots.PlotRenderer
+        return self.plot_renderer.get_sprite()
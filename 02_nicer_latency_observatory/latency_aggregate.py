@@ -0,0 +1,143 @@
+# Shared aggregation store for distributed latency probing
+# Probe and listener nodes (see latency_node) can run as separate processes, on one machine or
+# several, each owning some of the accounts. Listeners write the samples they measure into one
+# SQLite database in WAL mode, and everyone that needs the full picture (the web frontend, and
+# probe nodes for their adaptive intervals) follows it by row id. Samples only stay in the
+# database for AGGREGATE_RETENTION: long term history is kept by the followers' own stores.
+#
+# Writes from stream callbacks only go to a queue, a writer thread inserts them in batches, so
+# a slow or locked database never holds up a stream. Row ids are only ever handed out inside a
+# write transaction, and SQLite has a single writer at a time, so a follower that remembers the
+# last id it has seen never misses a sample, however many nodes write.
+
+import os
+import time
+import queue
+import sqlite3
+import logging
+import threading
+
+# Settings
+AGGREGATE_DB = os.environ.get("LATENCY_AGGREGATE_DB", "latency_aggregate.sqlite")
+AGGREGATE_WRITE_BATCH = 1000
+AGGREGATE_RETRY_INTERVAL = 5
+AGGREGATE_RETENTION = 7 * 24 * 60 * 60
+AGGREGATE_PRUNE_INTERVAL = 60 * 60
+AGGREGATE_PRUNE_BATCH = 10000
+
+def account_str(account):
+    return account[0] + "@" + account[1]
+
+def parse_account(account_str):
+    return tuple(account_str.split("@"))
+
+class AggregateStore():
+    """
+    Latency samples of all nodes in one SQLite database, by receiving and sending account
+    """
+    def __init__(self, db_file, node = ""):
+        self.db_file = db_file
+        self.node = node
+        self.local = threading.local()
+        self.queue = queue.Queue()
+        self.writer_thread = None
+        db = self.get_db()
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS samples (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                receiver TEXT,
+                sender TEXT,
+                timestamp REAL,
+                latency REAL,
+                node TEXT
+            )
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS samples_by_timestamp ON samples (timestamp)")
+        db.commit()
+
+    def get_db(self):
+        # One connection per thread
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.db_file, timeout = 30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+
+    def add_sample(self, account, account2, timestamp, latency):
+        """
+        Queue a sample (latency seen by account for a probe from account2) for the writer thread
+        """
+        self.queue.put((account_str(account), account_str(account2), timestamp, latency, self.node))
+
+    def write_samples(self, samples):
+        db = self.get_db()
+        db.executemany("INSERT INTO samples (receiver, sender, timestamp, latency, node) VALUES (?, ?, ?, ?, ?)", samples)
+        db.commit()
+
+    def samples_since(self, cursor, limit = AGGREGATE_WRITE_BATCH):
+        """
+        Get up to limit samples with an id above cursor, oldest first, as
+        (id, account, account2, timestamp, latency)
+        """
+        rows = self.get_db().execute(
+            "SELECT id, receiver, sender, timestamp, latency FROM samples WHERE id > ? ORDER BY id LIMIT ?",
+            (cursor, limit)
+        ).fetchall()
+        return [(row_id, parse_account(receiver), parse_account(sender), timestamp, latency) for row_id, receiver, sender, timestamp, latency in rows]
+
+    def prune(self, before):
+        """
+        Delete samples older than before, in batches so writers don't wait long
+        """
+        db = self.get_db()
+        pruned = 0
+        while True:
+            deleted = db.execute(
+                "DELETE FROM samples WHERE id IN (SELECT id FROM samples WHERE timestamp < ? LIMIT ?)",
+                (before, AGGREGATE_PRUNE_BATCH)
+            ).rowcount
+            db.commit()
+            pruned += deleted
+            if deleted < AGGREGATE_PRUNE_BATCH:
+                break
+        return pruned
+
+    def start_writing(self):
+        """
+        Write queued samples in a background thread, and prune old ones every AGGREGATE_PRUNE_INTERVAL
+        """
+        if self.writer_thread is not None:
+            return
+        def writer_worker():
+            samples = []
+            next_prune = time.time()
+            while True:
+                # Block for the first sample, then take whatever else is queued
+                if len(samples) == 0:
+                    samples.append(self.queue.get())
+                while len(samples) < AGGREGATE_WRITE_BATCH:
+                    try:
+                        samples.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                try:
+                    self.write_samples(samples)
+                    samples = []
+                except Exception as e:
+                    # Keep the batch and try again
+                    logging.warning("Writing " + str(len(samples)) + " samples to the aggregate failed, reason was " + str(e))
+                    time.sleep(AGGREGATE_RETRY_INTERVAL)
+                    continue
+
+                if time.time() >= next_prune:
+                    next_prune = time.time() + AGGREGATE_PRUNE_INTERVAL
+                    try:
+                        pruned = self.prune(time.time() - AGGREGATE_RETENTION)
+                        if pruned > 0:
+                            logging.info("Pruned " + str(pruned) + " samples from the aggregate")
+                    except Exception as e:
+                        logging.warning("Pruning the aggregate failed, reason was " + str(e))
+        self.writer_thread = threading.Thread(target = writer_worker, daemon = True)
+        self.writer_thread.start()
@@ -0,0 +1,42 @@
+# Local webhook sink for latency alerts
+# Accepts the JSON alerts latency_alerts.AlertDispatcher POSTs, logs them and appends them to
+# a JSON lines file. Point LATENCY_ALERT_WEBHOOK at it to try alerting without any external
+# service, or use it as a starting point for forwarding alerts somewhere else.
+#
+# Usage: python latency_alert_sink.py [port] [output.jsonl]
+
+import sys
+import json
+import logging
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Settings
+DEFAULT_PORT = 8089
+DEFAULT_OUTPUT = "latency_alerts_received.jsonl"
+
+class AlertSinkHandler(BaseHTTPRequestHandler):
+    output_file = DEFAULT_OUTPUT
+
+    def do_POST(self):
+        try:
+            alert = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValueError:
+            self.send_response(400)
+            self.end_headers()
+            return
+        logging.info("Alert: " + alert.get("sender", "?") + " -> " + alert.get("receiver", "?") + " " + alert.get("state", "?"))
+        with open(self.output_file, "a") as f:
+            f.write(json.dumps(alert) + "\n")
+        self.send_response(204)
+        self.end_headers()
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        stream = sys.stdout,
+        format = "%(levelname)s %(asctime)s - %(message)s",
+        level = logging.INFO
+    )
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT
+    AlertSinkHandler.output_file = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_OUTPUT
+    logging.info("Listening for alerts on port " + str(port))
+    HTTPServer(("127.0.0.1", port), AlertSinkHandler).serve_forever()
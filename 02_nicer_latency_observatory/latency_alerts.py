@@ -0,0 +1,145 @@
+# Change point detection and alerting for the latency observatory
+# Every pair has a ChangeDetector that sees each sample as it comes in: an EWMA of the log
+# latency and its variance is the pair's baseline, and a one-sided CUSUM of how far samples
+# are above it decides when the pair is degraded. Once degraded the baseline is frozen, and a
+# second CUSUM of samples back near it decides when it has recovered. Log latency, because
+# federation delays are multiplicative-ish; standardized deviations are clipped, so a single
+# huge outlier can't raise an alert on its own. An update is a handful of float operations,
+# whatever the number of pairs.
+#
+# State changes go to an AlertDispatcher, which only queues them: a background thread appends
+# them to a JSON lines log and POSTs them to a webhook, if one is set, so a slow webhook never
+# holds up a stream callback. latency_alert_sink is a local webhook to point it at.
+
+import os
+import json
+import math
+import queue
+import logging
+import threading
+import urllib.request
+
+import numpy as np
+
+# Settings
+ALERT_LOG = os.environ.get("LATENCY_ALERT_LOG", "latency_alerts.jsonl")
+ALERT_WEBHOOK = os.environ.get("LATENCY_ALERT_WEBHOOK")
+ALERT_WEBHOOK_TIMEOUT = 10
+DETECT_ALPHA = 0.02
+DETECT_SLACK = 1.0
+DETECT_THRESHOLD = 6.0
+DETECT_RECOVER_THRESHOLD = 4.0
+DETECT_Z_CLIP = 3.0
+DETECT_MIN_SIGMA = 0.05
+DETECT_FLOOR = 0.001
+DETECT_WARMUP = 20
+DETECT_SEED = 200
+
+class ChangeDetector():
+    """
+    EWMA baseline and CUSUM degraded / recovered detection on the log latency of one pair
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.var = 0.0
+        self.cusum = 0.0
+        self.degraded = False
+        self.degraded_since = None
+
+    def seed(self, latencies):
+        """
+        Start the baseline from past samples (oldest first), e.g. what the pair's ring was loaded with
+        """
+        logs = np.log(np.maximum(np.asarray(latencies)[-DETECT_SEED:], DETECT_FLOOR))
+        if len(logs) > 0:
+            self.count = len(logs)
+            self.mean = float(np.mean(logs))
+            self.var = float(np.var(logs))
+
+    def baseline(self):
+        return math.exp(self.mean)
+
+    def update(self, latency, timestamp):
+        """
+        Add a sample, return "degraded" or "recovered" if the pair's state changed, else None
+        """
+        x = math.log(max(latency, DETECT_FLOOR))
+        self.count += 1
+
+        # First samples only build the baseline, as a plain running mean and variance
+        if self.count <= DETECT_WARMUP:
+            delta = x - self.mean
+            self.mean += delta / self.count
+            self.var = (1.0 - 1.0 / self.count) * (self.var + delta * delta / self.count)
+            return None
+
+        sigma = max(math.sqrt(self.var), DETECT_MIN_SIGMA)
+        z = min(DETECT_Z_CLIP, max(-DETECT_Z_CLIP, (x - self.mean) / sigma))
+
+        if self.degraded:
+            # Samples back within the slack of the frozen baseline count towards recovery
+            self.cusum = max(0.0, self.cusum + DETECT_SLACK - z)
+            if self.cusum > DETECT_RECOVER_THRESHOLD:
+                self.degraded = False
+                self.cusum = 0.0
+                return "recovered"
+            return None
+
+        self.cusum = max(0.0, self.cusum + z - DETECT_SLACK)
+        if self.cusum > DETECT_THRESHOLD:
+            self.degraded = True
+            self.degraded_since = timestamp
+            self.cusum = 0.0
+            return "degraded"
+
+        # Learn the baseline from normal samples, outliers only count up to the clip
+        delta = z * sigma
+        self.mean += DETECT_ALPHA * delta
+        self.var = (1.0 - DETECT_ALPHA) * (self.var + DETECT_ALPHA * delta * delta)
+        return None
+
+class AlertDispatcher():
+    """
+    Writes alerts to a JSON lines log and POSTs them to webhook (if not None), in a background thread
+    """
+    def __init__(self, log_file = ALERT_LOG, webhook = ALERT_WEBHOOK):
+        self.log_file = log_file
+        self.webhook = webhook
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def send(self, alert):
+        self.queue.put(alert)
+
+    def deliver(self, alert):
+        line = json.dumps(alert)
+        with open(self.log_file, "a") as f:
+            f.write(line + "\n")
+        if self.webhook is not None:
+            request = urllib.request.Request(self.webhook, data = line.encode("utf-8"), headers = {"Content-Type": "application/json"})
+            urllib.request.urlopen(request, timeout = ALERT_WEBHOOK_TIMEOUT).close()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        def dispatch_worker():
+            while True:
+                alert = self.queue.get()
+                if alert is None:
+                    return
+                try:
+                    self.deliver(alert)
+                except Exception as e:
+                    logging.warning("Delivering alert failed, reason was " + str(e))
+        self.thread = threading.Thread(target = dispatch_worker, daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Deliver what is queued, then end the background thread
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,135 @@
+# Mergeable log bucket latency histograms
+# Bucket i counts latencies in [HIST_MIN * HIST_GROWTH^i, HIST_MIN * HIST_GROWTH^(i+1)), so
+# percentiles are accurate to about HIST_GROWTH relative error with a fixed number of counters.
+# Histograms merge by adding counts, which is what makes windows cheap: a pair keeps one
+# histogram per hour, and any window is the sum of the hours it covers. Nothing ever sorts
+# raw samples. The persistent store uses the same buckets for its rollup tiers.
+
+import math
+
+import numpy as np
+
+# Settings
+HIST_MIN = 0.001
+HIST_GROWTH = 1.25
+HIST_BUCKETS = 64
+SLICE_SECONDS = 60 * 60
+SLICES = 7 * 24
+PERCENTILES = [50, 90, 99]
+
+def bucket_for(latency):
+    # First and last bucket also take everything below / above
+    if latency <= HIST_MIN:
+        return 0
+    return min(HIST_BUCKETS - 1, int(math.log(latency / HIST_MIN) / math.log(HIST_GROWTH)))
+
+def bucket_value(bucket):
+    """
+    Representative latency for a bucket (geometric middle)
+    """
+    return HIST_MIN * HIST_GROWTH ** (bucket + 0.5)
+
+def bucket_upper_bound(bucket):
+    return HIST_MIN * HIST_GROWTH ** (bucket + 1)
+
+def histogram_percentile(counts, percentile):
+    """
+    Estimate a percentile (0 - 100) from bucket counts, None if there are no samples
+    """
+    total = int(np.sum(counts))
+    if total == 0:
+        return None
+    rank = max(1, int(math.ceil(percentile / 100.0 * total)))
+    bucket = int(np.searchsorted(np.cumsum(counts), rank))
+    return bucket_value(bucket)
+
+class LatencyHistogram():
+    """
+    Bucket counts plus the exact maximum, and the sum if built from individual samples
+    """
+    def __init__(self, counts = None, maximum = None):
+        self.counts = np.zeros(HIST_BUCKETS, np.uint64) if counts is None else counts.astype(np.uint64)
+        self.maximum = maximum
+        self.total = 0.0
+
+    def add(self, latency):
+        self.counts[bucket_for(latency)] += 1
+        self.total += latency
+        self.maximum = latency if self.maximum is None else max(self.maximum, latency)
+
+    def merge(self, other):
+        self.counts += other.counts.astype(np.uint64)
+        self.total += other.total
+        if other.maximum is not None:
+            self.maximum = other.maximum if self.maximum is None else max(self.maximum, other.maximum)
+
+    def count(self):
+        return int(np.sum(self.counts))
+
+    def percentile(self, percentile):
+        value = histogram_percentile(self.counts, percentile)
+        if value is None:
+            return None
+
+        # Never report a percentile above the real maximum
+        return min(value, self.maximum)
+
+    def summary(self):
+        summary = {"count": self.count(), "max": self.maximum}
+        for percentile in PERCENTILES:
+            summary["p" + str(percentile)] = self.percentile(percentile)
+        return summary
+
+class SlicedHistogram():
+    """
+    One histogram per SLICE_SECONDS for the last SLICES slices, in a ring addressed by time.
+    Adding is O(1), a window query merges at most SLICES histograms.
+    """
+    def __init__(self, slices = SLICES, slice_seconds = SLICE_SECONDS):
+        self.slices = slices
+        self.slice_seconds = slice_seconds
+        self.counts = np.zeros((slices, HIST_BUCKETS), np.uint32)
+        self.starts = np.full(slices, -1.0)
+        self.maxima = np.zeros(slices)
+
+    def get_slot(self, timestamp):
+        """
+        Slot for a timestamp, cleared first if it still holds an older slice. None if it
+        already holds a newer one, i.e. the timestamp is older than the ring covers.
+        """
+        start = (timestamp // self.slice_seconds) * self.slice_seconds
+        slot = int(timestamp // self.slice_seconds) % self.slices
+        if self.starts[slot] > start:
+            return None
+        if self.starts[slot] != start:
+            self.counts[slot] = 0
+            self.maxima[slot] = 0.0
+            self.starts[slot] = start
+        return slot
+
+    def add(self, timestamp, latency):
+        slot = self.get_slot(timestamp)
+        if slot is None:
+            return
+        self.counts[slot, bucket_for(latency)] += 1
+        self.maxima[slot] = max(self.maxima[slot], latency)
+
+    def load_slice(self, start, counts, maximum):
+        """
+        Fill one slice from precomputed counts, e.g. an hourly rollup of the persistent store
+        """
+        slot = self.get_slot(start)
+        if slot is None:
+            return
+        self.counts[slot] = counts
+        self.maxima[slot] = maximum
+
+    def window(self, start, end):
+        """
+        Merged histogram of all slices overlapping [start, end)
+        """
+        first_start = (start // self.slice_seconds) * self.slice_seconds
+        used = (self.starts >= first_start) & (self.starts < end)
+        if not np.any(used):
+            return LatencyHistogram()
+        return LatencyHistogram(np.sum(self.counts[used], axis = 0), float(np.max(self.maxima[used])))
@@ -0,0 +1,101 @@
+# OpenMetrics export for the latency observatory
+# Everything exported is state the watcher keeps up to date as samples and probes happen:
+# lifetime latency histograms per pair, the pairs' last sample times and change detector
+# states, probe counters of the scheduler and stream abort counts. A scrape only reads that state, O(pairs), without taking
+# any lock writers could be waiting on. Probe and stream counters only exist in the process that
+# probes or listens, so they are only exported for the watcher's own probe_accounts and
+# listen_accounts; a frontend that reads the aggregate (see latency_aggregate) has none.
+
+import numpy as np
+
+import latency_histogram
+
+# Settings
+METRIC_PREFIX = "latency_observatory_"
+METRICS_BUCKET_STRIDE = 4
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+def label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def labels(**kwargs):
+    return "{" + ",".join(key + "=\"" + label_value(value) + "\"" for key, value in kwargs.items()) + "}"
+
+def account_str(account):
+    return account[0] + "@" + account[1]
+
+# Exported bucket boundaries: every METRICS_BUCKET_STRIDE-th histogram bucket, the rest get folded in
+EXPORTED_BUCKETS = list(range(METRICS_BUCKET_STRIDE - 1, latency_histogram.HIST_BUCKETS - 1, METRICS_BUCKET_STRIDE))
+EXPORTED_BOUNDS = ["{:.6g}".format(latency_histogram.bucket_upper_bound(bucket)) for bucket in EXPORTED_BUCKETS]
+
+def render_metrics(watcher):
+    """
+    OpenMetrics text for a LatencyWatcher
+    """
+    now = watcher.clock()
+    lines = []
+
+    # Latency histograms, cumulative since start
+    name = METRIC_PREFIX + "latency_seconds"
+    lines.append("# TYPE " + name + " histogram")
+    lines.append("# UNIT " + name + " seconds")
+    lines.append("# HELP " + name + " Time from probe post to notification, by receiving and sending account.")
+    for account in watcher.accounts:
+        for account2 in watcher.accounts:
+            if account == account2:
+                continue
+            histogram = watcher.lifetime_histograms[account][account2]
+            cumulative = np.cumsum(histogram.counts)
+            receiver, sender = account_str(account), account_str(account2)
+            for bucket, bound in zip(EXPORTED_BUCKETS, EXPORTED_BOUNDS):
+                lines.append(name + "_bucket" + labels(receiver = receiver, sender = sender, le = bound) + " " + str(int(cumulative[bucket])))
+            lines.append(name + "_bucket" + labels(receiver = receiver, sender = sender, le = "+Inf") + " " + str(int(cumulative[-1])))
+            lines.append(name + "_count" + labels(receiver = receiver, sender = sender) + " " + str(int(cumulative[-1])))
+            lines.append(name + "_sum" + labels(receiver = receiver, sender = sender) + " " + repr(float(histogram.total)))
+
+    # Age of the newest sample per pair
+    name = METRIC_PREFIX + "last_sample_age_seconds"
+    lines.append("# TYPE " + name + " gauge")
+    lines.append("# UNIT " + name + " seconds")
+    lines.append("# HELP " + name + " Seconds since the last latency sample, by receiving and sending account.")
+    for account in watcher.accounts:
+        for account2 in watcher.accounts:
+            if account == account2:
+                continue
+            _, _, last_timestamp = watcher.latency_info[account][account2].summary()
+            if last_timestamp is not None:
+                lines.append(name + labels(receiver = account_str(account), sender = account_str(account2)) + " " + repr(float(now - last_timestamp)))
+
+    # Change detector state per pair
+    name = METRIC_PREFIX + "pair_degraded"
+    lines.append("# TYPE " + name + " gauge")
+    lines.append("# HELP " + name + " 1 while change detection considers the pair's latency degraded, by receiving and sending account.")
+    for account in watcher.accounts:
+        for account2 in watcher.accounts:
+            if account == account2:
+                continue
+            degraded = watcher.detectors[account][account2].degraded
+            lines.append(name + labels(receiver = account_str(account), sender = account_str(account2)) + " " + ("1" if degraded else "0"))
+
+    # Probe post / delete outcomes
+    if len(watcher.probe_accounts) > 0:
+        name = METRIC_PREFIX + "probes"
+        counters = dict(watcher.probe_scheduler.counters)
+        lines.append("# TYPE " + name + " counter")
+        lines.append("# HELP " + name + " Probe status posts and deletes, by account and result.")
+        for account in watcher.probe_accounts:
+            for action in ["post", "delete"]:
+                for result in ["success", "failure"]:
+                    count = counters.get((account, action, result), 0)
+                    lines.append(name + "_total" + labels(account = account_str(account), action = action, result = result) + " " + str(count))
+
+    # Stream aborts, each one followed by a reconnect attempt
+    if len(watcher.listen_accounts) > 0:
+        name = METRIC_PREFIX + "stream_reconnects"
+        lines.append("# TYPE " + name + " counter")
+        lines.append("# HELP " + name + " Streaming connection aborts that triggered a reconnect, by account.")
+        for account in watcher.listen_accounts:
+            lines.append(name + "_total" + labels(account = account_str(account)) + " " + str(watcher.stream_aborts[account]))
+
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,44 @@
+# Probe / listener node for distributed latency probing
+# Runs a LatencyWatcher for a subset of the accounts: it posts probes from the ones it probes
+# for, and measures latency on the streams of the ones it listens for, writing samples to the
+# shared aggregate (see latency_aggregate) that latency_web reads when LATENCY_AGGREGATE_DB is
+# set. Every node follows the aggregate too, so probe intervals adapt to what other nodes
+# measured. To scale out, start more nodes and split the accounts between them; each account
+# should be probed by one node and listened for by one node. Latencies are measured across
+# nodes (post time on one, arrival time on another), so node clocks need to be kept in sync.
+#
+# Usage: python latency_node.py <node name> <probe|listen|probe,listen> [user@instance ...]
+# Without accounts, the node takes all of latencies.ACCOUNTS. Needs MASTODON_SECRET and
+# MASTODON_GLOBAL_SECRET like the observatory itself, LATENCY_AGGREGATE_DB picks the database.
+
+import os
+import sys
+import time
+
+import latency_store
+from latencies import LatencyWatcher, ACCOUNTS
+from latency_aggregate import AggregateStore, AGGREGATE_DB, parse_account
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python latency_node.py <node name> <probe|listen|probe,listen> [user@instance ...]")
+        sys.exit(1)
+    node = sys.argv[1]
+    roles = sys.argv[2].split(",")
+    owned = [parse_account(account) for account in sys.argv[3:]] if len(sys.argv) > 3 else ACCOUNTS
+    for account in owned:
+        if not account in ACCOUNTS:
+            print("Unknown account " + "@".join(account))
+            sys.exit(1)
+
+    # Every node keeps its own local store
+    watcher = LatencyWatcher(
+        ACCOUNTS,
+        store_dir = os.path.join(latency_store.STORE_DIR, "node_" + node),
+        aggregate = AggregateStore(AGGREGATE_DB, node),
+        probe_accounts = owned if "probe" in roles else [],
+        listen_accounts = owned if "listen" in roles else []
+    )
+    watcher.start(render_plots = False)
+    while True:
+        time.sleep(60)
@@ -0,0 +1,321 @@
+# Latency plot rendering, off the request path
+# Plots are rendered in a small process pool with the Agg canvas directly (no pyplot, so no
+# global figure registry and no global rcParams changes), whenever a pair's ring version
+# changes. The web side only ever gets the latest finished PNG, or a placeholder.
+# Workers are started from a fork server (RENDER_START_METHOD), not forked from the observatory
+# itself, which has stream and scheduler threads running whose locks a fork could copy held.
+# Like with spawn, they import the main script again as __mp_main__, so scripts that start
+# a renderer need their startup behind a __main__ check.
+# The renderer also keeps the whole matrix as one sprite image of small thumbnails, so a page
+# view needs a single image request instead of one per cell: each cell is shaded by the pair's
+# mean latency with a sparkline of its latest samples on top, drawn straight into a numpy
+# array from the ring data. The sprite is rendered in the pool too, at most once per
+# SPRITE_MIN_INTERVAL, and only if some ring moved on since the last one.
+
+import io
+import os
+import time
+import logging
+import threading
+import functools
+import multiprocessing
+import concurrent.futures
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import matplotlib
+import matplotlib.dates as mdates
+import matplotlib.image as mpimg
+
+# Settings
+PLOT_COLOR = "white"
+PLOT_SIZE = (3.5, 3.5)
+PLOT_DPI = 100
+RENDER_WORKERS = 2
+RENDER_POLL_INTERVAL = 1
+RENDER_MIN_INTERVAL = 10
+RENDER_START_METHOD = "forkserver"
+THUMB_PIXELS = (80, 48)
+THUMB_COLORMAP = "plasma"
+THUMB_LATENCY_RANGE = (0.1, 10.0)
+THUMB_LINE_COLOR = (255, 255, 255, 255)
+SPRITE_MIN_INTERVAL = 30
+
+def style_axes(ax):
+    """
+    White on transparent, set per axes instead of through the global rcParams
+    """
+    ax.title.set_color(PLOT_COLOR)
+    ax.xaxis.label.set_color(PLOT_COLOR)
+    ax.yaxis.label.set_color(PLOT_COLOR)
+    ax.tick_params(colors = PLOT_COLOR, which = "both")
+    for spine in ax.spines.values():
+        spine.set_edgecolor(PLOT_COLOR)
+
+def figure_png(fig):
+    buf = io.BytesIO()
+    FigureCanvasAgg(fig)
+    fig.savefig(buf, format = "png", transparent = True)
+    return buf.getvalue()
+
+def encode_png(image):
+    buf = io.BytesIO()
+    mpimg.imsave(buf, image, format = "png")
+    return buf.getvalue()
+
+def to_datetime64(timestamps):
+    return (np.asarray(timestamps) * 1000000).astype("datetime64[us]")
+
+def render_plot(source_instance, target_instance, latencies, timestamps, mean):
+    """
+    Render one pair's latency plot to PNG bytes. Runs in the pool, so arguments are plain data.
+    """
+    data_x = to_datetime64(timestamps)
+    data_y = np.asarray(latencies) * 1000
+
+    fig = Figure(figsize = PLOT_SIZE, dpi = PLOT_DPI)
+    ax = fig.add_subplot(111)
+    ax.plot(data_x, data_y, marker = "o", color = PLOT_COLOR)
+    ax.set_title("{} ->\n{}\nMean[50]: {}ms".format(source_instance, target_instance, str(round(mean * 1000, 2))))
+    ax.set_xlabel("Time")
+    ax.set_ylabel("Latency [ms]")
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%b%d\n%H:%M'))
+    if len(data_x) > 1 and data_x[0] != data_x[-1]:
+        ax.set_xticks(to_datetime64(np.linspace(timestamps[0], timestamps[-1], 5)))
+        ax.set_xlim(data_x[0], data_x[-1])
+    style_axes(ax)
+    fig.tight_layout()
+    return figure_png(fig)
+
+def render_thumbnail(latencies, mean):
+    """
+    One matrix cell as an RGBA uint8 array: shaded by mean latency (log scale over
+    THUMB_LATENCY_RANGE), with a sparkline of the latest latencies, one per pixel column
+    """
+    width, height = THUMB_PIXELS
+    low, high = np.log(THUMB_LATENCY_RANGE)
+    shade = min(max((np.log(max(mean, THUMB_LATENCY_RANGE[0])) - low) / (high - low), 0.0), 1.0)
+    cell = np.empty((height, width, 4), np.uint8)
+    cell[:] = np.round(np.asarray(matplotlib.colormaps[THUMB_COLORMAP](shade)) * 255).astype(np.uint8)
+
+    # Stretch the latest samples over the cell width, scaled to the largest one, and join
+    # neighbouring columns with vertical runs so steps stay visible
+    latencies = np.asarray(latencies)[-width:]
+    if len(latencies) == 0:
+        return cell
+    top = max(float(np.max(latencies)), THUMB_LATENCY_RANGE[0])
+    values = np.interp(np.arange(width), np.linspace(0, width - 1, len(latencies)), latencies)
+    rows = (height - 2) - np.round(values / top * (height - 3)).astype(int)
+    for column in range(width):
+        previous = rows[max(column - 1, 0)]
+        cell[min(previous, rows[column]):max(previous, rows[column]) + 1, column] = THUMB_LINE_COLOR
+    return cell
+
+def render_sprite(size, cells):
+    """
+    Render the matrix sprite to PNG bytes. cells are (row, column, latencies, mean), cells
+    not in there stay transparent. Runs in the pool, so arguments are plain data.
+    """
+    width, height = THUMB_PIXELS
+    canvas = np.zeros((size * height, size * width, 4), np.uint8)
+    for row, column, latencies, mean in cells:
+        canvas[row * height:(row + 1) * height, column * width:(column + 1) * width] = render_thumbnail(latencies, mean)
+    return encode_png(canvas)
+
+@functools.lru_cache(maxsize = None)
+def placeholder_png():
+    """
+    Served for pairs that have no finished plot yet
+    """
+    fig = Figure(figsize = PLOT_SIZE, dpi = PLOT_DPI)
+    fig.text(0.5, 0.5, "no data yet", color = PLOT_COLOR, ha = "center", va = "center")
+    return figure_png(fig)
+
+class PlotRenderer():
+    """
+    Keeps one PNG per account pair up to date with that pair's LatencyRing version
+    """
+    def __init__(self, accounts, latency_info, workers = RENDER_WORKERS):
+        self.accounts = accounts
+        self.latency_info = latency_info
+        self.workers = workers
+        self.pool = None
+        self.thread = None
+
+        # (version, png) per pair, swapped as a whole, so readers need no lock
+        self.plots = {}
+        self.in_flight = {}
+        self.last_render = {}
+        self.lock = threading.Lock()
+
+        # Matrix sprite: cell (row, column) shows the thumbnail for (accounts[column], accounts[row]),
+        # i.e. rows are senders and columns receivers, like the page table. Versions are the
+        # ring versions the current (or in flight) sprite was rendered from.
+        self.etag_prefix = os.urandom(4).hex()
+        self.sprite = None
+        self.sprite_serial = 0
+        self.sprite_versions = None
+        self.sprite_future = None
+        self.last_sprite = 0
+        self.sprite_lock = threading.Lock()
+
+    def pairs(self):
+        for account in self.accounts:
+            for account2 in self.accounts:
+                if account != account2:
+                    yield account, account2
+
+    def get(self, account, account2):
+        """
+        Latest finished PNG for a pair, or the placeholder. Never waits for rendering.
+        """
+        plot = self.plots.get((account, account2))
+        if plot is None:
+            return placeholder_png()
+        return plot[1]
+
+    def get_version(self, account, account2):
+        """
+        Ring version the current PNG for a pair was rendered from, or None
+        """
+        plot = self.plots.get((account, account2))
+        return None if plot is None else plot[0]
+
+    def rendered(self, pair, version, future):
+        with self.lock:
+            self.in_flight.pop(pair, None)
+        try:
+            png = future.result()
+        except Exception as e:
+            logging.warning("Rendering plot for " + str(pair) + " failed, reason was " + str(e))
+            return
+        with self.lock:
+            current = self.plots.get(pair)
+            if current is None or current[0] < version:
+                self.plots[pair] = (version, png)
+
+    def submit_stale(self):
+        """
+        Queue a render for every pair whose data moved on since its last render
+        """
+        now = time.time()
+        for pair in self.pairs():
+            ring = self.latency_info[pair[0]][pair[1]]
+            if ring.version == self.get_version(*pair) or len(ring) == 0:
+                continue
+            with self.lock:
+                if pair in self.in_flight or now - self.last_render.get(pair, 0) < RENDER_MIN_INTERVAL:
+                    continue
+                self.last_render[pair] = now
+                version, latencies, timestamps = ring.snapshot()
+                mean = np.mean(latencies[-ring.mean_over:])
+                future = self.pool.submit(render_plot, pair[0][1], pair[1][1], latencies, timestamps, mean)
+                self.in_flight[pair] = future
+            future.add_done_callback(functools.partial(self.rendered, pair, version))
+
+    def sprite_rendered(self, future):
+        try:
+            png = future.result()
+        except Exception as e:
+            logging.warning("Rendering matrix sprite failed, reason was " + str(e))
+            with self.sprite_lock:
+                self.sprite_future = None
+                self.sprite_versions = None
+            return
+        with self.sprite_lock:
+            self.sprite_future = None
+            self.sprite_serial += 1
+            self.sprite = (self.etag_prefix + "-" + str(self.sprite_serial), png)
+
+    def update_sprite(self, force = False):
+        """
+        Queue a render of the matrix sprite if any ring moved on since the last one, at most
+        once per SPRITE_MIN_INTERVAL unless force. Returns the future, or None if nothing was queued.
+        """
+        now = time.time()
+        with self.sprite_lock:
+            if self.sprite_future is not None or (not force and now - self.last_sprite < SPRITE_MIN_INTERVAL):
+                return None
+            versions = [ring.version for row in self.latency_info.values() for ring in row.values()]
+            if versions == self.sprite_versions:
+                return None
+            cells = []
+            for row, account in enumerate(self.accounts):
+                for column, account2 in enumerate(self.accounts):
+                    if row == column:
+                        continue
+                    ring = self.latency_info[account2][account]
+                    if len(ring) == 0:
+                        continue
+                    _, latencies, _ = ring.snapshot()
+                    cells.append((row, column, latencies[-THUMB_PIXELS[0]:], ring.mean()))
+            future = self.pool.submit(render_sprite, len(self.accounts), cells)
+            self.sprite_future = future
+            self.sprite_versions = versions
+            self.last_sprite = now
+        future.add_done_callback(self.sprite_rendered)
+        return future
+
+    def get_sprite(self):
+        """
+        Get (etag, PNG bytes) of the whole matrix. Prepared in the background, this only
+        renders in the request before the first one is done.
+        """
+        sprite = self.sprite
+        if sprite is None:
+            return (self.etag_prefix + "-0", render_sprite(len(self.accounts), []))
+        return sprite
+
+    def render_all(self):
+        """
+        Render every stale pair now and wait for it, regardless of RENDER_MIN_INTERVAL
+        """
+        self.last_render = {}
+        self.submit_stale()
+        while True:
+            with self.lock:
+                in_flight = list(self.in_flight.values())
+            if len(in_flight) == 0:
+                break
+            concurrent.futures.wait(in_flight)
+            time.sleep(0.01)
+        with self.sprite_lock:
+            future = self.sprite_future
+        if future is not None:
+            concurrent.futures.wait([future])
+        future = self.update_sprite(force = True)
+        if future is not None:
+            concurrent.futures.wait([future])
+            time.sleep(0.01)
+
+    def start_pool(self):
+        """
+        Start the render pool only, e.g. to render_all without background rendering
+        """
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers = self.workers, mp_context = multiprocessing.get_context(RENDER_START_METHOD))
+
+    def start(self):
+        self.start_pool()
+        def render_worker():
+            while True:
+                try:
+                    self.submit_stale()
+                    self.update_sprite()
+                except concurrent.futures.process.BrokenProcessPool:
+                    logging.warning("Plot render pool died, restarting it")
+                    self.start_pool()
+                    with self.lock:
+                        self.in_flight = {}
+                    with self.sprite_lock:
+                        self.sprite_future = None
+                        self.sprite_versions = None
+                except Exception as e:
+                    logging.warning("Plot render pass failed, reason was " + str(e))
+                time.sleep(RENDER_POLL_INTERVAL)
+        self.thread = threading.Thread(target = render_worker, daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait = True)
@@ -0,0 +1,230 @@
+# Probe scheduling for the latency observatory
+# All post / delete timers run as tasks on one asyncio event loop in a single thread, and the
+# blocking API calls go to a small thread pool, so the thread count doesn't grow with the
+# number of instances.
+#
+# Every (sender, receiver) pair has its own next due time, from an interval the watcher picks
+# per pair (short while a pair's latency is moving or missing, long while it is stable). A
+# sender posts at most once per post_interval, and that post mentions at most
+# MENTION_GROUP_SIZE of its due pairs: most overdue first, ties going round the sender's
+# mention_order from where its last post stopped, topped up with pairs that would be due soon
+# anyway. Pairs that don't fit wait for the next post, so with many instances the receivers
+# take turns and the posts per sender stay bounded no matter how many instances there are.
+# Only pairs probed faster than stable_post_interval can make a sender post sooner than once
+# per stable_post_interval: while everything is stable a sender posts once per
+# stable_post_interval whatever the number of instances, and its receivers share those posts.
+# Pair due times are not jittered (only post times are), so pairs that were probed together
+# and have settled at the same interval stay due together and keep sharing one post.
+#
+# Deletes are not done one timer per probe: probes are queued and deleted in periodic sweeps,
+# one executor job per account. The API has no batch delete, so every post still costs one
+# delete call; sweeps only save the per-probe timers and retry failed deletes. API calls are
+# saved by posting less.
+#
+# The due time bookkeeping takes the current time as an argument, so it can be driven in
+# simulated time too (see benchmark_replay).
+
+import time
+import random
+import asyncio
+import logging
+import threading
+import collections
+import concurrent.futures
+
+# Settings
+PROBE_WORKERS = 8
+MENTION_GROUP_SIZE = 8
+PROBE_JITTER = 0.1
+PROBE_COALESCE = 0.5
+PROBE_MIN_SLEEP = 5
+DELETE_SWEEP_INTERVAL = 60
+DELETE_MAX_ATTEMPTS = 5
+
+def mention_order(account, accounts):
+    """
+    The other accounts for one sender. Each sender starts at a different offset, so no
+    account gets mentioned by everyone at once.
+    """
+    others = [account2 for account2 in accounts if account2 != account]
+    if len(others) == 0:
+        return []
+    offset = accounts.index(account) % len(others)
+    return others[offset:] + others[:offset]
+
+class ProbeScheduler():
+    """
+    Runs probes for every account on one event loop. post(account, targets) posts a probe
+    and returns the status, delete(account, status) deletes it. pair_interval(account, account2)
+    gives the current time between probes from account to account2. Probes mention the other
+    accounts in targets, which defaults to accounts. Each account posts at most once per
+    post_interval, and only once per stable_post_interval (defaults to post_interval) while
+    none of its pairs due are probed faster than that.
+    """
+    def __init__(self, accounts, post, delete, pair_interval, time_before_delete, post_interval,
+                 workers = PROBE_WORKERS, clock = time.time, targets = None, stable_post_interval = None):
+        self.accounts = accounts
+        self.targets = accounts if targets is None else targets
+        self.post_interval = post_interval
+        self.stable_post_interval = post_interval if stable_post_interval is None else stable_post_interval
+        self.post = post
+        self.delete = delete
+        self.pair_interval = pair_interval
+        self.time_before_delete = time_before_delete
+        self.clock = clock
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = workers, thread_name_prefix = "probe")
+        self.loop = None
+        self.thread = None
+
+        # (account, "post" / "delete", "success" / "failure") -> count, only written on the loop thread
+        self.counters = collections.Counter()
+
+        # Spread the first probes over one interval
+        now = self.clock()
+        self.others = {}
+        self.next_due = {}
+        self.next_post = {}
+        self.next_stable_post = {}
+        self.rotation = {}
+        self.pending_deletes = {}
+        for account in self.accounts:
+            self.others[account] = mention_order(account, self.targets)
+            self.next_post[account] = now
+            self.next_stable_post[account] = now
+            self.rotation[account] = 0
+            self.pending_deletes[account] = []
+            for account2 in self.others[account]:
+                self.next_due[(account, account2)] = now + random.uniform(0, self.pair_interval(account, account2))
+
+    def jittered(self, seconds):
+        return seconds * random.uniform(1.0 - PROBE_JITTER, 1.0 + PROBE_JITTER)
+
+    def ready_at(self, account, account2, interval):
+        """
+        When the pair can make account post: its due time, but not before the next stable post
+        of account unless the pair is probed faster than stable_post_interval
+        """
+        due = self.next_due[(account, account2)]
+        if interval < self.stable_post_interval:
+            return due
+        return max(due, self.next_stable_post[account])
+
+    def next_targets(self, account, now):
+        """
+        Pick the accounts the next probe of account mentions, and schedule their next probe
+        """
+        if now < self.next_post[account]:
+            return []
+        others = self.others[account]
+        candidates = []
+        ready = False
+        for index, account2 in enumerate(others):
+            due = self.next_due[(account, account2)]
+            interval = self.pair_interval(account, account2)
+            if due <= now + PROBE_COALESCE * interval:
+                turn = (index - self.rotation[account]) % len(others)
+                candidates.append((due, turn, index, account2))
+                ready = ready or self.ready_at(account, account2, interval) <= now
+        if not ready:
+            return []
+        candidates.sort()
+
+        # Next post of this account picks up after the last one this one mentions
+        chosen = candidates[:MENTION_GROUP_SIZE]
+        self.rotation[account] = (max(chosen, key = lambda candidate: candidate[1])[2] + 1) % len(others)
+        self.next_post[account] = now + self.jittered(self.post_interval)
+        self.next_stable_post[account] = now + self.jittered(self.stable_post_interval)
+        targets = [account2 for _, _, _, account2 in chosen]
+        for account2 in targets:
+            self.next_due[(account, account2)] = now + self.pair_interval(account, account2)
+        return targets
+
+    def next_wakeup(self, account, now):
+        if len(self.others[account]) == 0:
+            return now + DELETE_SWEEP_INTERVAL
+        earliest = min(self.ready_at(account, account2, self.pair_interval(account, account2)) for account2 in self.others[account])
+        return max(now + PROBE_MIN_SLEEP, self.next_post[account], earliest)
+
+    def queue_delete(self, account, status, now):
+        self.pending_deletes[account].append((now + self.time_before_delete, 0, status))
+
+    def take_due_deletes(self, account, now):
+        """
+        Remove and return the queued deletes of account that are due, as (due, attempts, status)
+        """
+        pending = self.pending_deletes[account]
+        due = [entry for entry in pending if entry[0] <= now]
+        self.pending_deletes[account] = [entry for entry in pending if entry[0] > now]
+        return due
+
+    def delete_batch(self, account, entries):
+        """
+        Delete a batch of statuses (in the executor), return the entries that failed
+        """
+        failed = []
+        for entry in entries:
+            try:
+                self.delete(account, entry[2])
+            except Exception as e:
+                logging.warning("Status delete failed for " + str(account) + ", reason was " + str(e))
+                failed.append(entry)
+        return failed
+
+    def deletes_done(self, account, entries, failed):
+        """
+        Count a finished batch and requeue what failed, unless it failed too often
+        """
+        self.counters[(account, "delete", "success")] += len(entries) - len(failed)
+        self.counters[(account, "delete", "failure")] += len(failed)
+        for due, attempts, status in failed:
+            if attempts + 1 < DELETE_MAX_ATTEMPTS:
+                self.pending_deletes[account].append((due, attempts + 1, status))
+
+    async def probe_cycle(self, account):
+        while True:
+            now = self.clock()
+            await asyncio.sleep(max(0, self.next_wakeup(account, now) - now))
+            targets = self.next_targets(account, self.clock())
+            if len(targets) == 0:
+                continue
+            try:
+                logging.info("Attempting post for " + str(account) + " to " + str(len(targets)) + " accounts")
+                status = await self.loop.run_in_executor(self.executor, self.post, account, targets)
+                self.counters[(account, "post", "success")] += 1
+                self.queue_delete(account, status, self.clock())
+            except Exception as e:
+                self.counters[(account, "post", "failure")] += 1
+                logging.warning("Status post failed for " + str(account) + ", reason was " + str(e))
+
+    async def delete_sweep(self, account):
+        entries = self.take_due_deletes(account, self.clock())
+        if len(entries) == 0:
+            return
+        failed = await self.loop.run_in_executor(self.executor, self.delete_batch, account, entries)
+        self.deletes_done(account, entries, failed)
+
+    async def delete_sweeps(self):
+        while True:
+            await asyncio.sleep(DELETE_SWEEP_INTERVAL)
+            await asyncio.gather(*[self.delete_sweep(account) for account in self.accounts], return_exceptions = True)
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        for account in self.accounts:
+            self.loop.create_task(self.probe_cycle(account))
+        self.loop.create_task(self.delete_sweeps())
+        self.thread = threading.Thread(target = self.loop.run_forever, daemon = True, name = "probe-scheduler")
+        self.thread.start()
+
+    def stop(self):
+        if self.loop is not None:
+            async def cancel_probes():
+                tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions = True)
+            asyncio.run_coroutine_threadsafe(cancel_probes(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+        self.executor.shutdown(wait = False)
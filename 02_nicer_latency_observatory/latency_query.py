@@ -0,0 +1,78 @@
+# Range queries over a pair's latency history, at a bounded number of points
+# A query picks the coarsest data that still has about the resolution asked for: raw samples
+# from the store's raw ring, or slots of the hourly or daily rollup tier, whichever is the
+# finest one still covering the start of the range. That series is then downsampled to the
+# requested point count with largest-triangle-three-buckets (LTTB), which keeps spikes and
+# steps that averaging would flatten. Every source is a fixed size ring, so a query is bounded
+# by the store's capacity no matter how long the range is.
+
+import math
+
+import numpy as np
+
+from latency_store import TIERS
+
+# Settings
+QUERY_DEFAULT_POINTS = 500
+QUERY_MAX_POINTS = 5000
+QUERY_MIN_POINTS = 3
+
+def lttb(x, y, points):
+    """
+    Indices of the points largest-triangle-three-buckets keeps when downsampling (x, y) to points
+    """
+    n = len(x)
+    if points >= n:
+        return np.arange(n)
+    points = max(points, QUERY_MIN_POINTS)
+
+    # First and last point always stay, the rest is split into points - 2 buckets. Each bucket
+    # keeps the point spanning the largest triangle with the point kept before it and the mean
+    # of the next bucket.
+    every = (n - 2) / (points - 2)
+    selected = np.zeros(points, np.int64)
+    kept = 0
+    for i in range(points - 2):
+        start = int(math.floor(i * every)) + 1
+        end = int(math.floor((i + 1) * every)) + 1
+        next_end = min(int(math.floor((i + 2) * every)) + 1, n)
+        mean_x = np.mean(x[end:next_end])
+        mean_y = np.mean(y[end:next_end])
+        area = np.abs((x[kept] - mean_x) * (y[start:end] - y[kept]) - (x[kept] - x[start:end]) * (mean_y - y[kept]))
+        kept = start + int(np.argmax(area))
+        selected[i + 1] = kept
+    selected[-1] = n - 1
+    return selected
+
+def pick_resolution(series, start, end, points, now):
+    """
+    Finest of "raw", "1h", "1d" that still covers start and is not much finer than (end - start) / points
+    """
+    step = (end - start) / points
+    if step < TIERS["1h"][0] and series.raw_covers(start):
+        return "raw"
+    width, slots = TIERS["1h"]
+    if start >= now - width * slots and step < TIERS["1d"][0]:
+        return "1h"
+    return "1d"
+
+def query_series(series, start, end, now, points = QUERY_DEFAULT_POINTS):
+    """
+    History of one PairSeries in [start, end), at most points rows. Returns (resolution, columns, rows).
+    Raw rows are (timestamp, latency), rollup rows (start, mean, min, max, count).
+    """
+    points = min(max(QUERY_MIN_POINTS, points), QUERY_MAX_POINTS)
+    resolution = pick_resolution(series, start, end, points, now)
+    if resolution == "raw":
+        latencies, timestamps = series.get_raw_range(start, end)
+        columns = ["timestamp", "latency"]
+        data = [timestamps, latencies]
+    else:
+        slots = series.get_rollup(resolution, start, end)
+        columns = ["timestamp", "latency", "min", "max", "count"]
+        data = [slots["start"], slots["sum"] / np.maximum(slots["count"], 1), slots["min"], slots["max"], slots["count"]]
+
+    # Downsample on (time, latency), keep the other columns of the chosen rows
+    selected = lttb(data[0], data[1], points)
+    rows = [list(row) for row in zip(*[column[selected].tolist() for column in data])]
+    return resolution, columns, rows
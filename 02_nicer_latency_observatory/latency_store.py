@@ -0,0 +1,244 @@
+# Persistent latency time series store
+# One set of memory mapped files per account pair: a ring of raw (timestamp, latency) samples,
+# and hourly and daily rollup tiers (count, sum, min, max and a latency_histogram bucket
+# histogram for percentiles). Rollup slots are addressed by time, so each tier is a fixed size
+# ring too and disk use is bounded no matter how long the observatory runs. Opening is just
+# mmap, so startup does not depend on how much history there is. Pairs are only opened when
+# they are first written or have files already, so pairs that never get a sample cost nothing.
+# A sample older than what its rollup slot holds now only goes to the raw ring, it never
+# recycles a slot of a newer period.
+#
+# Every pair has exactly one writer (the stream thread of the receiving account), so appends
+# do not lock.
+
+import os
+import time
+import logging
+import threading
+
+import numpy as np
+
+from latency_histogram import HIST_BUCKETS, bucket_for, histogram_percentile
+
+# Settings
+STORE_DIR = os.environ.get("LATENCY_STORE_DIR", "latency_store")
+RAW_DEFAULT_CAPACITY = 30 * 24 * 12
+HOURLY_SLOTS = 90 * 24
+DAILY_SLOTS = 5 * 365
+FLUSH_INTERVAL = 60
+
+RAW_DTYPE = np.dtype([("timestamp", "f8"), ("latency", "f8")])
+ROLLUP_DTYPE = np.dtype([
+    ("start", "f8"),
+    ("count", "i8"),
+    ("sum", "f8"),
+    ("min", "f8"),
+    ("max", "f8"),
+    ("histogram", "u4", (HIST_BUCKETS,)),
+])
+HEADER_DTYPE = np.dtype("i8")
+HEADER_FIELDS = 3 # capacity, head, count
+HEADER_BYTES = HEADER_FIELDS * HEADER_DTYPE.itemsize
+
+TIERS = {
+    "1h": (60 * 60, HOURLY_SLOTS),
+    "1d": (24 * 60 * 60, DAILY_SLOTS),
+}
+
+def pair_key(account, account2):
+    return "{}@{}__{}@{}".format(account[0], account[1], account2[0], account2[1]).replace(os.sep, "_")
+
+def open_memmap(file_name, dtype, shape, offset = 0):
+    mode = "r+" if os.path.exists(file_name) else "w+"
+    return np.memmap(file_name, dtype = dtype, mode = mode, offset = offset, shape = shape)
+
+class PairSeries():
+    """
+    Raw samples and rollup tiers for one account pair
+    """
+    def __init__(self, base_name, raw_capacity):
+        # Raw ring, capacity comes from the file if it exists already
+        raw_file = base_name + ".raw"
+        if os.path.exists(raw_file):
+            stored_capacity = int(np.fromfile(raw_file, dtype = HEADER_DTYPE, count = 1)[0])
+            if stored_capacity != raw_capacity:
+                logging.info("Keeping raw capacity " + str(stored_capacity) + " of existing " + raw_file)
+            raw_capacity = stored_capacity
+        # Header and samples share one mapping of the raw file
+        raw_map = open_memmap(raw_file, np.uint8, (HEADER_BYTES + raw_capacity * RAW_DTYPE.itemsize,))
+        self.raw_map = raw_map
+        self.header = raw_map[:HEADER_BYTES].view(HEADER_DTYPE)
+        self.header[0] = raw_capacity
+        self.raw = raw_map[HEADER_BYTES:].view(RAW_DTYPE)
+
+        # Rollup tiers
+        self.rollups = {}
+        for tier, (width, slots) in TIERS.items():
+            self.rollups[tier] = open_memmap(base_name + "." + tier, ROLLUP_DTYPE, (slots,))
+
+        # Writes go through plain ndarray views of the same memory, per field, which is a lot
+        # cheaper per element than going through memmap / structured element access
+        self.capacity = raw_capacity
+        self.head = int(self.header[1])
+        self.count = int(self.header[2])
+        self.header_view = self.header.view(np.ndarray)
+        self.raw_timestamps = self.raw.view(np.ndarray)["timestamp"]
+        self.raw_latencies = self.raw.view(np.ndarray)["latency"]
+        self.columns = {}
+        for tier in TIERS:
+            rollup = self.rollups[tier].view(np.ndarray)
+            self.columns[tier] = {field: rollup[field] for field in ROLLUP_DTYPE.names}
+
+    def append(self, timestamp, latency):
+        # Raw sample first, then publish it by moving the head
+        self.raw_timestamps[self.head] = timestamp
+        self.raw_latencies[self.head] = latency
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self.header_view[1] = self.head
+        self.header_view[2] = self.count
+
+        # Fold into the rollup slot this sample belongs to, recycling the slot if it is from an
+        # older period, skipping it if it is already used by a newer one
+        bucket = bucket_for(latency)
+        for tier, (width, slots) in TIERS.items():
+            columns = self.columns[tier]
+            start = (timestamp // width) * width
+            slot = int(timestamp // width) % slots
+            if columns["count"][slot] != 0 and columns["start"][slot] > start:
+                continue
+            if columns["start"][slot] != start or columns["count"][slot] == 0:
+                columns["start"][slot] = start
+                columns["count"][slot] = 1
+                columns["sum"][slot] = latency
+                columns["min"][slot] = latency
+                columns["max"][slot] = latency
+                columns["histogram"][slot] = 0
+            else:
+                columns["count"][slot] += 1
+                columns["sum"][slot] += latency
+                if latency < columns["min"][slot]:
+                    columns["min"][slot] = latency
+                if latency > columns["max"][slot]:
+                    columns["max"][slot] = latency
+            columns["histogram"][slot, bucket] += 1
+
+    def get_raw(self, limit = None):
+        """
+        Get (latencies, timestamps) copies of the newest raw samples, oldest first
+        """
+        capacity, head, count = (int(value) for value in self.header)
+        if limit is not None:
+            count = min(count, limit)
+        indices = (np.arange(head - count, head)) % capacity
+        samples = self.raw[indices]
+        return samples["latency"].copy(), samples["timestamp"].copy()
+
+    def get_raw_range(self, start, end):
+        """
+        Get (latencies, timestamps) copies of the raw samples in [start, end), oldest first
+        """
+        latencies, timestamps = self.get_raw()
+        used = (timestamps >= start) & (timestamps < end)
+        return latencies[used], timestamps[used]
+
+    def raw_covers(self, start):
+        """
+        Whether the raw ring still has every sample from start on
+        """
+        capacity, head, count = (int(value) for value in self.header)
+        return count < capacity or self.raw_timestamps[(head - count) % capacity] <= start
+
+    def get_rollup(self, tier, start = None, end = None):
+        """
+        Get rollup slots of a tier in [start, end) ordered by time, as a structured array
+        """
+        rollup = self.rollups[tier]
+        used = rollup[rollup["count"] > 0]
+        if start is not None:
+            used = used[used["start"] >= start]
+        if end is not None:
+            used = used[used["start"] < end]
+        return np.sort(used, order = "start")
+
+    def flush(self):
+        self.raw_map.flush()
+        for rollup in self.rollups.values():
+            rollup.flush()
+
+def summarize_rollup(slots):
+    """
+    Turn rollup slots into plain dicts with min / mean / max and percentiles
+    """
+    summary = []
+    for slot in slots:
+        summary.append({
+            "start": float(slot["start"]),
+            "count": int(slot["count"]),
+            "min": float(slot["min"]),
+            "mean": float(slot["sum"] / slot["count"]),
+            "max": float(slot["max"]),
+            "p50": histogram_percentile(slot["histogram"], 50),
+            "p90": histogram_percentile(slot["histogram"], 90),
+            "p99": histogram_percentile(slot["histogram"], 99),
+        })
+    return summary
+
+class LatencyStore():
+    """
+    All pairs' series, opened on first use, flushed to disk every FLUSH_INTERVAL seconds
+    """
+    def __init__(self, store_dir = STORE_DIR, raw_capacity = RAW_DEFAULT_CAPACITY):
+        self.store_dir = store_dir
+        self.raw_capacity = raw_capacity
+        self.series = {}
+        self.lock = threading.Lock()
+        self.flush_thread = None
+        os.makedirs(self.store_dir, exist_ok = True)
+
+    def base_name(self, account, account2):
+        return os.path.join(self.store_dir, pair_key(account, account2))
+
+    def has_series(self, account, account2):
+        """
+        Whether a pair has been written to, now or in an earlier run
+        """
+        return (account, account2) in self.series or os.path.exists(self.base_name(account, account2) + ".raw")
+
+    def get_series(self, account, account2, create = True):
+        """
+        Get the PairSeries of a pair, opening it if needed. Without create, None for pairs
+        that were never written to instead of creating empty files for them.
+        """
+        series = self.series.get((account, account2))
+        if series is None:
+            if not create and not self.has_series(account, account2):
+                return None
+            with self.lock:
+                series = self.series.get((account, account2))
+                if series is None:
+                    series = PairSeries(self.base_name(account, account2), self.raw_capacity)
+                    self.series[(account, account2)] = series
+        return series
+
+    def append(self, account, account2, timestamp, latency):
+        self.get_series(account, account2).append(timestamp, latency)
+
+    def flush(self):
+        with self.lock:
+            all_series = list(self.series.values())
+        for series in all_series:
+            series.flush()
+
+    def start_flushing(self):
+        if self.flush_thread is not None:
+            return
+        def flush_worker():
+            while True:
+                time.sleep(FLUSH_INTERVAL)
+                try:
+                    self.flush()
+                except Exception as e:
+                    logging.warning("Flushing latency store failed, reason was " + str(e))
+        self.flush_thread = threading.Thread(target = flush_worker, daemon = True)
+        self.flush_thread.start()
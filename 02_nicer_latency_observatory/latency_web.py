@@ -1,19 +1,40 @@
 from flask import Flask, make_response, request
+import io
+import os
+import sys
+import csv
+import json
 import datetime
 
-from latencies import LatencyWatcher
+from latencies import LatencyWatcher, ACCOUNTS
+
+sys.path.append("../tooling/")
+from page_cache import PageCache
+from latency_plots import THUMB_PIXELS
+from latency_aggregate import AggregateStore, parse_account
+from latency_alerts import AlertDispatcher
+from latency_query import QUERY_DEFAULT_POINTS
+import latency_metrics
 
 # Settings
-accounts = [
-    ("halcy", "mastodon.social"),
-    ("halcy", "glitch.social"),
-    ("latencyobs", "icosahedron.website"),
-    #("latencyobs", "botsin.space"),
-    ("halcy", "hachyderm.io"),
-]
+accounts = ACCOUNTS
 
-watcher = LatencyWatcher(accounts)
-watcher.start()
+# With LATENCY_AGGREGATE_DB set, probing and listening is left to latency_node processes and
+# this only reads what they measured from the aggregate. Otherwise, do everything in here.
+# Plot render workers import this module again as __mp_main__ when it is run as a script
+# (see latency_plots), only the process serving the page runs a watcher.
+if __name__ != "__mp_main__":
+    if "LATENCY_AGGREGATE_DB" in os.environ:
+        watcher = LatencyWatcher(
+            accounts,
+            aggregate = AggregateStore(os.environ["LATENCY_AGGREGATE_DB"], "web"),
+            probe_accounts = [],
+            listen_accounts = [],
+            alerts = AlertDispatcher()
+        )
+    else:
+        watcher = LatencyWatcher(accounts, alerts = AlertDispatcher())
+    watcher.start()
 
 HEAD = """
 <html>
@@ -51,16 +72,28 @@ table tbody tr:nth-child(odd) {
 a {
     color: #FFFFFF;
 }
+.plot {
+    width: %dpx;
+    height: %dpx;
+    background-image: url(matrix.png);
+}
 </style>
 <h1>⟴ Mastodon Latency Observatory <span style="font-size:17px"><a href="https://github.com/halcy/MastodonpyExamples/tree/master/02_nicer_latency_observatory">on github</a></h1>
-"""
+<p><a href=".">mean latency</a> | percentiles over <a href="percentiles?hours=3">3h</a> <a href="percentiles?hours=24">24h</a> <a href="percentiles?hours=168">7d</a></p>
+""" % THUMB_PIXELS
 
 FOOT = """
 </body></html>
 """
+page_cache = PageCache()
+
 app = Flask(__name__)
 @app.route('/')
 def base_page():
+    # Only rendered again when a new sample came in
+    return page_cache.respond(request, "base", watcher.get_data_version(), render_base_page)
+
+def render_base_page():
     # Get info from watcher
     latency_info = watcher.get_latencies()
 
@@ -82,13 +115,97 @@ def base_page():
                 lat_date = datetime.datetime.fromtimestamp(latency_data[1])
                 lat_date_str = lat_date.astimezone(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S %Z')
                 alt_text = lat_str + " at " + lat_date_str
-                response += '<td><img src="plot?acc1={}&acc2={}" alt="{}"</td>'.format(str(id1), str(id2), alt_text)
+                response += '<td><a href="plot?acc1={}&acc2={}"><div class="plot" style="background-position: -{}px -{}px" title="{}"></div></a></td>'.format(
+                    str(id1), str(id2), str(id2 * THUMB_PIXELS[0]), str(id1 * THUMB_PIXELS[1]), alt_text
+                )
         response += "</tr>"
 
     # Foot
     response += "</table>"
     return HEAD + response + FOOT
 
+def ms_str(latency):
+    if latency is None:
+        return "-"
+    return str(round(latency * 1000, 2)) + "ms"
+
+@app.route('/percentiles', methods=['GET'])
+def percentile_page():
+    # Tail latencies from the merged per pair histograms
+    try:
+        hours = min(max(1, int(request.args.get("hours", 3))), 7 * 24)
+    except ValueError:
+        return make_response("hours must be a whole number", 400)
+    percentile_info = watcher.get_percentiles(hours * 60 * 60)
+
+    # Head
+    response = "<p>Latency percentiles over the last " + str(hours) + "h</p>"
+    response += "<table><tr><td></td>"
+    for account in accounts:
+        response += "<td>to " + account[1] + "</td>"
+    response += "</tr>"
+
+    # Rows
+    for account in accounts:
+        response += "<tr><td>from " + account[1] + "</td>"
+        for account2 in accounts:
+            if account == account2:
+                response += "<td></td>"
+            else:
+                summary = percentile_info[account2][account]
+                response += "<td>p50 {}<br/>p90 {}<br/>p99 {}<br/>max {}<br/>n = {}</td>".format(
+                    ms_str(summary["p50"]), ms_str(summary["p90"]), ms_str(summary["p99"]), ms_str(summary["max"]), str(summary["count"])
+                )
+        response += "</tr>"
+
+    # Foot
+    response += "</table>"
+    return HEAD + response + FOOT
+
+@app.route('/metrics', methods=['GET'])
+def send_metrics():
+    resp = make_response(watcher.get_metrics())
+    resp.headers['Content-Type'] = latency_metrics.CONTENT_TYPE
+    return resp
+
+@app.route('/query', methods=['GET'])
+def send_query():
+    # History of one pair, downsampled to about points rows, as JSON or CSV
+    args = request.args
+    try:
+        account = parse_account(args["receiver"])
+        account2 = parse_account(args["sender"])
+        end = float(args.get("end", watcher.clock()))
+        start = float(args.get("start", end - 24 * 60 * 60))
+        points = int(args.get("points", QUERY_DEFAULT_POINTS))
+    except (KeyError, ValueError):
+        return make_response("Need receiver and sender (user@instance), optional start, end (unix time) and points", 400)
+    if not account in accounts or not account2 in accounts or account == account2:
+        return make_response("Unknown account pair", 404)
+    if not start < end:
+        return make_response("start must be before end", 400)
+
+    resolution, columns, rows = watcher.query_history(account, account2, start, end, points)
+    if args.get("format", "json") == "csv":
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        writer.writerows(rows)
+        resp = make_response(out.getvalue())
+        resp.headers['Content-Type'] = "text/csv; charset=utf-8"
+    else:
+        resp = make_response(json.dumps({
+            "receiver": args["receiver"],
+            "sender": args["sender"],
+            "start": start,
+            "end": end,
+            "resolution": resolution,
+            "columns": columns,
+            "rows": rows,
+        }))
+        resp.headers['Content-Type'] = "application/json"
+    return resp
+
 @app.route('/plot', methods=['GET'])
 def send_png():
     args = request.args
@@ -99,5 +216,15 @@ def send_png():
     resp.headers['Content-Type'] = "image/png"
     return resp
 
+@app.route('/matrix.png', methods=['GET'])
+def send_matrix_png():
+    # All thumbnails in one image, the page shows cells of it via background-position
+    etag, binary_data = watcher.get_latencies_matrix()
+    resp = make_response(binary_data)
+    resp.headers['Content-Type'] = "image/png"
+    resp.headers['Cache-Control'] = "no-cache"
+    resp.set_etag(etag)
+    return resp.make_conditional(request)
+
 if __name__ == '__main__':
     app.run("0.0.0.0")
@@ -7,8 +7,7 @@ import logging
 import threading
 import traceback
 
-from flask import Flask, session, render_template, redirect, request, abort, g
-import sqlite3
+from flask import Flask, session, render_template, redirect, request, abort
 
 import numpy as np
 import torch
@@ -19,6 +18,7 @@ from transformers import CLIPProcessor, CLIPModel
 sys.path.append("../tooling/")
 import secret_registry
 import app_data_registry
+import client_registry
 import validators
 
 from mastodon import Mastodon
@@ -48,31 +48,11 @@ clip_model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
 clip_processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
 
 # DB stuff
-def get_db():
-    # Connect to DB
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = sqlite3.connect(app_data_registry.get_db_file(APP_PREFIX))
-        db.row_factory = sqlite3.Row
-        g._database = db
-    return db
+db = app_data_registry.get_database(APP_PREFIX)
 
 def query_db(query, args=(), single = False):
-    with app.app_context():
-        # SQL query function
-        db =  get_db()
-        cursor = db.execute(query, args)
-        data = cursor.fetchall()
-        cursor.close()
-        db.commit()
-        return (data[0] if data else None) if single else data
-
-@app.teardown_appcontext
-def close_connection(exception):
-    # Close DB connection on teardown
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+    # SQL query function
+    return db.query(query, args, single)
 
 # Set up the DB initially, if empty
 table_exists = query_db("SELECT name FROM sqlite_master WHERE type='table' AND name='users'", single = True) is not None
@@ -101,16 +81,17 @@ if not table_exists:
 
 # User insert / update / delete
 def db_insert_user(account):
-    query = """
-    INSERT OR IGNORE INTO users (account, last_update, embed1, embed2, embed3)
-    VALUES (?, 0, "", "", "")
-    """
-    query_db(query, (account,))
-    query = """
-    INSERT OR IGNORE INTO suggestions (account, suggestions, mode)
-    VALUES (?, "", "show")
-    """
-    query_db(query, (account,))
+    with db.transaction():
+        query = """
+        INSERT OR IGNORE INTO users (account, last_update, embed1, embed2, embed3)
+        VALUES (?, 0, "", "", "")
+        """
+        query_db(query, (account,))
+        query = """
+        INSERT OR IGNORE INTO suggestions (account, suggestions, mode)
+        VALUES (?, "", "show")
+        """
+        query_db(query, (account,))
 
 def db_update_user(account, embed1, embed2, embed3, reset=False):
     query = """
@@ -127,10 +108,11 @@ def db_update_user(account, embed1, embed2, embed3, reset=False):
     query_db(query, (update_time, embed1, embed2, embed3, account))
 
 def db_delete_user(account):
-    query = "DELETE FROM users WHERE account = ?"
-    query_db(query, (account,))
-    query = "DELETE FROM suggestions WHERE account = ?"
-    query_db(query, (account,))
+    with db.transaction():
+        query = "DELETE FROM users WHERE account = ?"
+        query_db(query, (account,))
+        query = "DELETE FROM suggestions WHERE account = ?"
+        query_db(query, (account,))
 
 def db_update_suggestions(account, suggestions):
     query = """
@@ -242,6 +224,11 @@ def get_clustered_clip_encodings(text_list):
             clusters = clustering.centroids.cpu().numpy()
         return clusters
 
+# Client credentials, registering the app with new instances as needed
+client_credentials = client_registry.ClientCredentialResolver(
+    CLIENT_NAME, APP_PREFIX, MASTO_SECRET, SCOPES_TO_REQUEST, redirect_uris = [OAUTH_TARGET_URL]
+)
+
 def get_client_credential(instance):
     # Try to be permissive
     if "://" in instance:
@@ -255,28 +242,7 @@ def get_client_credential(instance):
     if not validators.url(instance):
         abort(500)
 
-    # Lock credential DB
-    secret_registry.lock_credentials()
-
-    try:
-        # Get app credential, register new if needed
-        client_credential = secret_registry.get_name_for(APP_PREFIX, MASTO_SECRET, instance, "client")
-        if not secret_registry.have_credential(client_credential):
-            Mastodon.create_app(
-                CLIENT_NAME,
-                api_base_url = instance,
-                scopes = SCOPES_TO_REQUEST,
-                to_file = client_credential,
-                redirect_uris = [OAUTH_TARGET_URL]
-            )
-            secret_registry.update_meta_time(client_credential)
-    except:
-        client_credential = None
-
-    # Unlock credential DB
-    secret_registry.release_credentials()
-
-    return client_credential
+    return client_credentials.resolve(instance)[0]
 
 # User updater code
 def insecure_strip_html(html):
@@ -456,7 +422,7 @@ def revoke():
         instance = instance.split("/")[0]
 
     # Lock credential DB
-    secret_registry.lock_credentials()
+    secret_registry.lock_credentials(APP_PREFIX, instance)
 
     # Revoke token
     try:
@@ -502,7 +468,7 @@ def auth():
     api = Mastodon(client_id = client_credential)
 
     # Lock credential DB
-    secret_registry.lock_credentials()
+    secret_registry.lock_credentials(APP_PREFIX, instance)
 
     # Log in
     try:
@@ -6,12 +6,12 @@ import logging
 import threading
 import traceback
 
-from flask import Flask, session, render_template, redirect, request, abort, g
-import sqlite3
+from flask import Flask, session, render_template, redirect, request, abort
 
 sys.path.append("../tooling/")
 import secret_registry
 import app_data_registry
+import client_registry
 import validators
 
 from mastodon import Mastodon, streaming
@@ -36,31 +36,11 @@ app = Flask(__name__)
 app_data_registry.set_flask_session_info(app, APP_PREFIX, True)
 
 # DB stuff
-def get_db():
-    # Connect to DB
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = sqlite3.connect(app_data_registry.get_db_file(APP_PREFIX))
-        db.row_factory = sqlite3.Row
-        g._database = db
-    return db
+db = app_data_registry.get_database(APP_PREFIX)
 
 def query_db(query, args=(), single = False):
-    with app.app_context():
-        # SQL query function
-        db =  get_db()
-        cursor = db.execute(query, args)
-        data = cursor.fetchall()
-        cursor.close()
-        db.commit()
-        return (data[0] if data else None) if single else data
-
-@app.teardown_appcontext
-def close_connection(exception):
-    # Close DB connection on teardown
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+    # SQL query function
+    return db.query(query, args, single)
 
 # Set up the DB initially, if empty
 table_exists = query_db("SELECT name FROM sqlite_master WHERE type='table' AND name='posts'", single = True) is not None
@@ -85,27 +65,28 @@ def db_update_post(account, other_account, post):
     post_json = json.dumps(post, default=str)
     other_account = other_account.lower()
 
-    # Check if a post exists that would match here
-    query = """
-    SELECT post FROM posts 
-    WHERE account = ? AND other_account = ?
-    """
-    post_exists = query_db(query, (account, other_account), single = True) is not None
-
-    # Insert or update, depending
-    if not post_exists:
-        query = """
-        INSERT INTO posts (account, other_account, post, post_id)
-        VALUES (?, ?, ?, ?)
-        """
-        query_db(query, (account, other_account, post_json, post.id))
-    else:
+    with db.transaction():
+        # Check if a post exists that would match here
         query = """
-        UPDATE posts
-        SET post = ?, post_id = ?
+        SELECT post FROM posts 
         WHERE account = ? AND other_account = ?
         """
-        query_db(query, (post_json, post.id, account, other_account))
+        post_exists = query_db(query, (account, other_account), single = True) is not None
+
+        # Insert or update, depending
+        if not post_exists:
+            query = """
+            INSERT INTO posts (account, other_account, post, post_id)
+            VALUES (?, ?, ?, ?)
+            """
+            query_db(query, (account, other_account, post_json, post.id))
+        else:
+            query = """
+            UPDATE posts
+            SET post = ?, post_id = ?
+            WHERE account = ? AND other_account = ?
+            """
+            query_db(query, (post_json, post.id, account, other_account))
 
 # Get current posts from DB
 def db_get_posts(account):
@@ -171,33 +152,14 @@ def log_off_session():
     except:
         pass
 
+# Client credentials, registering the app with new instances as needed
+client_credentials = client_registry.ClientCredentialResolver(
+    CLIENT_NAME, APP_PREFIX, MASTO_SECRET, SCOPES_TO_REQUEST, redirect_uris = [OAUTH_TARGET_URL]
+)
+
 # Gets a client credential, creates app if needed
 def get_client_credential(instance):
-    # For registry, add https://
-    instance = "https://" + instance
-
-    # Lock credential DB
-    secret_registry.lock_credentials()
-
-    try:
-        # Get app credential, register new if needed
-        client_credential = secret_registry.get_name_for(APP_PREFIX, MASTO_SECRET, instance, "client")
-        if not secret_registry.have_credential(client_credential):
-            Mastodon.create_app(
-                CLIENT_NAME,
-                api_base_url = instance,
-                scopes = SCOPES_TO_REQUEST,
-                to_file = client_credential,
-                redirect_uris = [OAUTH_TARGET_URL]
-            )
-            secret_registry.update_meta_time(client_credential)
-    except:
-        client_credential = None
-
-    # Unlock credential DB
-    secret_registry.release_credentials()
-
-    return client_credential
+    return client_credentials.resolve(instance)[0]
 
 # Background processing
 def post_to_db_resilient(account, post):
@@ -224,8 +186,8 @@ def refresh_worker():
                         # Get login
                         logging.info("Starting stream for " + account)
                         user_name, instance = account.split("@")
-                        user_credential = secret_registry.get_name_for(APP_PREFIX, MASTO_SECRET, instance, "user", user_name)
-                        api = Mastodon(access_token = user_credential, request_timeout = 10)
+                        user_login = secret_registry.get_login(APP_PREFIX, MASTO_SECRET, instance, "user", user_name)
+                        api = Mastodon(**user_login, request_timeout = 10)
 
                         # Stream
                         listener = streaming.CallbackStreamListener(
@@ -274,11 +236,12 @@ def index():
         # If there are no posts in DB: Get posts, insert
         posts = db_get_posts(account)
         if len(posts) == 0:
-            user_credential = secret_registry.get_name_for(APP_PREFIX, MASTO_SECRET, instance, "user", user_name)
-            api = Mastodon(access_token = user_credential, request_timeout = 10)
+            user_login = secret_registry.get_login(APP_PREFIX, MASTO_SECRET, instance, "user", user_name)
+            api = Mastodon(**user_login, request_timeout = 10)
             posts_new = api.timeline_home()
-            for post_new in posts_new:
-                db_update_post(account, post_new.account.acct, post_new)
+            with db.transaction():
+                for post_new in posts_new:
+                    db_update_post(account, post_new.account.acct, post_new)
             posts = db_get_posts(account)
 
         # Render
@@ -296,8 +259,8 @@ def post_status():
     # Send post
     post_text = request.form['text']
     try:
-        user_credential = secret_registry.get_name_for(APP_PREFIX, MASTO_SECRET, instance, "user", user_name)
-        api = Mastodon(access_token = user_credential, request_timeout = 10)
+        user_login = secret_registry.get_login(APP_PREFIX, MASTO_SECRET, instance, "user", user_name)
+        api = Mastodon(**user_login, request_timeout = 10)
         api.status_post(post_text)
     except:
         pass
@@ -316,8 +279,8 @@ def reply():
 
     # Send reply
     try:
-        user_credential = secret_registry.get_name_for(APP_PREFIX, MASTO_SECRET, instance, "user", user_name)
-        api = Mastodon(access_token = user_credential, request_timeout = 10)
+        user_login = secret_registry.get_login(APP_PREFIX, MASTO_SECRET, instance, "user", user_name)
+        api = Mastodon(**user_login, request_timeout = 10)
         reply_to_post = api.status(reply_to)
         api.status_reply(reply_to_post, reply_text)
     except:
@@ -332,7 +295,7 @@ def revoke():
     user_name, instance, account = get_session_user()
 
     # Lock credential DB
-    secret_registry.lock_credentials()
+    secret_registry.lock_credentials(APP_PREFIX, instance)
 
     # Revoke token
     try:
@@ -370,7 +333,7 @@ def auth():
     api = Mastodon(client_id = client_credential)
 
     # Lock credential DB
-    secret_registry.lock_credentials()
+    secret_registry.lock_credentials(APP_PREFIX, instance)
 
     # Log in
     try:
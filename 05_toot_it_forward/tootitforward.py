@@ -6,13 +6,13 @@ import logging
 import traceback
 import uuid
 import pickle
+import threading
 
-from flask import Flask, session, render_template, redirect, request, abort, g
-import sqlite3
+from flask import Flask, session, render_template, redirect, request, abort
 
 sys.path.append("../tooling/")
-import secret_registry
 import app_data_registry
+import client_registry
 import validators
 
 from mastodon import Mastodon, streaming
@@ -23,6 +23,7 @@ APP_PREFIX = "day05_tootitforward_r1"
 MASTO_SECRET = os.environ["MASTODON_SECRET"]
 SCOPES_TO_REQUEST = ["read:accounts", "read:statuses", "write:statuses"]
 SCOPES_FALLBACK = ["read", "write"]
+ABANDONED_AFTER = 60 * 60 * 24
 OAUTH_TARGET_URL = "https://mastolab.kal-tsit.halcy.de/day05/auth"
 APP_BASE_URL = "/day05/"
 
@@ -37,48 +38,52 @@ logging.basicConfig(
 app = Flask(__name__)
 app_data_registry.set_flask_session_info(app, APP_PREFIX, True)
 
+# Logins that were started but never finished get dropped when the state is compacted
+def is_abandoned(register, key, value):
+    if register == "meta" or key == state_meta["current_post_uuid"]:
+        return False
+    if register == "post_register" and value[0] is not None:
+        return False
+    try:
+        started = (uuid.UUID(key).time - 0x01b21dd213814000) / 10000000
+    except:
+        return False
+    return started < time.time() - ABANDONED_AFTER
+
 # Globals
-state_file = app_data_registry.get_state_file(APP_PREFIX)
-if os.path.exists(state_file):
-    with open(state_file, 'rb') as f:
-        post_register, instance_register, current_post_uuid = pickle.load(f)
-else:
-    post_register = {
-        "initial": ("halcy@icosahedron.website", "First post!", {
-            "acct": "halcy@icosahedron.website",
-            "display_name": "halcy",  
-            "avatar": "https://icosahedron.website/system/accounts/avatars/000/000/001/original/media.jpg"
-        })
-    }
-    instance_register = {}
-    current_post_uuid = "initial"
+state = app_data_registry.JournaledState(APP_PREFIX, drop = is_abandoned)
+forward_lock = threading.Lock()
+post_register = state.register("post_register")
+instance_register = state.register("instance_register")
+state_meta = state.register("meta")
+if not "current_post_uuid" in state_meta:
+    # Import old pickled state, if there is any
+    legacy_state_file = app_data_registry.get_state_file(APP_PREFIX)
+    if os.path.exists(legacy_state_file):
+        with open(legacy_state_file, 'rb') as f:
+            legacy_posts, legacy_instances, legacy_current = pickle.load(f)
+    else:
+        legacy_posts = {
+            "initial": ("halcy@icosahedron.website", "First post!", {
+                "acct": "halcy@icosahedron.website",
+                "display_name": "halcy",  
+                "avatar": "https://icosahedron.website/system/accounts/avatars/000/000/001/original/media.jpg"
+            })
+        }
+        legacy_instances = {}
+        legacy_current = "initial"
+    state.update(
+        [("set", "post_register", key, value) for key, value in legacy_posts.items()] +
+        [("set", "instance_register", key, value) for key, value in legacy_instances.items()] +
+        [("set", "meta", "current_post_uuid", legacy_current)]
+    )
 
 # DB stuff
-def get_db():
-    # Connect to DB
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = sqlite3.connect(app_data_registry.get_db_file(APP_PREFIX))
-        db.row_factory = sqlite3.Row
-        g._database = db
-    return db
+db = app_data_registry.get_database(APP_PREFIX)
 
 def query_db(query, args=(), single = False):
-    with app.app_context():
-        # SQL query function
-        db =  get_db()
-        cursor = db.execute(query, args)
-        data = cursor.fetchall()
-        cursor.close()
-        db.commit()
-        return (data[0] if data else None) if single else data
-
-@app.teardown_appcontext
-def close_connection(exception):
-    # Close DB connection on teardown
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+    # SQL query function
+    return db.query(query, args, single)
 
 # Set up the DB initially, if empty
 table_exists = query_db("SELECT name FROM sqlite_master WHERE type='table' AND name='posts'", single = True) is not None
@@ -130,45 +135,15 @@ def norm_instance_url(instance):
         abort(500)
     return instance
 
+# Client credentials, registering the app with new instances as needed
+client_credentials = client_registry.ClientCredentialResolver(
+    CLIENT_NAME, APP_PREFIX, MASTO_SECRET, SCOPES_TO_REQUEST,
+    redirect_uris = [OAUTH_TARGET_URL], fallback_scopes = SCOPES_FALLBACK
+)
+
 # Gets a client credential, creates app if needed
 def get_client_credential(instance):
-    # For registry, add https://
-    instance = "https://" + instance
-
-    # Lock credential DB
-    secret_registry.lock_credentials()
-
-    fallback_scopes = False
-    try:
-        # Get app credential, register new if needed
-        client_credential = secret_registry.get_name_for(APP_PREFIX, MASTO_SECRET, instance, "client")
-        if not secret_registry.have_credential(client_credential):
-            try:
-                Mastodon.create_app(
-                    CLIENT_NAME,
-                    api_base_url = instance,
-                    scopes = SCOPES_TO_REQUEST,
-                    to_file = client_credential,
-                    redirect_uris = [OAUTH_TARGET_URL]
-                )
-            except:
-                # Special akkoma fallback
-                Mastodon.create_app(
-                    CLIENT_NAME,
-                    api_base_url = instance,
-                    scopes = SCOPES_FALLBACK,
-                    to_file = client_credential,
-                    redirect_uris = [OAUTH_TARGET_URL]
-                )
-                fallback_scopes = True
-            secret_registry.update_meta_time(client_credential)
-    except:
-        client_credential = None
-
-    # Unlock credential DB
-    secret_registry.release_credentials()
-
-    return client_credential, fallback_scopes
+    return client_credentials.resolve(instance)
 
 def process_emoji(text, emojis):
     for emoji in emojis:
@@ -186,25 +161,16 @@ def index():
 
 @app.route('/auth')
 def auth():
-    # Global vars
-    global post_register
-    global instance_register
-    global current_post_uuid
-    global state_file
-
     # Get the oauth code
     uuid_str = request.args.get('state')
     oauth_code = request.args.get('code')
     instance = norm_instance_url(instance_register[uuid_str])
-    del instance_register[uuid_str]
+    state.delete("instance_register", uuid_str)
 
     # Get client credential and create API
     client_credential, _ = get_client_credential(instance)
     api = Mastodon(client_id = client_credential)
 
-    # Lock credential DB (we also use this lock for everything else)
-    secret_registry.lock_credentials()
-
     # Log in
     try:
         # Authenticate
@@ -223,17 +189,21 @@ def auth():
             )
         account = api.me().acct
 
-        # Send the post
-        current_post_user, current_post, current_post_account = post_register[current_post_uuid]
-        post = api.status_post(current_post)
-        post["account"]["acct"] += instance
-        del post_register[current_post_uuid]
-        post_register[uuid_str] = (account, post_register[uuid_str][1], post.account)
-        current_post_uuid = uuid_str
-        
-        # Dump state
-        with open(state_file, 'wb') as f:
-            pickle.dump((post_register, instance_register, current_post_uuid), f)
+        # Send the post and make ours the current one, one login at a time, so that
+        # every post gets forwarded exactly once. The user token is never stored, so
+        # there is nothing to lock in the credential registry.
+        with forward_lock:
+            current_post_uuid = state_meta["current_post_uuid"]
+            current_post_user, current_post, current_post_account = post_register[current_post_uuid]
+            post = api.status_post(current_post)
+            post["account"]["acct"] += instance
+
+            # Journal state change
+            state.update([
+                ("delete", "post_register", current_post_uuid),
+                ("set", "post_register", uuid_str, (account, post_register[uuid_str][1], post.account)),
+                ("set", "meta", "current_post_uuid", uuid_str),
+            ])
 
         # Store in DB
         post["post_from"] = current_post_account
@@ -245,9 +215,6 @@ def auth():
         # Error handling (showing the user that something went wrong) is future work
         logging.warning("Auth error" + str(e))
 
-    # Unlock credential DB
-    secret_registry.release_credentials()
-
     return redirect(APP_BASE_URL)
 
 @app.route('/login', methods=['POST'])
@@ -285,8 +252,10 @@ def login():
             )
 
         # Store data
-        post_register[uuid_str] = (None, new_post)
-        instance_register[uuid_str] = instance
+        state.update([
+            ("set", "post_register", uuid_str, (None, new_post)),
+            ("set", "instance_register", uuid_str, instance),
+        ])
 
         # Redirect the user to the OAuth login URL
         return redirect(login_url)
@@ -11,6 +11,7 @@ from flask import Flask, session, render_template, redirect, request, abort, g
 sys.path.append("../tooling/")
 import secret_registry
 import app_data_registry
+import client_registry
 import validators
 
 from mastodon import Mastodon, streaming
@@ -67,33 +68,14 @@ def log_off_session():
     except:
         pass
 
+# Client credentials, registering the app with new instances as needed
+client_credentials = client_registry.ClientCredentialResolver(
+    CLIENT_NAME, APP_PREFIX, MASTO_SECRET, SCOPES_TO_REQUEST, redirect_uris = [OAUTH_TARGET_URL]
+)
+
 # Gets a client credential, creates app if needed
 def get_client_credential(instance):
-    # For registry, add https://
-    instance = "https://" + instance
-
-    # Lock credential DB
-    secret_registry.lock_credentials()
-
-    try:
-        # Get app credential, register new if needed
-        client_credential = secret_registry.get_name_for(APP_PREFIX, MASTO_SECRET, instance, "client")
-        if not secret_registry.have_credential(client_credential):
-            Mastodon.create_app(
-                CLIENT_NAME,
-                api_base_url = instance,
-                scopes = SCOPES_TO_REQUEST,
-                to_file = client_credential,
-                redirect_uris = [OAUTH_TARGET_URL]
-            )
-            secret_registry.update_meta_time(client_credential)
-    except:
-        client_credential = None
-
-    # Unlock credential DB
-    secret_registry.release_credentials()
-
-    return client_credential
+    return client_credentials.resolve(instance)[0]
 
 def process_emoji(text, emojis):
     for emoji in emojis:
@@ -129,8 +111,8 @@ def index():
         since_id = request.args.get('since_id')
         max_id = request.args.get('max_id')
 
-        user_credential = secret_registry.get_name_for(APP_PREFIX, MASTO_SECRET, instance, "user", user_name)
-        api = Mastodon(access_token = user_credential, request_timeout = 10)
+        user_login = secret_registry.get_login(APP_PREFIX, MASTO_SECRET, instance, "user", user_name)
+        api = Mastodon(**user_login, request_timeout = 10)
         posts = api.timeline_home(
             limit = 40,
             since_id = since_id,
@@ -152,8 +134,8 @@ def post_status():
     # Send post
     post_text = request.form['text']
     try:
-        user_credential = secret_registry.get_name_for(APP_PREFIX, MASTO_SECRET, instance, "user", user_name)
-        api = Mastodon(access_token = user_credential, request_timeout = 10)
+        user_login = secret_registry.get_login(APP_PREFIX, MASTO_SECRET, instance, "user", user_name)
+        api = Mastodon(**user_login, request_timeout = 10)
         api.status_post(post_text)
     except:
         pass
@@ -172,8 +154,8 @@ def reply():
 
     # Send reply
     try:
-        user_credential = secret_registry.get_name_for(APP_PREFIX, MASTO_SECRET, instance, "user", user_name)
-        api = Mastodon(access_token = user_credential, request_timeout = 10)
+        user_login = secret_registry.get_login(APP_PREFIX, MASTO_SECRET, instance, "user", user_name)
+        api = Mastodon(**user_login, request_timeout = 10)
         reply_to_post = api.status(reply_to)
         api.status_reply(reply_to_post, reply_text)
     except:
@@ -192,8 +174,8 @@ def boost():
 
     # Send reply
     try:
-        user_credential = secret_registry.get_name_for(APP_PREFIX, MASTO_SECRET, instance, "user", user_name)
-        api = Mastodon(access_token = user_credential, request_timeout = 10)
+        user_login = secret_registry.get_login(APP_PREFIX, MASTO_SECRET, instance, "user", user_name)
+        api = Mastodon(**user_login, request_timeout = 10)
         api.status_reblog(which)
     except:
         pass
@@ -211,8 +193,8 @@ def unboost():
 
     # Send reply
     try:
-        user_credential = secret_registry.get_name_for(APP_PREFIX, MASTO_SECRET, instance, "user", user_name)
-        api = Mastodon(access_token = user_credential, request_timeout = 10)
+        user_login = secret_registry.get_login(APP_PREFIX, MASTO_SECRET, instance, "user", user_name)
+        api = Mastodon(**user_login, request_timeout = 10)
         api.status_unreblog(which)
     except:
         pass
@@ -230,8 +212,8 @@ def fav():
 
     # Send reply
     try:
-        user_credential = secret_registry.get_name_for(APP_PREFIX, MASTO_SECRET, instance, "user", user_name)
-        api = Mastodon(access_token = user_credential, request_timeout = 10)
+        user_login = secret_registry.get_login(APP_PREFIX, MASTO_SECRET, instance, "user", user_name)
+        api = Mastodon(**user_login, request_timeout = 10)
         api.status_favourite(which)
     except:
         pass
@@ -249,8 +231,8 @@ def unfav():
 
     # Send reply
     try:
-        user_credential = secret_registry.get_name_for(APP_PREFIX, MASTO_SECRET, instance, "user", user_name)
-        api = Mastodon(access_token = user_credential, request_timeout = 10)
+        user_login = secret_registry.get_login(APP_PREFIX, MASTO_SECRET, instance, "user", user_name)
+        api = Mastodon(**user_login, request_timeout = 10)
         api.status_unfavourite(which)
     except:
         pass
@@ -264,7 +246,7 @@ def revoke():
     user_name, instance, account = get_session_user()
 
     # Lock credential DB
-    secret_registry.lock_credentials()
+    secret_registry.lock_credentials(APP_PREFIX, instance)
 
     # Revoke token
     try:
@@ -293,7 +275,7 @@ def auth():
     api = Mastodon(client_id = client_credential)
 
     # Lock credential DB
-    secret_registry.lock_credentials()
+    secret_registry.lock_credentials(APP_PREFIX, instance)
 
     # Log in
     try:
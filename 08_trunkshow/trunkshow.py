@@ -6,8 +6,8 @@ import logging
 from flask import Flask, session, render_template, redirect, request, abort
 
 sys.path.append("../tooling/")
-import secret_registry
 import app_data_registry
+import client_registry
 import validators
 
 from mastodon import Mastodon
@@ -41,32 +41,10 @@ def norm_instance_url(instance):
         abort(500)
     return instance
 
-# Gets a client credential, creates app if needed
-def get_client_credential(instance):
-    # For registry, add https://
-    instance = "https://" + instance
-
-    # Lock credential DB
-    secret_registry.lock_credentials()
-
-    try:
-        # Get app credential, register new if needed
-        client_credential = secret_registry.get_name_for(APP_PREFIX, MASTO_SECRET, instance, "client")
-        if not secret_registry.have_credential(client_credential):
-            Mastodon.create_app(
-                CLIENT_NAME,
-                api_base_url = instance,
-                scopes = SCOPES_TO_REQUEST,
-                to_file = client_credential,
-            )
-            secret_registry.update_meta_time(client_credential)
-    except:
-        client_credential = None
-
-    # Unlock credential DB
-    secret_registry.release_credentials()
-
-    return client_credential
+# Client credentials, registering the app with new instances as needed
+client_credentials = client_registry.ClientCredentialResolver(
+    CLIENT_NAME, APP_PREFIX, MASTO_SECRET, SCOPES_TO_REQUEST
+)
 
 @app.route('/')
 def index():
@@ -86,7 +64,7 @@ def index():
 def posts():
     # Get api
     instance = session["instance"]
-    api = Mastodon(client_id = get_client_credential(instance))
+    api = Mastodon(**client_credentials.get_login(instance))
     
     # Get posts
     what = session["what"]
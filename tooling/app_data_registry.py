@@ -1,23 +1,59 @@
 import secret_registry
 import os
+import time
+import zlib
+import struct
+import pickle
+import sqlite3
+import threading
+import contextlib
+
+# Database settings
+DB_STATEMENT_CACHE_SIZE = 256
+DB_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=30000",
+]
 
 appdata_dir = os.path.abspath(secret_registry.db_path) + "/appdata/"
 if not os.path.exists(appdata_dir):
     os.makedirs(appdata_dir)
 
-def set_flask_session_info(app, app_prefix, prefix_secret = False):
+def set_flask_session_info(app, app_prefix, prefix_secret = False, session_backend = None):
     """
     Set up a flask session with a certain session dir, and set the secret to a value read from env variables
+
+    session_backend can be "filesystem" (the default, unless MASTODON_SESSION_BACKEND says otherwise) or
+    "sqlite", which keeps sessions for all apps in one shared database with expiry
     """
-    session_dir = appdata_dir + "session_" + app_prefix
-    if not os.path.exists(session_dir):
-        os.makedirs(session_dir)
     if prefix_secret == True:
         app.secret_key = app_prefix + os.environ["FLASK_SECRET"]
     else:
         app.secret_key = os.environ["FLASK_SECRET"]
-    app.config["SESSION_TYPE"] = "filesystem"
-    app.config["SESSION_FILE_DIR"] = session_dir
+
+    if session_backend is None:
+        session_backend = os.environ.get("MASTODON_SESSION_BACKEND", "filesystem")
+    if session_backend == "sqlite":
+        import session_store
+        app.session_interface = session_store.get_session_interface(get_session_db_file(), app_prefix)
+    elif session_backend == "filesystem":
+        session_dir = appdata_dir + "session_" + app_prefix
+        if not os.path.exists(session_dir):
+            os.makedirs(session_dir)
+        app.config["SESSION_TYPE"] = "filesystem"
+        app.config["SESSION_FILE_DIR"] = session_dir
+    else:
+        raise Exception("Unknown session backend " + session_backend)
+
+def get_session_db_file():
+    """
+    Return the file name for the session database shared by all apps
+    """
+    return appdata_dir + "sessions.db"
     
 def get_db_file(app_prefix):
     """
@@ -25,8 +61,209 @@ def get_db_file(app_prefix):
     """
     return appdata_dir + "db_" + app_prefix + ".db"
 
+class AppDatabase():
+    """
+    SQLite database for an app: one connection per thread, kept open and reused,
+    in WAL mode with a prepared statement cache. Writes commit right away unless
+    they are made inside transaction(), reads never commit.
+    """
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.local = threading.local()
+        self.timing_hooks = []
+
+    def get_connection(self):
+        """
+        Get this threads connection, opening it if needed
+        """
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.db_file, timeout = 30, cached_statements = DB_STATEMENT_CACHE_SIZE)
+            db.row_factory = sqlite3.Row
+            for pragma in DB_PRAGMAS:
+                db.execute(pragma)
+            self.local.db = db
+            self.local.transaction_depth = 0
+        return db
+
+    def query(self, query, args = (), single = False):
+        """
+        Run a query, return all rows, or the first row (or None) if single is set
+        """
+        db = self.get_connection()
+        time_start = time.perf_counter()
+        cursor = db.execute(query, args)
+        data = cursor.fetchall()
+        cursor.close()
+        if self.local.transaction_depth == 0 and db.in_transaction:
+            db.commit()
+        if len(self.timing_hooks) != 0:
+            elapsed = time.perf_counter() - time_start
+            for hook in self.timing_hooks:
+                hook(query, args, elapsed)
+        return (data[0] if data else None) if single else data
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Batch all queries in the block into one transaction, rolled back on exception. Nests.
+        """
+        db = self.get_connection()
+        self.local.transaction_depth += 1
+        try:
+            yield self
+            if self.local.transaction_depth == 1:
+                db.commit()
+        except:
+            if self.local.transaction_depth == 1:
+                db.rollback()
+            raise
+        finally:
+            self.local.transaction_depth -= 1
+
+    def add_timing_hook(self, hook):
+        """
+        Call hook(query, args, seconds) after every query
+        """
+        self.timing_hooks.append(hook)
+
+databases = {}
+databases_lock = threading.Lock()
+
+def get_database(app_prefix):
+    """
+    Return the shared database object for an app
+    """
+    with databases_lock:
+        if not app_prefix in databases:
+            databases[app_prefix] = AppDatabase(get_db_file(app_prefix))
+        return databases[app_prefix]
+
 def get_state_file(app_prefix):
     """
-    Return a file name for a database file
+    Return a file name for a state pickle (superseded by JournaledState)
     """
     return appdata_dir + "state_" + app_prefix + ".pkl"
+
+class JournaledState():
+    """
+    App state as a set of named dicts ("registers"), persisted as a snapshot plus an
+    append-only journal of changes. Every change is one small checksummed record, so
+    a write costs O(change) instead of re-pickling everything. Loading replays the
+    journal over the snapshot up to the first torn record. Once the journal has more
+    than compact_after records it is folded into a new snapshot, dropping every entry
+    for which drop(register, key, value) is true.
+    """
+    RECORD_HEADER = struct.Struct("<II")
+
+    def __init__(self, app_prefix, compact_after = 10000, drop = None):
+        self.snapshot_file = appdata_dir + "state_" + app_prefix + ".snapshot"
+        self.journal_file = appdata_dir + "state_" + app_prefix + ".journal"
+        self.compact_after = compact_after
+        self.drop = drop
+        self.lock = threading.RLock()
+        self.registers = {}
+        self.generation = 0
+        self.journal_records = 0
+        self.load()
+
+    def load(self):
+        # Snapshot first
+        if os.path.exists(self.snapshot_file):
+            with open(self.snapshot_file, 'rb') as f:
+                self.generation, self.registers = pickle.load(f)
+
+        # Then replay the journal, if it belongs to this snapshot
+        valid_length = 0
+        if os.path.exists(self.journal_file):
+            with open(self.journal_file, 'rb') as f:
+                journal = f.read()
+            records = self.read_records(journal)
+            if len(records) != 0 and records[0][1] == ("generation", self.generation):
+                for _, changes in records[1:]:
+                    self.apply_changes(changes)
+                valid_length = records[-1][0]
+                self.journal_records = len(records) - 1
+
+        # Cut off anything torn or stale and continue appending
+        if valid_length == 0:
+            self.start_journal()
+        else:
+            self.journal = open(self.journal_file, 'r+b')
+            self.journal.truncate(valid_length)
+            self.journal.seek(valid_length)
+
+    def read_records(self, journal):
+        # Returns a list of (end offset, record), stops at the first broken one
+        records = []
+        offset = 0
+        while offset + self.RECORD_HEADER.size <= len(journal):
+            length, checksum = self.RECORD_HEADER.unpack_from(journal, offset)
+            data = journal[offset + self.RECORD_HEADER.size:offset + self.RECORD_HEADER.size + length]
+            if len(data) != length or zlib.crc32(data) != checksum:
+                break
+            offset += self.RECORD_HEADER.size + length
+            records.append((offset, pickle.loads(data)))
+        return records
+
+    def write_record(self, record):
+        data = pickle.dumps(record, protocol = pickle.HIGHEST_PROTOCOL)
+        self.journal.write(self.RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data)
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def start_journal(self):
+        self.journal = open(self.journal_file, 'wb')
+        self.write_record(("generation", self.generation))
+        self.journal_records = 0
+
+    def apply_changes(self, changes):
+        for change in changes:
+            register = self.registers.setdefault(change[1], {})
+            if change[0] == "set":
+                register[change[2]] = change[3]
+            else:
+                register.pop(change[2], None)
+
+    def register(self, name):
+        """
+        Get a register (a plain dict, do not modify it directly, use set / delete / update)
+        """
+        with self.lock:
+            return self.registers.setdefault(name, {})
+
+    def update(self, changes):
+        """
+        Atomically apply a list of ("set", register, key, value) / ("delete", register, key) changes
+        """
+        with self.lock:
+            self.write_record(changes)
+            self.apply_changes(changes)
+            self.journal_records += 1
+            if self.journal_records > self.compact_after:
+                self.compact()
+
+    def set(self, register, key, value):
+        self.update([("set", register, key, value)])
+
+    def delete(self, register, key):
+        self.update([("delete", register, key)])
+
+    def compact(self):
+        """
+        Write a new snapshot and start an empty journal
+        """
+        with self.lock:
+            if self.drop is not None:
+                for name, register in self.registers.items():
+                    for key in [key for key, value in register.items() if self.drop(name, key, value)]:
+                        del register[key]
+            self.generation += 1
+            temp_file = self.snapshot_file + ".tmp"
+            with open(temp_file, 'wb') as f:
+                pickle.dump((self.generation, self.registers), f, protocol = pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_file, self.snapshot_file)
+            self.journal.close()
+            self.start_journal()
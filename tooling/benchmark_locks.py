@@ -0,0 +1,55 @@
+# Lock contention benchmark for secret_registry
+# Runs several processes that each repeatedly take the credential lock and hold it for a while
+# (like a slow Mastodon.create_app would), once with the global lock and once with the sharded
+# lock, and prints how long it took.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import multiprocessing
+
+# Never touch real secrets
+os.environ["MASTODON_SECRETS_DIR"] = tempfile.mkdtemp(prefix = "benchmark_locks_")
+if not "MASTODON_GLOBAL_SECRET" in os.environ:
+    os.environ["MASTODON_GLOBAL_SECRET"] = "benchmark"
+import secret_registry
+
+# Settings
+PROCESSES = 8
+ITERATIONS = 20
+HOLD_TIME = 0.01
+
+def contend(worker, sharded, start_event):
+    instance = "https://instance" + str(worker) + ".example"
+    start_event.wait()
+    for _ in range(ITERATIONS):
+        if sharded:
+            secret_registry.lock_credentials("benchmark", instance)
+        else:
+            secret_registry.lock_credentials()
+        time.sleep(HOLD_TIME)
+        secret_registry.release_credentials()
+
+def run(sharded):
+    start_event = multiprocessing.Event()
+    workers = [multiprocessing.Process(target = contend, args = (worker, sharded, start_event)) for worker in range(PROCESSES)]
+    for worker in workers:
+        worker.start()
+    time_start = time.time()
+    start_event.set()
+    for worker in workers:
+        worker.join()
+    return time.time() - time_start
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        PROCESSES = int(sys.argv[1])
+    time_global = run(False)
+    time_sharded = run(True)
+    print("{} processes x {} lock acquisitions, {}s hold time".format(PROCESSES, ITERATIONS, HOLD_TIME))
+    print("Global lock:  {:.3f}s".format(time_global))
+    print("Sharded lock: {:.3f}s".format(time_sharded))
+    print("Speedup:      {:.2f}x".format(time_global / time_sharded))
+    shutil.rmtree(os.environ["MASTODON_SECRETS_DIR"])
@@ -0,0 +1,222 @@
+# Benchmark suite for secret_registry
+# Generates synthetic secrets directories of several sizes and measures latency distributions
+# and throughput of the registry operations, including multi-process lock contention. Mastodon
+# is replaced by a stub, so no network is needed. Results are written as JSON, so that runs can
+# be compared against each other.
+#
+# Usage: python benchmark_registry.py [output.json] [size ...]
+# e.g.   python benchmark_registry.py results.json 10000 100000 1000000
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+
+# Settings
+DEFAULT_SIZES = [10000, 100000]
+PREFIXES = ["day03_clippy", "day04_alphant", "day06_mastomash", "day07_florps"]
+INSTANCES = 200
+SAMPLES = 2000
+MOVES = 500
+REVOKE_FRACTION = 0.01
+LOCK_PROCESSES = 8
+LOCK_ITERATIONS = 200
+SPREAD_SECONDS = 30 * 24 * 60 * 60
+
+def stats(latencies, elapsed = None):
+    """
+    Latency distribution (in milliseconds) and throughput for a list of latencies in seconds
+    """
+    latencies = sorted(latencies)
+    count = len(latencies)
+    if elapsed is None:
+        elapsed = sum(latencies)
+    def percentile(p):
+        return latencies[min(count - 1, int(p / 100.0 * count))] * 1000.0
+    return {
+        "count": count,
+        "mean_ms": sum(latencies) / count * 1000.0,
+        "p50_ms": percentile(50),
+        "p90_ms": percentile(90),
+        "p99_ms": percentile(99),
+        "max_ms": latencies[-1] * 1000.0,
+        "ops_per_sec": count / elapsed if elapsed > 0 else None,
+    }
+
+def timed(function, args_list):
+    """
+    Call function once per argument tuple, return per-call latencies and total time
+    """
+    latencies = []
+    time_start = time.perf_counter()
+    for args in args_list:
+        call_start = time.perf_counter()
+        function(*args)
+        latencies.append(time.perf_counter() - call_start)
+    return latencies, time.perf_counter() - time_start
+
+class StubMastodon():
+    """
+    Stand-in for Mastodon that accepts any credential and revokes instantly
+    """
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def revoke_access_token(self):
+        pass
+
+def generate(secret_registry, size):
+    """
+    Write a synthetic secrets directory with size user credentials, return their keys
+    """
+    now = time.time()
+    keys = []
+    for i in range(size):
+        prefix = random.choice(PREFIXES)
+        instance = "https://instance" + str(random.randrange(INSTANCES)) + ".example"
+        user = "user" + str(i)
+        name = secret_registry.get_name_for(prefix, "benchmark", instance, "user", user)
+        with open(name, 'w') as f:
+            f.write("token" + str(i) + "\n" + instance + "\nclient_id\nclient_secret\n")
+        with open(name + "_meta.secret", 'w') as f:
+            f.write(str(now - random.random() * SPREAD_SECONDS))
+        keys.append((prefix, instance, user))
+    return keys
+
+def lock_worker(sharded, worker, start_event, result_queue):
+    import secret_registry
+    instance = "https://instance" + str(worker) + ".example"
+    latencies = []
+    start_event.wait()
+    for _ in range(LOCK_ITERATIONS):
+        call_start = time.perf_counter()
+        if sharded:
+            secret_registry.lock_credentials(PREFIXES[0], instance)
+        else:
+            secret_registry.lock_credentials()
+        latencies.append(time.perf_counter() - call_start)
+        time.sleep(0.0005)
+        secret_registry.release_credentials()
+    result_queue.put(latencies)
+
+def lock_contention(sharded):
+    start_event = multiprocessing.Event()
+    result_queue = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target = lock_worker, args = (sharded, worker, start_event, result_queue))
+        for worker in range(LOCK_PROCESSES)
+    ]
+    for worker in workers:
+        worker.start()
+    time_start = time.perf_counter()
+    start_event.set()
+    latencies = []
+    for _ in workers:
+        latencies += result_queue.get()
+    for worker in workers:
+        worker.join()
+    return stats(latencies, time.perf_counter() - time_start)
+
+def run_size(size):
+    """
+    Run all benchmarks against one directory size, in this process
+    """
+    import secret_registry
+    secret_registry.Mastodon = StubMastodon
+    results = {"size": size}
+
+    time_start = time.perf_counter()
+    keys = generate(secret_registry, size)
+    results["generate_seconds"] = time.perf_counter() - time_start
+
+    time_start = time.perf_counter()
+    secret_registry.rebuild_catalog()
+    results["rebuild_catalog_seconds"] = time.perf_counter() - time_start
+
+    sample = random.sample(keys, min(SAMPLES, len(keys)))
+    names = [secret_registry.get_name_for(prefix, "benchmark", instance, "user", user) for prefix, instance, user in sample]
+
+    latencies, elapsed = timed(secret_registry.get_name_for, [(prefix, "benchmark", instance, "user", user) for prefix, instance, user in sample])
+    results["get_name_for"] = stats(latencies, elapsed)
+
+    latencies, elapsed = timed(secret_registry.have_credential, [(name,) for name in names])
+    results["have_credential_hit"] = stats(latencies, elapsed)
+
+    missing = [secret_registry.get_name_for(PREFIXES[0], "benchmark", "https://missing.example", "user", "missing" + str(i)) for i in range(len(names))]
+    latencies, elapsed = timed(secret_registry.have_credential, [(name,) for name in missing])
+    results["have_credential_miss"] = stats(latencies, elapsed)
+
+    args = [(prefix, "benchmark", instance, "user", user) for prefix, instance, user in sample]
+    timed(secret_registry.get_credential, args)
+    latencies, elapsed = timed(secret_registry.get_credential, args)
+    results["get_credential_cached"] = stats(latencies, elapsed)
+
+    latencies, elapsed = timed(secret_registry.update_meta_time, [(name,) for name in names[:MOVES]])
+    results["update_meta_time"] = stats(latencies, elapsed)
+
+    moves = []
+    for i, (prefix, instance, user) in enumerate(sample[:MOVES]):
+        moves.append((names[i], secret_registry.get_name_for(prefix, "benchmark", instance, "user", user + "_moved")))
+    latencies, elapsed = timed(secret_registry.move_credential, moves)
+    results["move_credential"] = stats(latencies, elapsed)
+
+    def lock_release(*args):
+        secret_registry.lock_credentials(*args)
+        secret_registry.release_credentials()
+    latencies, elapsed = timed(lock_release, [()] * SAMPLES)
+    results["lock_release_global"] = stats(latencies, elapsed)
+    latencies, elapsed = timed(lock_release, [(prefix, instance) for prefix, instance, _ in sample])
+    results["lock_release_sharded"] = stats(latencies, elapsed)
+
+    # Revoke the oldest slice of one prefix, sequentially and concurrently
+    when = time.time() - SPREAD_SECONDS * (1.0 - REVOKE_FRACTION)
+    for workers in [1, 16]:
+        time_start = time.perf_counter()
+        summary = secret_registry.revoke_all_older_than(PREFIXES[workers % len(PREFIXES)], "user", when, workers)
+        elapsed = time.perf_counter() - time_start
+        results["revoke_all_older_than_workers_" + str(workers)] = {
+            "revoked": summary["revoked"],
+            "seconds": elapsed,
+            "per_credential_ms": elapsed / max(1, summary["total"]) * 1000.0,
+        }
+
+    results["lock_contention_global"] = lock_contention(False)
+    results["lock_contention_sharded"] = lock_contention(True)
+    return results
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--run-size":
+        # Child: secrets dir and global secret come in through the environment
+        print(json.dumps(run_size(int(sys.argv[2]))))
+        sys.exit()
+
+    output_file = sys.argv[1] if len(sys.argv) > 1 else "benchmark_registry.json"
+    sizes = [int(size) for size in sys.argv[2:]] or DEFAULT_SIZES
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+        "sizes": [],
+    }
+    for size in sizes:
+        # One fresh directory and process per size, secret_registry picks its directory on import
+        secrets_dir = tempfile.mkdtemp(prefix = "benchmark_registry_")
+        env = dict(os.environ, MASTODON_SECRETS_DIR = secrets_dir, MASTODON_GLOBAL_SECRET = "benchmark")
+        try:
+            print("Benchmarking " + str(size) + " credentials...")
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--run-size", str(size)],
+                env = env, check = True, stdout = subprocess.PIPE, cwd = os.path.dirname(os.path.abspath(__file__))
+            ).stdout
+            results["sizes"].append(json.loads(output.decode("utf-8").strip().split("\n")[-1]))
+        finally:
+            shutil.rmtree(secrets_dir)
+    with open(output_file, 'w') as f:
+        json.dump(results, f, indent = 4)
+    print("Wrote " + output_file)
@@ -0,0 +1,132 @@
+# Session backend benchmark
+# Compares the filesystem session backend (one pickle file per session, like Flask-Session's
+# filesystem mode) against the shared SQLite session store, at 100k sessions by default:
+# read / write latency, expiry sweep and listing time.
+#
+# Usage: python benchmark_sessions.py [sessions] [output.json]
+
+import os
+import sys
+import json
+import time
+import random
+import pickle
+import shutil
+import hashlib
+import secrets
+import tempfile
+
+import session_store
+from benchmark_registry import stats, timed
+
+# Settings
+DEFAULT_SESSIONS = 100000
+SAMPLES = 5000
+TTL = 30 * 24 * 60 * 60
+EXPIRED_FRACTION = 0.1
+
+def session_data(i):
+    return {"logged_in": True, "user_name": "user" + str(i), "instance": "instance" + str(i % 200) + ".example"}
+
+class FilesystemSessions():
+    """
+    One pickle file per session, named by the hash of the session id
+    """
+    def __init__(self, session_dir):
+        self.session_dir = session_dir
+
+    def file_for(self, sid):
+        return os.path.join(self.session_dir, hashlib.md5(sid.encode("utf-8")).hexdigest())
+
+    def set(self, sid, data, ttl):
+        with open(self.file_for(sid), 'wb') as f:
+            pickle.dump((time.time() + ttl, data), f)
+
+    def get(self, sid):
+        try:
+            with open(self.file_for(sid), 'rb') as f:
+                expires, data = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        return data if expires > time.time() else None
+
+    def compact(self):
+        evicted = 0
+        for name in os.listdir(self.session_dir):
+            path = os.path.join(self.session_dir, name)
+            with open(path, 'rb') as f:
+                expires, _ = pickle.load(f)
+            if expires <= time.time():
+                os.remove(path)
+                evicted += 1
+        return evicted
+
+    def count(self):
+        return len(os.listdir(self.session_dir))
+
+class SqliteSessions():
+    """
+    Adapter for the shared store, in one namespace
+    """
+    def __init__(self, db_file):
+        self.store = session_store.SessionStore(db_file)
+
+    def set(self, sid, data, ttl):
+        self.store.set("benchmark", sid, data, ttl)
+
+    def get(self, sid):
+        return self.store.get("benchmark", sid)
+
+    def compact(self):
+        return self.store.compact()
+
+    def count(self):
+        return self.store.get_db().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+def benchmark(backend, count):
+    """
+    Fill a backend with count sessions, a fraction of them already expired, and measure it
+    """
+    sids = [secrets.token_urlsafe(32) for _ in range(count)]
+    results = {}
+
+    args = [(sids[i], session_data(i), -1 if i < count * EXPIRED_FRACTION else TTL) for i in range(count)]
+    latencies, elapsed = timed(backend.set, args)
+    results["write"] = stats(latencies, elapsed)
+
+    sample = random.sample(sids, min(SAMPLES, count))
+    latencies, elapsed = timed(backend.get, [(sid,) for sid in sample])
+    results["read"] = stats(latencies, elapsed)
+
+    time_start = time.perf_counter()
+    backend.count()
+    results["count_seconds"] = time.perf_counter() - time_start
+
+    time_start = time.perf_counter()
+    results["evicted"] = backend.compact()
+    results["compact_seconds"] = time.perf_counter() - time_start
+    return results
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SESSIONS
+    work_dir = tempfile.mkdtemp(prefix = "benchmark_sessions_")
+    try:
+        os.makedirs(os.path.join(work_dir, "sessions"))
+        results = {
+            "sessions": count,
+            "filesystem": benchmark(FilesystemSessions(os.path.join(work_dir, "sessions")), count),
+            "sqlite": benchmark(SqliteSessions(os.path.join(work_dir, "sessions.db")), count),
+        }
+    finally:
+        shutil.rmtree(work_dir)
+
+    for backend in ["filesystem", "sqlite"]:
+        print("{:<11} write p50 {:.3f}ms p99 {:.3f}ms | read p50 {:.3f}ms p99 {:.3f}ms | count {:.3f}s | compact {:.3f}s".format(
+            backend,
+            results[backend]["write"]["p50_ms"], results[backend]["write"]["p99_ms"],
+            results[backend]["read"]["p50_ms"], results[backend]["read"]["p99_ms"],
+            results[backend]["count_seconds"], results[backend]["compact_seconds"]
+        ))
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], 'w') as f:
+            json.dump(results, f, indent = 4)
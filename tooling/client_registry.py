@@ -0,0 +1,125 @@
+# Shared client credential resolution for the apps
+# Client credentials come from secret_registry's in-process credential cache, so the common
+# case does not lock or touch the filesystem. Registering the app with a new instance is
+# single-flight: concurrent first logins for the same instance wait for one create_app call.
+# Failed registrations are remembered for a while, so a dead instance isn't asked again and again.
+
+import os
+import time
+import logging
+import threading
+
+import secret_registry
+
+from mastodon import Mastodon
+
+# Settings
+FAILURE_TTL = 5 * 60
+
+class ClientCredentialResolver():
+    def __init__(self, client_name, app_prefix, secret, scopes, redirect_uris = None, fallback_scopes = None):
+        # Store parameters
+        self.client_name = client_name
+        self.app_prefix = app_prefix
+        self.secret = secret
+        self.scopes = scopes
+        self.redirect_uris = redirect_uris
+        self.fallback_scopes = fallback_scopes
+
+        # Registration state
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.failed_until = {}
+        self.used_fallback = {}
+
+    def normalize(self, instance):
+        # For registry, add https://
+        if not instance.startswith("http://") and not instance.startswith("https://"):
+            instance = "https://" + instance
+        return instance
+
+    def register(self, instance, client_credential):
+        """
+        Register the app with an instance, unless another process beat us to it
+        """
+        # Lock credential DB, only for this instance
+        secret_registry.lock_credentials(self.app_prefix, instance)
+
+        try:
+            if not secret_registry.have_credential(client_credential):
+                try:
+                    Mastodon.create_app(
+                        self.client_name,
+                        api_base_url = instance,
+                        scopes = self.scopes,
+                        to_file = client_credential,
+                        redirect_uris = self.redirect_uris
+                    )
+                except:
+                    if self.fallback_scopes is None:
+                        raise
+
+                    # Special akkoma fallback
+                    Mastodon.create_app(
+                        self.client_name,
+                        api_base_url = instance,
+                        scopes = self.fallback_scopes,
+                        to_file = client_credential,
+                        redirect_uris = self.redirect_uris
+                    )
+                    self.used_fallback[instance] = True
+                secret_registry.update_meta_time(client_credential)
+
+            # Registration that leaves no credential behind is a failure too, retrying right away would not help
+            if not os.path.isfile(client_credential):
+                raise Exception("no client credential was written")
+        except Exception as e:
+            logging.warning("Could not register app with " + instance + ": " + str(e))
+            with self.lock:
+                self.failed_until[instance] = time.time() + FAILURE_TTL
+
+        # Unlock credential DB
+        secret_registry.release_credentials()
+
+    def resolve(self, instance):
+        """
+        Get (client credential, whether fallback scopes were used), registering the app if
+        needed. The credential is None if the app could not be registered.
+        """
+        instance = self.normalize(instance)
+        while True:
+            try:
+                client_credential, login = secret_registry.get_credential(self.app_prefix, self.secret, instance, "client")
+            except:
+                return None, False
+            if login is not None:
+                return client_credential, self.used_fallback.get(instance, False)
+
+            # Not registered yet: either we register, or we wait for whoever is already doing it
+            with self.lock:
+                if self.failed_until.get(instance, 0) > time.time():
+                    return None, False
+                registration_done = self.in_flight.get(instance)
+                leader = registration_done is None
+                if leader:
+                    registration_done = threading.Event()
+                    self.in_flight[instance] = registration_done
+
+            if leader:
+                try:
+                    self.register(instance, client_credential)
+                finally:
+                    with self.lock:
+                        del self.in_flight[instance]
+                    registration_done.set()
+            else:
+                registration_done.wait()
+
+    def get_login(self, instance):
+        """
+        Get keyword arguments to create a Mastodon API object with the client credential for an instance
+        """
+        client_credential, _ = self.resolve(instance)
+        if client_credential is None:
+            return {"client_id": None}
+        return secret_registry.get_login(self.app_prefix, self.secret, self.normalize(instance), "client")
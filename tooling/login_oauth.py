@@ -1,15 +1,23 @@
 # Basic login example
 # Not at all performant, but simple
+# There is also a batch mode, for provisioning many accounts at once: it takes a JSON manifest
+# of [{"instance": ..., "account": ...}, ...] and optionally a JSON file mapping "account@instance"
+# to {"code": ...} or {"token": ...}, registers missing apps concurrently and writes a JSON report.
+# Accounts without code or token get their OAuth URL in the report, so codes can be collected
+# and the batch run again.
 
 import secret_registry
 import webbrowser
 import time
 import sys
+import json
+import concurrent.futures
 from mastodon import Mastodon
 
 # Usage printer
-if len(sys.argv) != 4:
+if not len(sys.argv) in [4, 6, 7, 8] or (len(sys.argv) > 4 and sys.argv[4] != "--batch"):
     print("Usage: " + sys.argv[0] + " <client name> <credential prefix> <secret>")
+    print("       " + sys.argv[0] + " <client name> <credential prefix> <secret> --batch <manifest> [codes file] [report file]")
     sys.exit()
     
 # Settings
@@ -17,53 +25,156 @@ SCOPES_TO_REQUEST = ['read', 'write', 'follow', 'push']
 CLIENT_NAME = sys.argv[1]
 CRED_PREFIX = sys.argv[2]
 SECRET = sys.argv[3]
+BATCH_WORKERS = 8
 
-# Read instance from user
-instance = input("Enter mastodon instance name: ")
+def ensure_client_credential(instance):
+    """
+    Register the app with an instance if needed, holding the lock only while touching files
+    """
+    # Check for app credential with a read lock first
+    client_credential = secret_registry.get_name_for(CRED_PREFIX, SECRET, instance, "client")
+    secret_registry.lock_credentials(CRED_PREFIX, instance, shared = True)
+    have_client_credential = secret_registry.have_credential(client_credential)
+    secret_registry.release_credentials()
+    if have_client_credential:
+        return client_credential
 
-# Lock credential DB
-secret_registry.lock_credentials()
-
-# Get app credential, register new if needed
-client_credential = secret_registry.get_name_for(CRED_PREFIX, SECRET, instance, "client")
-if not secret_registry.have_credential(client_credential):
-    Mastodon.create_app(
+    # Register without holding the lock
+    client_id, client_secret = Mastodon.create_app(
         CLIENT_NAME,
         api_base_url = instance,
-        scopes = SCOPES_TO_REQUEST,
-        to_file = client_credential
+        scopes = SCOPES_TO_REQUEST
     )
-    secret_registry.update_meta_time(client_credential)
-
-# Unlock credential DB
-secret_registry.release_credentials()
-
-# Start oauth flow
-api = Mastodon(client_id = client_credential)
-oauth_url = api.auth_request_url(scopes = SCOPES_TO_REQUEST)
-print(oauth_url)
-webbrowser.open_new(oauth_url)
-time.sleep(3)
-print("\n\n")
-
-# Get oauth code from user and log in
-oauth_code = input("After logging in, enter the code you received: ")
-
-# Lock credential DB
-secret_registry.lock_credentials()
-
-# Log in
-user_credential_temp = secret_registry.get_name_for(CRED_PREFIX, SECRET, instance, "user", oauth_code)
-api.log_in(
-    code = oauth_code,
-    to_file = user_credential_temp
-)
-secret_registry.update_meta_time(user_credential_temp)
-
-# Move to final place
-user_name = api.me().acct
-user_credential_final = secret_registry.get_name_for(CRED_PREFIX, SECRET, instance, "user", user_name)
-secret_registry.move_credential(user_credential_temp, user_credential_final)
-
-# Unlock credential DB
-secret_registry.release_credentials()
+
+    # Store, unless someone else was faster
+    secret_registry.lock_credentials(CRED_PREFIX, instance)
+    try:
+        if not secret_registry.have_credential(client_credential):
+            secret_registry.store_credential(client_credential, [client_id, client_secret, instance, CLIENT_NAME])
+    finally:
+        secret_registry.release_credentials()
+    return client_credential
+
+def provision_account(entry, login_data, client_credential):
+    """
+    Log in one account with a pre-obtained code or token, return a report entry
+    """
+    instance = entry["instance"]
+    result = {"instance": instance, "account": entry["account"]}
+
+    # Already have it?
+    user_credential = secret_registry.get_name_for(CRED_PREFIX, SECRET, instance, "user", entry["account"])
+    if secret_registry.have_credential(user_credential):
+        result["status"] = "exists"
+        return result
+
+    # Network calls, no lock
+    api = Mastodon(client_id = client_credential)
+    if "token" in login_data:
+        api = Mastodon(client_id = client_credential, access_token = login_data["token"])
+    elif "code" in login_data:
+        api.log_in(code = login_data["code"], scopes = SCOPES_TO_REQUEST)
+    else:
+        result["status"] = "needs_code"
+        result["auth_url"] = api.auth_request_url(scopes = SCOPES_TO_REQUEST)
+        return result
+    user_name = api.me().acct
+    if user_name != entry["account"]:
+        result["logged_in_as"] = user_name
+        user_credential = secret_registry.get_name_for(CRED_PREFIX, SECRET, instance, "user", user_name)
+
+    # Store
+    secret_registry.lock_credentials(CRED_PREFIX, instance)
+    try:
+        secret_registry.store_credential(user_credential, [api.access_token, api.api_base_url, api.client_id, api.client_secret])
+    finally:
+        secret_registry.release_credentials()
+    result["status"] = "provisioned"
+    return result
+
+def login_batch(manifest_file, codes_file = None, report_file = None):
+    with open(manifest_file, 'r') as f:
+        manifest = json.load(f)
+    codes = {}
+    if codes_file is not None:
+        with open(codes_file, 'r') as f:
+            codes = json.load(f)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers = BATCH_WORKERS) as executor:
+        # Apps first, once per instance
+        instances = sorted(set(entry["instance"] for entry in manifest))
+        client_futures = {instance: executor.submit(ensure_client_credential, instance) for instance in instances}
+        client_credentials = {}
+        client_errors = {}
+        for instance, future in client_futures.items():
+            try:
+                client_credentials[instance] = future.result()
+            except Exception as e:
+                client_errors[instance] = str(e)
+
+        # Then accounts
+        results = []
+        account_futures = []
+        for entry in manifest:
+            if entry["instance"] in client_errors:
+                results.append({
+                    "instance": entry["instance"], 
+                    "account": entry["account"], 
+                    "status": "failed", 
+                    "error": "App registration failed: " + client_errors[entry["instance"]]
+                })
+                continue
+            login_data = codes.get(entry["account"] + "@" + entry["instance"], {})
+            future = executor.submit(provision_account, entry, login_data, client_credentials[entry["instance"]])
+            account_futures.append((entry, future))
+        for entry, future in account_futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append({"instance": entry["instance"], "account": entry["account"], "status": "failed", "error": str(e)})
+
+    # Report
+    summary = {}
+    for result in results:
+        summary[result["status"]] = summary.get(result["status"], 0) + 1
+    report = {"summary": summary, "results": results}
+    if report_file is not None:
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent = 4)
+    print(json.dumps(summary))
+    return report
+
+def login_interactive():
+    # Read instance from user
+    instance = input("Enter mastodon instance name: ")
+
+    # Get app credential, register new if needed
+    client_credential = ensure_client_credential(instance)
+
+    # Start oauth flow
+    api = Mastodon(client_id = client_credential)
+    oauth_url = api.auth_request_url(scopes = SCOPES_TO_REQUEST)
+    print(oauth_url)
+    webbrowser.open_new(oauth_url)
+    time.sleep(3)
+    print("\n\n")
+
+    # Get oauth code from user and log in
+    oauth_code = input("After logging in, enter the code you received: ")
+
+    # Log in, network calls, no lock
+    api.log_in(code = oauth_code)
+    user_name = api.me().acct
+
+    # Store under the final name
+    user_credential = secret_registry.get_name_for(CRED_PREFIX, SECRET, instance, "user", user_name)
+    secret_registry.lock_credentials(CRED_PREFIX, instance)
+    try:
+        secret_registry.store_credential(user_credential, [api.access_token, api.api_base_url, api.client_id, api.client_secret])
+    finally:
+        secret_registry.release_credentials()
+
+if len(sys.argv) == 4:
+    login_interactive()
+else:
+    login_batch(*sys.argv[5:])
@@ -0,0 +1,88 @@
+# Cache for rendered pages that only change when their data does
+# A page is rendered once per data version and kept together with its gzip (and, if the brotli
+# module is installed, brotli) compressed bodies and strong ETags. Requests are answered from
+# that, with 304s for clients that already have the current version, so a traffic spike costs
+# almost no CPU. Concurrent requests for a stale page wait for one render instead of all
+# rendering it.
+
+import gzip
+import hashlib
+import threading
+
+from flask import make_response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Settings
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+class CachedPage():
+    """
+    One rendered version of a page, in every encoding we serve
+    """
+    def __init__(self, version, body, content_type):
+        self.version = version
+        self.content_type = content_type
+        self.bodies = {"identity": body}
+        self.bodies["gzip"] = gzip.compress(body, GZIP_LEVEL)
+        if brotli is not None:
+            self.bodies["br"] = brotli.compress(body, quality = BROTLI_QUALITY)
+
+        # Strong ETags differ per encoding, since the bytes differ
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.etags = {}
+        for encoding in self.bodies:
+            self.etags[encoding] = digest if encoding == "identity" else digest + "-" + encoding
+
+class PageCache():
+    """
+    Rendered pages by key, re-rendered when the version passed in changes
+    """
+    def __init__(self):
+        self.pages = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, version, render, content_type = "text/html; charset=utf-8"):
+        """
+        Get the CachedPage for key at version, calling render() for the body if it isn't cached
+        """
+        page = self.pages.get(key)
+        if page is not None and page.version == version:
+            return page
+        with self.lock:
+            page = self.pages.get(key)
+            if page is None or page.version != version:
+                body = render()
+                if isinstance(body, str):
+                    body = body.encode("utf-8")
+                page = CachedPage(version, body, content_type)
+                self.pages[key] = page
+        return page
+
+    def respond(self, request, key, version, render, content_type = "text/html; charset=utf-8"):
+        """
+        Flask response for a cached page: best encoding the client accepts, 304 if its copy is current
+        """
+        page = self.get(key, version, render, content_type)
+        encoding = "identity"
+        for candidate in ["br", "gzip"]:
+            if candidate in page.bodies and request.accept_encodings.quality(candidate) > 0:
+                encoding = candidate
+                break
+
+        etag = page.etags[encoding]
+        if request.if_none_match.contains(etag):
+            resp = make_response("", 304)
+        else:
+            resp = make_response(page.bodies[encoding])
+            resp.headers['Content-Type'] = page.content_type
+            if encoding != "identity":
+                resp.headers['Content-Encoding'] = encoding
+        resp.set_etag(etag)
+        resp.headers['Vary'] = "Accept-Encoding"
+        resp.headers['Cache-Control'] = "no-cache"
+        return resp
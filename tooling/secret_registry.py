@@ -3,19 +3,35 @@
 # This is more intended for experimental stuff
 
 import time
+import json
+import datetime
+import email.utils
 import hashlib
 import os
 import logging
 import glob
+import sqlite3
+import threading
+import collections
+import concurrent.futures
 import locket
+import requests
 
-from mastodon import Mastodon
+# Shared / exclusive file locks where available, otherwise everything goes through one locket lock
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from mastodon import Mastodon, MastodonRatelimitError
 
 global_secret = os.environ["MASTODON_GLOBAL_SECRET"]
 if global_secret is None or len(global_secret.strip()) == 0:
     raise Exception("Need to have a MASTODON_GLOBAL_SECRET env var")
 
 db_path = os.path.abspath(os.path.dirname(os.path.realpath(__file__)) + "/../../") + "/secrets/"
+if "MASTODON_SECRETS_DIR" in os.environ:
+    db_path = os.path.abspath(os.environ["MASTODON_SECRETS_DIR"]) + "/"
 if not os.path.exists(db_path):
     os.makedirs(db_path)
 
@@ -25,14 +41,58 @@ if not os.path.exists(credential_lock_file):
         f.write("")
 credential_lock = locket.lock_file(credential_lock_file)
 
-def get_name_for(prefix, secret, instance, cred_type, user = None):
+# Locks are sharded by (prefix, instance), so that a slow instance only blocks
+# its own shard. Taking a shard also takes the global lock in shared mode, so that
+# lock_credentials() without arguments still excludes everyone
+CREDENTIAL_LOCK_SHARDS = 64
+credential_locks_held = threading.local()
+
+# Catalog of credentials, indexed by prefix, type and creation time, so that lookups
+# and age based sweeps do not have to scan the directory and open every meta file.
+# The .secret / _meta.secret files stay the source of truth, the catalog can always
+# be rebuilt from them with "python secret_registry.py rebuild-catalog"
+catalog_file = db_path + ".catalog.db"
+catalog_is_new = not os.path.exists(catalog_file)
+catalog_local = threading.local()
+
+# In-process LRU cache of parsed credentials for hot request paths. Entries are
+# checked against the files mtime at most every CREDENTIAL_CACHE_RECHECK seconds,
+# to notice changes made by other processes
+CREDENTIAL_CACHE_SIZE = 4096
+CREDENTIAL_CACHE_RECHECK = 10
+credential_cache = collections.OrderedDict()
+credential_cache_keys = {}
+credential_cache_lock = threading.Lock()
+
+# Storage format for new credentials: "paired" keeps the creation time in a separate
+# _meta.secret file, "record" appends it to the credential file itself as a trailer
+# line that Mastodon.py never reads, so every credential is a single file. Both
+# formats are always readable, "python secret_registry.py migrate-records" converts
+CREDENTIAL_STORAGE = os.environ.get("MASTODON_CREDENTIAL_STORAGE", "paired")
+RECORD_META_MARKER = "@@@meta "
+
+# Bulk revocation settings
+REVOKE_PER_INSTANCE = 2
+REVOKE_MAX_RETRIES = 5
+REVOKE_BACKOFF_BASE = 2
+REVOKE_BACKOFF_MAX = 5 * 60
+REVOKE_REQUEST_TIMEOUT = 30
+
+def strip_instance(instance):
     """
-    Get a name for a credential file for the given object
+    Remove the protocol from an instance URL
     """
     if instance.startswith("http://"):
         instance = "http://".join(instance.split("http://")[1:])
     elif instance.startswith("https://"):
         instance = "https://".join(instance.split("https://")[1:])
+    return instance
+
+def get_name_for(prefix, secret, instance, cred_type, user = None):
+    """
+    Get a name for a credential file for the given object
+    """
+    instance = strip_instance(instance)
 
     if not cred_type in ["client", "user"]:
         raise Exception("Type must be Client or User")
@@ -55,17 +115,266 @@ def get_name_for(prefix, secret, instance, cred_type, user = None):
     
     return db_path + prefix + "_" + cred_type + "_" + hashlib.sha256(key.encode("utf-8")).hexdigest() + ".secret"
 
-def lock_credentials():
+def get_catalog():
+    """
+    Get this threads connection to the credential catalog, creating it if needed
+    """
+    global catalog_is_new
+    catalog = getattr(catalog_local, "connection", None)
+    if catalog is None:
+        catalog = sqlite3.connect(catalog_file, timeout = 60)
+        catalog.execute("PRAGMA journal_mode=WAL")
+        catalog.execute("""
+            CREATE TABLE IF NOT EXISTS credentials (
+                name TEXT PRIMARY KEY,
+                prefix TEXT,
+                cred_type TEXT,
+                created REAL
+            )
+        """)
+        catalog.execute("CREATE INDEX IF NOT EXISTS credentials_by_age ON credentials (prefix, cred_type, created)")
+        catalog.commit()
+        catalog_local.connection = catalog
+
+        # Fresh catalog next to an existing secrets dir -> import what is there
+        if catalog_is_new:
+            catalog_is_new = False
+            rebuild_catalog()
+    return catalog
+
+def split_name(name):
+    """
+    Get (prefix, cred_type) back from a credential file name
+    """
+    base = os.path.basename(name)[:-len(".secret")]
+    prefix, cred_type, _ = base.rsplit("_", 2)
+    return prefix, cred_type
+
+def read_credential_lines(name):
+    """
+    Read the lines of a credential file, and the record meta data if it has any
+    """
+    with open(name, 'r') as f:
+        lines = [line.rstrip("\n") for line in f.readlines()]
+    meta = None
+    if len(lines) > 0 and lines[-1].startswith(RECORD_META_MARKER):
+        meta = json.loads(lines.pop()[len(RECORD_META_MARKER):])
+    return lines, meta
+
+def write_record(name, created):
+    """
+    Atomically rewrite a credential file as a single record including its creation time
+    """
+    lines, _ = read_credential_lines(name)
+    lines += [""] * (4 - len(lines))
+    if split_name(name)[1] == "client" and len(lines[3]) == 0:
+        # Line 4 of client files is read as user agent by Mastodon.py, keep it its default
+        lines[3] = "mastodonpy"
+    lines.append(RECORD_META_MARKER + json.dumps({"created": created}))
+
+    temp_name = name + ".tmp"
+    with open(temp_name, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_name, name)
+    if os.path.exists(name + "_meta.secret"):
+        os.remove(name + "_meta.secret")
+
+def read_meta_time(name):
+    """
+    Read "creation" time for a credential file, 0 if unknown
+    """
+    try:
+        with open(name + "_meta.secret", 'r') as f:
+            return float(f.read().replace("\n", "").strip())
+    except:
+        pass
+    try:
+        _, meta = read_credential_lines(name)
+        return float(meta["created"])
+    except:
+        return 0
+
+def catalog_add(name, created):
+    """
+    Add or update a credential in the catalog
+    """
+    prefix, cred_type = split_name(name)
+    catalog = get_catalog()
+    catalog.execute(
+        "INSERT OR REPLACE INTO credentials (name, prefix, cred_type, created) VALUES (?, ?, ?, ?)",
+        (os.path.basename(name), prefix, cred_type, created)
+    )
+    catalog.commit()
+
+def catalog_remove(name):
+    """
+    Remove a credential from the catalog
+    """
+    catalog = get_catalog()
+    catalog.execute("DELETE FROM credentials WHERE name = ?", (os.path.basename(name),))
+    catalog.commit()
+
+def rebuild_catalog():
+    """
+    Sync the catalog with the secrets directory: import every credential file, drop entries
+    without one, and clean up orphaned meta files
+    """
+    # This is the import a fresh catalog would trigger, don't have get_catalog() run it again
+    global catalog_is_new
+    catalog_is_new = False
+
+    rows = []
+    for name in glob.glob(db_path + "*.secret"):
+        if name.endswith("_meta.secret"):
+            # Meta files left over from an interrupted delete
+            if not os.path.exists(name[:-len("_meta.secret")]):
+                os.remove(name)
+            continue
+        try:
+            prefix, cred_type = split_name(name)
+        except:
+            logging.warn(f"Skipping unrecognized credential file {name}")
+            continue
+        rows.append((os.path.basename(name), prefix, cred_type, read_meta_time(name)))
+
+    catalog = get_catalog()
+    with catalog:
+        catalog.execute("DELETE FROM credentials")
+        catalog.executemany("INSERT INTO credentials (name, prefix, cred_type, created) VALUES (?, ?, ?, ?)", rows)
+    return len(rows)
+
+def parse_credential(name, cred_type):
+    """
+    Read a credential file into keyword arguments for the Mastodon constructor
+    """
+    lines, _ = read_credential_lines(name)
+    lines = [line.rstrip() for line in lines] + [""] * 4
+    if cred_type == "client":
+        # Line 4 is the user agent, see write_record
+        login = {"client_id": lines[0], "client_secret": lines[1], "api_base_url": lines[2], "user_agent": lines[3]}
+    else:
+        login = {"access_token": lines[0], "api_base_url": lines[1], "client_id": lines[2], "client_secret": lines[3]}
+    return {key: value for key, value in login.items() if len(value) != 0}
+
+def invalidate_credential(name):
+    """
+    Drop a credential from the in-process cache
+    """
+    with credential_cache_lock:
+        key = credential_cache_keys.pop(name, None)
+        if key is not None:
+            credential_cache.pop(key, None)
+
+def get_credential(prefix, secret, instance, cred_type, user = None):
+    """
+    Get (name, parsed contents) for a credential, from the in-process cache if possible.
+    Contents are None if the credential does not exist.
+    """
+    # Keyed by the instance like the file name is, so "https://x" and "x" share one entry
+    key = (prefix, secret, strip_instance(instance), cred_type, user)
+    now = time.time()
+    with credential_cache_lock:
+        entry = credential_cache.get(key)
+        if entry is not None:
+            credential_cache.move_to_end(key)
+            if now - entry[3] < CREDENTIAL_CACHE_RECHECK:
+                return entry[0], entry[1]
+    name = entry[0] if entry is not None else get_name_for(prefix, secret, instance, cred_type, user)
+
+    # Not cached, or time to check if someone else changed it
+    try:
+        mtime = os.stat(name).st_mtime_ns
+    except FileNotFoundError:
+        invalidate_credential(name)
+        return name, None
+    if entry is not None and entry[2] == mtime:
+        entry[3] = now
+        return entry[0], entry[1]
+    login = parse_credential(name, cred_type)
+
+    with credential_cache_lock:
+        credential_cache[key] = [name, login, mtime, now]
+        credential_cache_keys[name] = key
+        while len(credential_cache) > CREDENTIAL_CACHE_SIZE:
+            _, evicted = credential_cache.popitem(last = False)
+            credential_cache_keys.pop(evicted[0], None)
+    return name, login
+
+def get_login(prefix, secret, instance, cred_type, user = None):
+    """
+    Get keyword arguments to create a Mastodon API object for a credential, from the in-process cache if possible
+    """
+    name, login = get_credential(prefix, secret, instance, cred_type, user)
+    if login is None:
+        # Let Mastodon.py deal with it just like with a file name
+        return {"access_token": name} if cred_type == "user" else {"client_id": name}
+    return login
+
+def get_lock_shard_file(prefix, instance):
+    """
+    Get the lock file for the shard that (prefix, instance) belongs to
+    """
+    key = prefix + "@@@\n" + strip_instance(instance)
+    shard = int(hashlib.sha256(key.encode("utf-8")).hexdigest(), 16) % CREDENTIAL_LOCK_SHARDS
+    return db_path + ".lock_" + str(shard)
+
+def flock_file(name, shared):
     """
-    Acquire database lock
+    Open a file and flock it, return the file descriptor
     """
-    credential_lock.acquire()
+    fd = os.open(name, os.O_RDWR | os.O_CREAT)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+    except:
+        os.close(fd)
+        raise
+    return fd
+
+def lock_credentials(prefix = None, instance = None, shared = False):
+    """
+    Acquire database lock. Without prefix and instance, locks the whole database, with
+    them only the shard that (prefix, instance) belongs to. shared = True acquires a
+    read lock, which can be held by many readers at once.
+    """
+    held = getattr(credential_locks_held, "stack", None)
+    if held is None:
+        held = credential_locks_held.stack = []
+
+    # No flock -> everything is one exclusive lock
+    if fcntl is None:
+        if len(held) == 0:
+            credential_lock.acquire()
+        held.append((True, []))
+        return
+
+    # Already holding the whole database exclusively -> nothing more to do
+    if any(exclusive for exclusive, _ in held):
+        held.append((True, []))
+        return
+
+    if prefix is None or instance is None:
+        fds = [flock_file(credential_lock_file, shared)]
+    else:
+        fds = [flock_file(credential_lock_file, True)]
+        try:
+            fds.append(flock_file(get_lock_shard_file(prefix, instance), shared))
+        except:
+            os.close(fds[0])
+            raise
+    held.append((not shared and len(fds) == 1, fds))
 
 def release_credentials():
     """
-    Release database lock
+    Release the most recently acquired database lock
     """
-    credential_lock.release()
+    _, fds = credential_locks_held.stack.pop()
+    if fcntl is None and len(credential_locks_held.stack) == 0:
+        credential_lock.release()
+    for fd in reversed(fds):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
 
 def move_credential(from_name, to_name):
     """
@@ -75,37 +384,183 @@ def move_credential(from_name, to_name):
         raise Exception("Invalid name")
     if not to_name.startswith(db_path) or not to_name.endswith(".secret"):
         raise Exception("Invalid name")
+    invalidate_credential(from_name)
+    invalidate_credential(to_name)
     os.rename(from_name, to_name)
-    os.rename(from_name + "_meta.secret", to_name + "_meta.secret")
+    if os.path.exists(from_name + "_meta.secret"):
+        os.rename(from_name + "_meta.secret", to_name + "_meta.secret")
+    elif os.path.exists(to_name + "_meta.secret"):
+        os.remove(to_name + "_meta.secret")
+
+    catalog = get_catalog()
+    with catalog:
+        catalog.execute("DELETE FROM credentials WHERE name = ?", (os.path.basename(to_name),))
+        moved = catalog.execute(
+            "UPDATE credentials SET name = ? WHERE name = ?",
+            (os.path.basename(to_name), os.path.basename(from_name))
+        ).rowcount
+    if moved == 0:
+        catalog_add(to_name, read_meta_time(to_name))
 
 def have_credential(name):
     """
-    Just test if file exists
+    Test if a credential exists. The file decides, the catalog is only an index: a catalog
+    entry whose file is gone is dropped.
     """
     if not name.startswith(db_path) or not name.endswith(".secret"):
         raise Exception("Invalid name")
-    return os.path.isfile(name)
+    if os.path.isfile(name):
+        return True
+    row = get_catalog().execute("SELECT 1 FROM credentials WHERE name = ?", (os.path.basename(name),)).fetchone()
+    if row is not None:
+        logging.warn(f"Dropping catalog entry for missing credential file {name}")
+        invalidate_credential(name)
+        catalog_remove(name)
+    return False
+
+def delete_credential(name):
+    """
+    Delete the files for a credential and drop it from catalog and cache. The meta file
+    goes first, so that an interruption at worst leaves a token without meta time, which
+    the next sweep treats as infinitely old, rather than an orphaned meta file.
+    """
+    invalidate_credential(name)
+    try:
+        if os.path.exists(name + "_meta.secret"):
+            os.remove(name + "_meta.secret")
+        os.remove(name)
+    except:
+        logging.warn(f"Error while deleting token {name}")
+    catalog_remove(name)
 
 def revoke_credential(name):
     """
-    Log in with a credential, revoke it if possible, delete the file
+    Log in with a credential, revoke it if possible, delete the file.
+    Returns None if the token was revoked or an error string.
     """
     if not name.startswith(db_path) or not name.endswith(".secret"):
         raise Exception("Invalid name")    
+    invalidate_credential(name)
+    error = None
     try:
         api = Mastodon(access_token = name)
         api.revoke_access_token()
-    except:
+    except Exception as e:
         logging.warn(f"Could not revoke token {name}")
+        error = "Could not revoke: " + str(e)
+    delete_credential(name)
+    return error
+
+class InstanceGate():
+    """
+    Concurrency cap and rate limit pause for one instance during bulk revocation
+    """
+    def __init__(self, max_concurrent):
+        self.semaphore = threading.Semaphore(max_concurrent)
+        self.paused_until = 0
+
+    def pause_until(self, when):
+        self.paused_until = max(self.paused_until, when)
+
+    def wait(self, stop_event):
+        while not stop_event.is_set():
+            to_wait = self.paused_until - time.time()
+            if to_wait <= 0:
+                return
+            stop_event.wait(min(to_wait, 1))
+
+def parse_retry_time(headers):
+    """
+    Unix time a rate limited response says to retry at, from its Retry-After or
+    X-RateLimit-Reset header, or None if it has neither
+    """
+    now = time.time()
+    retry_after = headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return now + float(retry_after)
+        except ValueError:
+            pass
+        try:
+            return email.utils.parsedate_to_datetime(retry_after).timestamp()
+        except (TypeError, ValueError):
+            pass
+    reset = headers.get("X-RateLimit-Reset")
+    if reset is None:
+        return None
     try:
-        os.remove(name)
-        os.remove(name + "_meta.secret")
-    except:
-        logging.warn(f"Error while deleting token {name}")
+        reset = float(reset)
+    except ValueError:
+        try:
+            reset = datetime.datetime.fromisoformat(reset.replace("Z", "+00:00")).timestamp()
+        except ValueError:
+            return None
+
+    # The reset time is the server's, adjust it to our clock
+    try:
+        return reset + now - email.utils.parsedate_to_datetime(headers["Date"]).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return reset
 
-def revoke_all_older_than(prefix, cred_type, when = None):
+def revoke_with_backoff(name, cred_type, gate, stop_event):
     """
-    Revoke all credentials of a certain type older than some time
+    Revoke a credential, waiting out rate limits on its instance, then delete it.
+    Returns None on success or an error string.
+    """
+    error = None
+    try:
+        login = parse_credential(name, cred_type)
+    except FileNotFoundError:
+        # Deleted since the sweep listed it, just drop what is left of it
+        delete_credential(name)
+        return "Credential file missing"
+    if "access_token" in login:
+        # Mastodon.py does not keep rate limit headers for revocation requests, so note
+        # them from every 429 the session sees
+        retry_times = []
+        def note_retry_time(response, *args, **kwargs):
+            if response.status_code == 429:
+                retry_times.append(parse_retry_time(response.headers))
+        session = requests.Session()
+        session.hooks["response"].append(note_retry_time)
+        for attempt in range(REVOKE_MAX_RETRIES + 1):
+            gate.wait(stop_event)
+            if stop_event.is_set():
+                return "Interrupted"
+            try:
+                with gate.semaphore:
+                    api = Mastodon(
+                        **login,
+                        session = session,
+                        ratelimit_method = "throw",
+                        request_timeout = REVOKE_REQUEST_TIMEOUT,
+                        version_check_mode = "none"
+                    )
+                    api.revoke_access_token()
+                error = None
+                break
+            except MastodonRatelimitError as e:
+                # Back off: until the time the instance told us, exponentially if it didn't
+                error = "Rate limited: " + str(e)
+                retry_time = retry_times.pop() if len(retry_times) > 0 else None
+                retry_times.clear()
+                if retry_time is None:
+                    retry_time = time.time() + REVOKE_BACKOFF_BASE * 2 ** attempt
+                gate.pause_until(min(retry_time, time.time() + REVOKE_BACKOFF_MAX))
+            except Exception as e:
+                error = "Could not revoke: " + str(e)
+                break
+        session.close()
+    delete_credential(name)
+    return error
+
+def revoke_all_older_than(prefix, cred_type, when = None, workers = 1, progress = None):
+    """
+    Revoke all credentials of a certain type older than some time. With workers > 1,
+    revoke concurrently, at most REVOKE_PER_INSTANCE at a time per instance. progress,
+    if given, is called with (done, total) after every credential.
+
+    Returns a summary dict with counts and a list of failures.
     """
     if not cred_type in ["client", "user"]:
         raise Exception("Type must be Client or User")
@@ -114,34 +569,134 @@ def revoke_all_older_than(prefix, cred_type, when = None):
     if when is None:
         when = time.time()
 
-    # Go through files and revoke
-    names = glob.glob(db_path + prefix + "_" + cred_type + "*.secret")
-    for name in names:
-        if name.endswith("_meta.secret"):
-            continue
-        meta_name = name + "_meta.secret"
-        mod_time = 0
+    # Look up candidates in the catalog
+    names = get_catalog().execute(
+        "SELECT name FROM credentials WHERE prefix = ? AND cred_type = ? AND created < ?",
+        (prefix, cred_type, when)
+    ).fetchall()
+    names = [db_path + name for (name,) in names]
+    summary = {"total": len(names), "revoked": 0, "failed": [], "interrupted": False, "elapsed": 0}
+    time_start = time.time()
 
-        # Extra paranoid programming
-        try:
-            with open(meta_name, 'r') as f:
-                mod_time = float(f.read().replace("\n", "").strip())
-        except:
-            mod_time = 0
-        should_revoke = True
+    # Sequential: same as always
+    if workers <= 1:
+        for done, name in enumerate(names):
+            try:
+                error = revoke_credential(name)
+            except Exception as e:
+                logging.warn(f"Error when revoking credential {name}")
+                error = str(e)
+            if error is None:
+                summary["revoked"] += 1
+            else:
+                summary["failed"].append({"name": name, "error": error})
+            if progress is not None:
+                progress(done + 1, len(names))
+        summary["elapsed"] = time.time() - time_start
+        return summary
+
+    # Concurrent: interleave instances so the per-instance caps don't starve the pool
+    by_instance = collections.defaultdict(list)
+    for name in names:
         try:
-            should_revoke = mod_time is None or mod_time < when
+            instance = parse_credential(name, cred_type).get("api_base_url", "")
         except:
-            pass
-        if should_revoke:
+            instance = ""
+        by_instance[instance].append(name)
+    gates = {instance: InstanceGate(REVOKE_PER_INSTANCE) for instance in by_instance}
+    queue = []
+    while len(by_instance) > 0:
+        for instance in list(by_instance.keys()):
+            queue.append((instance, by_instance[instance].pop()))
+            if len(by_instance[instance]) == 0:
+                del by_instance[instance]
+
+    stop_event = threading.Event()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers = workers)
+    try:
+        futures = {
+            executor.submit(revoke_with_backoff, name, cred_type, gates[instance], stop_event): (instance, name)
+            for instance, name in queue
+        }
+        for done, future in enumerate(concurrent.futures.as_completed(futures)):
+            instance, name = futures[future]
             try:
-                revoke_credential(name)
-            except:
-                logging.warn(f"Error when revoking credential {name}")
+                error = future.result()
+            except Exception as e:
+                error = str(e)
+            if error is None:
+                summary["revoked"] += 1
+            else:
+                summary["failed"].append({"name": name, "instance": instance, "error": error})
+            if progress is not None:
+                progress(done + 1, len(names))
+            if (done + 1) % 100 == 0:
+                logging.info(f"Revoked {done + 1} / {len(names)} credentials")
+    except BaseException:
+        # Interrupted: let running revocations finish their cleanup, drop the rest
+        summary["interrupted"] = True
+        stop_event.set()
+        raise
+    finally:
+        executor.shutdown(wait = True, cancel_futures = True)
+        summary["elapsed"] = time.time() - time_start
+        logging.info(f"Revocation summary: {summary['revoked']} revoked, {len(summary['failed'])} failed, {summary['total']} total")
+    return summary
 
 def update_meta_time(name):
     """
     Set "creation" time for a credential file
     """
-    with open(name + "_meta.secret", 'w') as f:
-        f.write(str(time.time()))
+    now = time.time()
+    if CREDENTIAL_STORAGE == "record":
+        write_record(name, now)
+    else:
+        with open(name + "_meta.secret", 'w') as f:
+            f.write(str(now))
+    catalog_add(name, now)
+
+def store_credential(name, lines):
+    """
+    Write a credential file from its lines (in the format Mastodon.py reads) and set its creation time
+    """
+    if not name.startswith(db_path) or not name.endswith(".secret"):
+        raise Exception("Invalid name")
+    invalidate_credential(name)
+    with open(name, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    update_meta_time(name)
+
+def migrate_to_records():
+    """
+    Convert every paired credential in the secrets directory to a single record
+    """
+    migrated = 0
+    for meta_name in glob.glob(db_path + "*.secret_meta.secret"):
+        name = meta_name[:-len("_meta.secret")]
+        if not os.path.exists(name):
+            os.remove(meta_name)
+            continue
+        invalidate_credential(name)
+        write_record(name, read_meta_time(name))
+        migrated += 1
+    return migrated
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) == 2 and sys.argv[1] == "rebuild-catalog":
+        count = rebuild_catalog()
+        print("Imported " + str(count) + " credentials into " + catalog_file)
+    elif len(sys.argv) == 2 and sys.argv[1] == "migrate-records":
+        count = migrate_to_records()
+        print("Migrated " + str(count) + " credentials to single records")
+    elif len(sys.argv) in [5, 6] and sys.argv[1] == "revoke-older-than":
+        import json
+        logging.basicConfig(level = logging.INFO)
+        workers = int(sys.argv[5]) if len(sys.argv) == 6 else 16
+        when = time.time() - float(sys.argv[4]) * 24 * 60 * 60
+        summary = revoke_all_older_than(sys.argv[2], sys.argv[3], when, workers)
+        print(json.dumps(summary, indent = 4))
+    else:
+        print("Usage: " + sys.argv[0] + " rebuild-catalog")
+        print("       " + sys.argv[0] + " migrate-records")
+        print("       " + sys.argv[0] + " revoke-older-than <prefix> <client|user> <days> [workers]")
@@ -0,0 +1,180 @@
+# Shared server side session store for the flask apps
+# All apps keep their sessions in one SQLite database in WAL mode, namespaced by app prefix,
+# instead of one file per session. Sessions expire after a TTL and a background compaction
+# pass evicts expired ones and keeps the database file from growing without bound.
+
+import time
+import pickle
+import secrets
+import sqlite3
+import logging
+import threading
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+# Settings
+COMPACTION_INTERVAL = 10 * 60
+COMPACTION_BATCH = 10000
+
+class StoredSession(CallbackDict, SessionMixin):
+    """
+    Session dict that remembers its id and whether it was modified
+    """
+    def __init__(self, initial = None, sid = None, new = False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+class SessionStore():
+    """
+    Session data for all apps in one SQLite database, namespaced per app, with expiry
+    """
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.local = threading.local()
+        self.compaction_thread = None
+        db = self.get_db()
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                namespace TEXT,
+                sid TEXT,
+                data BLOB,
+                expires REAL,
+                PRIMARY KEY (namespace, sid)
+            ) WITHOUT ROWID
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS sessions_by_expiry ON sessions (expires)")
+        db.commit()
+
+    def get_db(self):
+        # One connection per thread
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.db_file, timeout = 30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self.local.db = db
+        return db
+
+    def get(self, namespace, sid):
+        row = self.get_db().execute(
+            "SELECT data FROM sessions WHERE namespace = ? AND sid = ? AND expires > ?",
+            (namespace, sid, time.time())
+        ).fetchone()
+        return None if row is None else pickle.loads(row[0])
+
+    def set(self, namespace, sid, data, ttl):
+        db = self.get_db()
+        db.execute(
+            "INSERT OR REPLACE INTO sessions (namespace, sid, data, expires) VALUES (?, ?, ?, ?)",
+            (namespace, sid, pickle.dumps(data), time.time() + ttl)
+        )
+        db.commit()
+
+    def delete(self, namespace, sid):
+        db = self.get_db()
+        db.execute("DELETE FROM sessions WHERE namespace = ? AND sid = ?", (namespace, sid))
+        db.commit()
+
+    def compact(self):
+        """
+        Evict expired sessions in batches, then give the space back
+        """
+        db = self.get_db()
+        evicted = 0
+        while True:
+            deleted = db.execute(
+                "DELETE FROM sessions WHERE (namespace, sid) IN (SELECT namespace, sid FROM sessions WHERE expires <= ? LIMIT ?)",
+                (time.time(), COMPACTION_BATCH)
+            ).rowcount
+            db.commit()
+            evicted += deleted
+            if deleted < COMPACTION_BATCH:
+                break
+        db.execute("PRAGMA incremental_vacuum")
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return evicted
+
+    def start_compaction(self):
+        """
+        Run compaction in a background thread every COMPACTION_INTERVAL seconds
+        """
+        if self.compaction_thread is not None:
+            return
+        def compaction_worker():
+            while True:
+                try:
+                    evicted = self.compact()
+                    if evicted > 0:
+                        logging.info("Evicted " + str(evicted) + " expired sessions")
+                except Exception as e:
+                    logging.warning("Session compaction failed: " + str(e))
+                time.sleep(COMPACTION_INTERVAL)
+        self.compaction_thread = threading.Thread(target = compaction_worker, daemon = True)
+        self.compaction_thread.start()
+
+class StoreSessionInterface(SessionInterface):
+    """
+    Flask session interface that keeps only a random session id in the cookie
+    """
+    def __init__(self, store, namespace):
+        self.store = store
+        self.namespace = namespace
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid is not None:
+            data = self.store.get(self.namespace, sid)
+            if data is not None:
+                return StoredSession(data, sid = sid)
+        return StoredSession(sid = secrets.token_urlsafe(32), new = True)
+
+    def save_session(self, app, session, response):
+        cookie_name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        # Emptied session -> drop it
+        if not session:
+            if session.modified:
+                self.store.delete(self.namespace, session.sid)
+                response.delete_cookie(cookie_name, domain = domain, path = path)
+            return
+
+        if not self.should_set_cookie(app, session):
+            return
+        ttl = app.permanent_session_lifetime.total_seconds()
+        if session.modified or session.new:
+            self.store.set(self.namespace, session.sid, dict(session), ttl)
+        response.set_cookie(
+            cookie_name,
+            session.sid,
+            expires = self.get_expiration_time(app, session),
+            httponly = self.get_cookie_httponly(app),
+            domain = domain,
+            path = path,
+            secure = self.get_cookie_secure(app),
+            samesite = self.get_cookie_samesite(app)
+        )
+
+# One store per database file, shared by every app in the process
+stores = {}
+stores_lock = threading.Lock()
+
+def get_store(db_file):
+    with stores_lock:
+        if not db_file in stores:
+            stores[db_file] = SessionStore(db_file)
+            stores[db_file].start_compaction()
+        return stores[db_file]
+
+def get_session_interface(db_file, namespace):
+    """
+    Get a flask session interface for an app, backed by the shared store in db_file
+    """
+    return StoreSessionInterface(get_store(db_file), namespace)
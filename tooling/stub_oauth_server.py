@@ -0,0 +1,70 @@
+# Minimal local stand-in for an instance's OAuth revocation endpoint
+# Every request is answered after a delay, every Nth request is rate limited with a 429,
+# so that bulk revocation can be tried out without touching real instances.
+
+import sys
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Settings
+RESPONSE_DELAY = 0.05
+RATELIMIT_EVERY = 10
+RATELIMIT_RESET_AFTER = 1
+
+class StubOAuthHandler(BaseHTTPRequestHandler):
+    request_count = 0
+    revoked = set()
+    count_lock = threading.Lock()
+
+    def send_json(self, code, data, headers = {}):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        # No oauth server metadata -> clients fall back to /oauth/revoke
+        self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        time.sleep(RESPONSE_DELAY)
+        if self.path != "/oauth/revoke":
+            self.send_json(404, {"error": "Not found"})
+            return
+        with StubOAuthHandler.count_lock:
+            StubOAuthHandler.request_count += 1
+            limited = RATELIMIT_EVERY > 0 and StubOAuthHandler.request_count % RATELIMIT_EVERY == 0
+        ratelimit_headers = {
+            "X-RateLimit-Limit": "300",
+            "X-RateLimit-Remaining": "0" if limited else "100",
+            "X-RateLimit-Reset": str(int(time.time() + RATELIMIT_RESET_AFTER)),
+        }
+        if limited:
+            ratelimit_headers["Retry-After"] = str(RATELIMIT_RESET_AFTER)
+            self.send_json(429, {"error": "Too many requests"}, ratelimit_headers)
+        else:
+            self.send_json(200, {}, ratelimit_headers)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server(port = 0):
+    """
+    Start a stub server in a background thread, return it (the port is server.server_address[1])
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubOAuthHandler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8123
+    print("Stub OAuth server on http://127.0.0.1:" + str(port))
+    ThreadingHTTPServer(("127.0.0.1", port), StubOAuthHandler).serve_forever()